@@ -0,0 +1,251 @@
+#!/usr/bin/env python
+
+# task: search the depth pipeline tunables with closed-loop kinematic flights
+# (imports kinematic_sim and so the ROS python packages)
+from __future__ import print_function
+from __future__ import division
+
+import argparse
+import hashlib
+import json
+import multiprocessing
+import os
+import time
+
+from kinematic_sim import KinematicFlight, WORLDS, run_case
+
+import numpy as np
+import yaml
+
+from depth_params import ParameterStore
+
+
+# (low, high) of every tuned parameter; ints are rounded
+SEARCH_SPACE = {
+  'VERTICAL_KERNEL_SIZE': (150, 500),
+  'VERTICAL_DECAY_RATE': (2., 50.),
+  'VERTICAL_DECAY_CUTOFF': (40., 200.),
+  'HORIZONTAL_KERNEL_SIZE': (40, 200),
+  'HORIZONTAL_DECAY_RATE': (2., 50.),
+  'HORIZONTAL_DECAY_CUTOFF': (4., 40.),
+  'K_vertical': (0., 2.),
+  'K_horizontal': (0., 2.),
+  'DANGER_DISTANCE': (1.5, 4.),
+  'THRESHOLD_FRACTION': (0.5, 0.95),
+}
+
+# Flight score: reaching the marker is worth 1 plus up to TIME_WEIGHT for
+# reaching it early, a collision COLLISION_SCORE; flights that didn't
+# collide add CLEARANCE_WEIGHT times their minimum clearance up to
+# CLEARANCE_CAP. A configuration scores the mean over its flights.
+TIME_WEIGHT = 0.5
+COLLISION_SCORE = -1.
+CLEARANCE_WEIGHT = 0.2
+CLEARANCE_CAP = 1.5 # m
+
+
+def flight_score(result):
+  if result['outcome'] == 'collided':
+    return COLLISION_SCORE
+  score = CLEARANCE_WEIGHT*min(result['clearance'], CLEARANCE_CAP)/CLEARANCE_CAP
+  if result['outcome'] == 'reached':
+    score += 1. + TIME_WEIGHT*(1. - result['sim_time']/KinematicFlight.MAX_TIME)
+  return score
+
+
+def config_key(parameters, setting):
+  '''
+  Hash of a configuration and the flights it is evaluated on, so
+  results of another engine or world set are never mixed in
+  '''
+  text = json.dumps([sorted(parameters.items()), setting], sort_keys=True)
+  return hashlib.sha1(text.encode('utf-8')).hexdigest()[:16]
+
+
+class ResultCache:
+  '''
+  Flight results appended to a JSON lines file as they finish, keyed by
+  configuration hash, world and seed. Reopening the file resumes an
+  interrupted search without flying anything twice.
+  '''
+
+  def __init__(self, path):
+    self.path = path
+    self.flights = {}
+    if os.path.exists(path):
+      with open(path) as cache_file:
+        for line in cache_file:
+          try:
+            record = json.loads(line)
+          except ValueError:
+            continue # Line cut short by an interruption
+          self.add(record)
+
+  def add(self, record):
+    self.flights[(record['key'], record['world'], record['seed'])] = record
+
+  def append(self, record):
+    self.add(record)
+    with open(self.path, 'a') as cache_file:
+      cache_file.write(json.dumps(record) + '\n')
+
+  def results(self, key, cases):
+    '''
+    Cached flights of a configuration over (world, seed) cases; None if
+    any is missing
+    '''
+    found = [self.flights.get((key, world, seed)) for world, seed in cases]
+    return None if None in found else found
+
+
+class ParameterSearch:
+  '''
+  Random search over SEARCH_SPACE, refined around the best configurations.
+  Configurations are proposed in generations of batch_size: the first
+  holds the defaults and random samples, later ones perturb the best
+  scored so far for half the batch and sample the rest at random. All the
+  flights of a generation go to one process pool. Proposals only depend
+  on the seed and the cached scores, so a resumed search proposes the
+  same configurations and finds their flights in the cache.
+  '''
+  PERTURBATION = 0.1 # standard deviation, fraction of the parameter range
+  ELITE = 3 # configurations perturbed
+
+  def __init__(self, cache, engine='penalty', worlds=WORLDS, seeds=2, workers=1,
+               batch_size=8, seed=0, options=None):
+    self.cache = cache
+    self.engine = engine
+    self.worlds = worlds
+    self.cases = [(os.path.basename(path), seed) for path in worlds for seed in range(seeds)]
+    self.workers = workers
+    self.batch_size = batch_size
+    self.seed = seed
+    self.options = dict(options or {}, use_planner=True)
+    self.setting = [engine, self.cases, sorted(self.options.items())]
+    self.store = ParameterStore()
+    self.scores = {} # key: (score, parameters, results)
+
+
+  def defaults(self):
+    return dict((name, self.store.values[name]) for name in SEARCH_SPACE)
+
+
+  def validated(self, values):
+    '''
+    Values rounded and converted to their declared types
+    '''
+    return dict((name, self.store.convert(name, int(round(value)) if isinstance(SEARCH_SPACE[name][0], int)
+                                            else float(value)))
+                for name, value in values.items())
+
+
+  def sample(self, rng):
+    return self.validated(dict((name, rng.uniform(float(low), float(high)))
+                               for name, (low, high) in SEARCH_SPACE.items()))
+
+
+  def perturb(self, parameters, rng):
+    values = {}
+    for name, (low, high) in SEARCH_SPACE.items():
+      value = parameters[name] + rng.normal(0., self.PERTURBATION*(high - low))
+      values[name] = np.clip(value, low, high)
+    return self.validated(values)
+
+
+  def propose(self, generation):
+    rng = np.random.RandomState([self.seed, generation])
+    if generation == 0:
+      batch = [self.defaults()]
+    else:
+      ranked = sorted(self.scores.values(), key=lambda entry: -entry[0])
+      elite = [parameters for score, parameters, results in ranked[:self.ELITE]]
+      batch = [self.perturb(elite[i % len(elite)], rng) for i in range(self.batch_size//2)]
+    while len(batch) < self.batch_size:
+      batch.append(self.sample(rng))
+    return batch
+
+
+  def evaluate(self, batch):
+    '''
+    Fly every uncached (configuration, world, seed) of a batch on the
+    pool, caching each flight as it lands, and score the batch
+    '''
+    paths = dict((os.path.basename(path), path) for path in self.worlds)
+    keys = [config_key(parameters, self.setting) for parameters in batch]
+    todo, owners = [], []
+    for key, parameters in zip(keys, batch):
+      for world, seed in self.cases:
+        if (key, world, seed) not in self.cache.flights:
+          options = dict(self.options, parameters=parameters)
+          todo.append((paths[world], self.engine, seed, options))
+          owners.append((key, parameters))
+
+    if todo:
+      pool = multiprocessing.Pool(self.workers) if self.workers > 1 else None
+      try:
+        flights = (pool.imap(run_case, todo, chunksize=1) if pool is not None
+                   else (run_case(case) for case in todo))
+        for (key, parameters), result in zip(owners, flights):
+          record = dict((name, value.item() if isinstance(value, np.generic) else value)
+                        for name, value in result.items())
+          record.update(key=key, parameters=parameters)
+          self.cache.append(record)
+      finally:
+        if pool is not None:
+          pool.close()
+          pool.join()
+
+    for key, parameters in zip(keys, batch):
+      results = self.cache.results(key, self.cases)
+      self.scores[key] = (np.mean([flight_score(r) for r in results]), parameters, results)
+
+
+  def run(self, generations):
+    for generation in range(generations):
+      start = time.time()
+      self.evaluate(self.propose(generation))
+      best = max(self.scores.values(), key=lambda entry: entry[0])
+      print("generation %d: %d configurations, best score %.3f (%.1f s)"
+            % (generation, len(self.scores), best[0], time.time() - start))
+    return sorted(self.scores.values(), key=lambda entry: -entry[0])
+
+
+def summary(results):
+  outcomes = [r['outcome'] for r in results]
+  reached = [r['sim_time'] for r in results if r['outcome'] == 'reached']
+  return ("reached %d collided %d of %d, time to marker %s, min clearance %.2f m"
+          % (outcomes.count('reached'), outcomes.count('collided'), len(results),
+             "%.0f s" % np.mean(reached) if reached else "-",
+             min(r['clearance'] for r in results)))
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(
+      description="Search the depth pipeline tunables with kinematic closed-loop flights")
+  parser.add_argument('--engine', default='penalty', help="penalty, profile or vfh")
+  parser.add_argument('--worlds', nargs='*', default=WORLDS)
+  parser.add_argument('--seeds', type=int, default=2, help="flights per world")
+  parser.add_argument('--generations', type=int, default=4)
+  parser.add_argument('--batch-size', type=int, default=8, help="configurations per generation")
+  parser.add_argument('--workers', type=int, default=multiprocessing.cpu_count())
+  parser.add_argument('--seed', type=int, default=0)
+  parser.add_argument('--cache', default='autotune_results.jsonl',
+                      help="flight results, reused when the search is rerun")
+  parser.add_argument('--best', metavar='YAML',
+                      help="write the best configuration as a depth_params file")
+  args = parser.parse_args()
+
+  search = ParameterSearch(ResultCache(args.cache), args.engine, args.worlds, args.seeds,
+                           args.workers, args.batch_size, args.seed)
+  ranked = search.run(args.generations)
+  default_key = config_key(search.defaults(), search.setting)
+  for score, parameters, results in ranked[:5]:
+    tag = " (defaults)" if config_key(parameters, search.setting) == default_key else ""
+    print("score %.3f%s: %s" % (score, tag, summary(results)))
+    print("  " + ", ".join("%s=%.4g" % item for item in sorted(parameters.items())))
+  score, parameters, results = search.scores[default_key]
+  print("defaults score %.3f: %s" % (score, summary(results)))
+  if args.best:
+    with open(args.best, 'w') as yaml_file:
+      yaml_file.write("# autotune.py --engine %s best score %.3f\n" % (args.engine, ranked[0][0]))
+      yaml.safe_dump(ranked[0][1], yaml_file, default_flow_style=False)
@@ -0,0 +1,603 @@
+#!/usr/bin/env python
+
+# task: offline timing of the perception/planning stages (no ROS node needed;
+# the depth pipeline benchmarks import helper2 and so the ROS python packages)
+from __future__ import print_function
+from __future__ import division
+
+import argparse
+import glob
+import itertools
+import os
+import time
+
+# Pin BLAS/OpenMP to one core so the numbers reflect a single onboard core
+os.environ.setdefault('OMP_NUM_THREADS', '1')
+os.environ.setdefault('OPENBLAS_NUM_THREADS', '1')
+
+import numpy as np
+import scipy.ndimage
+
+from occupancy_map import OccupancyMap
+from planner import DStarLite
+from sdf_world import WorldModel
+
+
+FRAME_RATE = 30. # Hz, the budget every per-frame stage has to fit in
+WORLDS = sorted(glob.glob(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                       '..', '..', 'interiit21', 'worlds', 'interiit_world*.world')))
+
+
+def synthetic_depth(height=480, width=640, wall=6., seed=0):
+  '''
+  Depth image (metres, NaN = out of range) of a wall with a doorway
+  and a few random posts in front of it
+  '''
+  rng = np.random.RandomState(seed)
+  depth = np.full((height, width), wall, dtype=np.float32)
+  depth[height//4:, width//2-60:width//2+60] = np.nan
+  for _ in range(4):
+    col = rng.randint(0, width-40)
+    depth[:, col:col+40] = rng.uniform(1.5, wall)
+  depth[:height//5, :] = np.nan
+  return depth
+
+
+def report(name, times):
+  times = 1e3*np.asarray(times)
+  print("%-28s mean %7.2f ms  p95 %7.2f ms  (%6.1f Hz, budget %.1f ms)"
+        % (name, times.mean(), np.percentile(times, 95),
+           1e3/times.mean(), 1e3/FRAME_RATE))
+
+
+def bench_occupancy(frames):
+  occupancy_map = OccupancyMap()
+  depth = synthetic_depth()
+  times = []
+  for i in range(frames):
+    position = [0.05*i, 0.02*i, 2.5]
+    orientation = [0., 0., 0.01*i]
+    t = time.time()
+    occupancy_map.update(depth, position, orientation)
+    times.append(time.time() - t)
+  report("occupancy update", times)
+  print("  occupied voxels: %d, grid memory: %.1f MB"
+        % (np.sum(occupancy_map.grid > occupancy_map.L_OCCUPIED),
+           occupancy_map.grid.nbytes/1e6))
+
+
+def bench_rays(frames):
+  '''
+  Batched ray integration against a per-ray Python loop doing the same
+  voxel walk (timed on a slice of the rays and extrapolated)
+  '''
+  occupancy_map = OccupancyMap()
+  depth = synthetic_depth()
+  position, orientation = [0., 0., 2.5], [0., 0., 0.]
+  occupancy_map.recentre(position)
+  points, hit, origin = occupancy_map.depth_to_points(depth, position, orientation)
+  free_rays = occupancy_map.pixel_grid(depth.shape)[-1]
+
+  times = []
+  for _ in range(frames):
+    t = time.time()
+    occupancy_map.integrate_rays(origin, points, hit, free_rays)
+    times.append(time.time() - t)
+  report("batched rays (%d rays)" % np.sum(free_rays), times)
+
+  subset = points[free_rays][:200]
+  t = time.time()
+  for point in subset:
+    occupancy_map.free_space_slots(origin, point[None,:])
+  per_ray = (time.time() - t)/len(subset)
+  report("per-ray loop (extrapolated)", [per_ray*np.sum(free_rays)])
+
+
+def bench_pixel_rays(frames):
+  """
+  Unit rays of pixels from the cached ray table (Helper.pixelRays,
+  depthPoints) against pixelPoint (the point pixel_to_dirn wraps) and a
+  norm per pixel, at full size
+  and 2x2 DECIMATION
+  """
+  helper = depth_helper()
+  rng = np.random.RandomState(0)
+  for decimation in (1, 2):
+    helper.applyParameters({'DECIMATION': decimation})
+    depth = helper.decimate(synthetic_depth())
+    t = time.time()
+    helper.rayTable()
+    report("ray table %dx%d" % depth.shape, [time.time() - t])
+    rows = rng.randint(0, depth.shape[0], 1000)
+    cols = rng.randint(0, depth.shape[1], 1000)
+
+    loops, lookups, clouds = [], [], []
+    for _ in range(frames):
+      t = time.time()
+      looped = []
+      for h, w in zip(rows, cols):
+        dirn = helper.pixelPoint(h, w)
+        looped.append(dirn/np.linalg.norm(dirn))
+      loops.append(time.time() - t)
+      t = time.time()
+      rays = helper.pixelRays(rows, cols)
+      lookups.append(time.time() - t)
+      t = time.time()
+      helper.depthPoints(depth)
+      clouds.append(time.time() - t)
+    report("1000 pixels, pixelPoint + norm", loops)
+    report("1000 pixels, pixelRays", lookups)
+    report("depthPoints of the frame", clouds)
+    # Chord length, arccos of a dot product this close to 1 is all rounding
+    error = np.degrees(np.linalg.norm(rays - np.array(looped), axis=1))
+    print("  rays off pixelPoint by max %.2g deg" % error.max())
+  helper.applyParameters({'DECIMATION': 1})
+
+
+def depth_helper(helper_class=None):
+  '''
+  Helper (or a subclass) with its parameters set up outside a node,
+  hovering at 2.5 m
+  '''
+  if helper_class is None:
+    from helper2 import Helper as helper_class
+  helper = helper_class()
+  helper.curr_position = [0., 0., 2.5]
+  helper.curr_orientation = (0., 0., 0.)
+  helper.defineParameters()
+  return helper
+
+
+def bench_profile(frames):
+  '''
+  Target selection from the full penalized image against the clearance
+  profile, and the reduction to the profile alone
+  '''
+  helper = depth_helper()
+  depth = synthetic_depth().astype(float)
+  times = []
+  for _ in range(frames):
+    t = time.time()
+    helper.preprocessDepth(depth)
+    times.append(time.time() - t)
+  report("penalty pipeline", times)
+
+  times, reductions = [], []
+  for _ in range(frames):
+    t = time.time()
+    profile, target = helper.preprocessProfile(depth)
+    times.append(time.time() - t)
+    t = time.time()
+    helper.clearanceProfile()
+    helper.profileTarget(profile)
+    reductions.append(time.time() - t)
+  report("profile pipeline", times)
+  report("  profile + heading only", reductions)
+  print("  profile: %d x %s (%d bytes), target column %d, clearance %.2f m"
+        % (profile.size, profile.dtype, profile.nbytes, target[1], profile[target[1]]))
+
+
+def world_frames(count):
+  '''
+  (depth, position) of about count frames rendered turning on the spot at
+  the spawn of every interiit21 world
+  '''
+  from depth_renderer import DepthRenderer
+  poses = []
+  for path in WORLDS:
+    world = WorldModel(path)
+    renderer = DepthRenderer(world)
+    for yaw in np.linspace(-np.pi, np.pi, max(2, count//len(WORLDS)), endpoint=False):
+      position = np.array([world.spawn[0], world.spawn[1], 2.5])
+      poses.append((renderer.render(position, (0., 0., world.spawn[3] + yaw)).astype(float), position))
+  return poses
+
+
+def bench_decimation(frames):
+  """
+  Penalty and profile pipelines on frames rendered in every interiit21
+  world with the depth frame min-pooled by DECIMATION: cost, and how far
+  the target direction and the danger flag move from full resolution
+  """
+  poses = world_frames(frames//5)
+
+  def angle(a, b):
+    return np.degrees(np.arccos(np.clip(a.dot(b)/np.linalg.norm(a)/np.linalg.norm(b), -1., 1.)))
+
+  helper = depth_helper()
+  for pipeline in ('penalty', 'profile'):
+    reference = None
+    for decimation in (1, 2, 4):
+      helper.applyParameters({'DECIMATION': decimation})
+      times, directions, dangers = [], [], []
+      for depth, position in poses:
+        helper.curr_position = position
+        t = time.time()
+        if pipeline == 'penalty':
+          penalized, target = helper.preprocessDepth(depth)
+          danger = helper.detectDanger(penalized)
+        else:
+          profile, target = helper.preprocessProfile(depth)
+          danger = helper.detectDangerProfile(profile)
+        times.append(time.time() - t)
+        directions.append(helper.pixelPoint(*target))
+        dangers.append(danger)
+      report("%s pipeline, %dx%d min-pool" % (pipeline, decimation, decimation), times)
+      if reference is None:
+        reference = directions, dangers
+        continue
+      deviation = [angle(a, b) for a, b in zip(directions, reference[0])]
+      print("  target direction off full size by median %.1f, max %.1f deg; "
+            "danger flag differs on %d/%d frames"
+            % (np.median(deviation), np.max(deviation),
+               sum(a != b for a, b in zip(dangers, reference[1])), len(poses)))
+    helper.applyParameters({'DECIMATION': 1})
+
+
+def bench_edge(frames):
+  """
+  The EDGE_PENALTY implementations of the edge penalty on world frames:
+  cost of the pass alone, largest difference from the fftconvolve
+  reference and frames whose danger flag or target changes
+  """
+  import edge_penalty
+  poses = world_frames(frames)
+  helper = depth_helper()
+  modes = ['fft', 'spectral'] + (['numba'] if edge_penalty.numba is not None else [])
+  reference = None
+  for mode in modes:
+    helper.applyParameters({'EDGE_PENALTY': mode})
+    times, images, decisions = [], [], []
+    for depth, position in poses:
+      helper.curr_position = position
+      penalized, target = helper.preprocessDepth(depth)
+      decisions.append((helper.detectDanger(penalized), helper.pixelPoint(*target)))
+      cleaned = depth/helper.POINTCLOUD_CUTOFF
+      cleaned[np.isnan(cleaned)] = 1.0
+      cleaned = helper.filterSkyGround(cleaned)
+      t = time.time()
+      images.append(helper.penalizeEdges(cleaned))
+      times.append(time.time() - t)
+    report("edge penalty, %s" % mode, times)
+    if reference is None:
+      reference = images, decisions
+      continue
+    for image, expected in zip(images, reference[0]):
+      assert np.allclose(image, expected), "%s edge penalty differs from fft" % mode
+    deviation = [np.degrees(np.arccos(np.clip(a[1].dot(b[1])/np.linalg.norm(a[1])/np.linalg.norm(b[1]),
+                                              -1., 1.)))
+                 for a, b in zip(decisions, reference[1])]
+    print("  max difference %.1e; danger flag differs on %d/%d frames, target direction "
+          "by median %.1f, max %.1f deg (ties in findTarget's maximum)"
+          % (max(np.abs(a - b).max() for a, b in zip(images, reference[0])),
+             sum(a[0] != b[0] for a, b in zip(decisions, reference[1])), len(poses),
+             np.median(deviation), np.max(deviation)))
+  if edge_penalty.numba is None:
+    print("  numba not installed: EDGE_PENALTY numba runs spectral")
+  helper.applyParameters({'EDGE_PENALTY': 'fft'})
+
+
+def bench_tiled(frames):
+  """
+  Edge penalty on PENALTY_WORKERS threads (row/column stripes) against
+  the serial pass of each EDGE_PENALTY implementation, on world frames
+  """
+  import multiprocessing
+  import edge_penalty
+  poses = world_frames(frames)
+  helper = depth_helper()
+  cleaned = []
+  for depth, position in poses:
+    helper.curr_position = position
+    frame = depth/helper.POINTCLOUD_CUTOFF
+    frame[np.isnan(frame)] = 1.0
+    frame = helper.filterSkyGround(frame)
+    cleaned.append((frame, helper.cleaned_with_sky_ground))
+  print("%d cores" % multiprocessing.cpu_count())
+  modes = ['fft', 'spectral'] + (['numba'] if edge_penalty.numba is not None else [])
+  for mode in modes:
+    serial, reference = None, []
+    for workers in sorted(set([1, 2, 3, 4, multiprocessing.cpu_count()])):
+      helper.applyParameters({'EDGE_PENALTY': mode, 'PENALTY_WORKERS': workers})
+      helper.cleaned_with_sky_ground = cleaned[0][1]
+      helper.penalizeEdges(cleaned[0][0]) # Pool start, kernels and compilation
+      times = []
+      for i, (frame, sky_ground) in enumerate(cleaned):
+        helper.cleaned_with_sky_ground = sky_ground
+        t = time.time()
+        penalized = helper.penalizeEdges(frame)
+        times.append(time.time() - t)
+        if workers == 1:
+          reference.append(penalized)
+        else:
+          assert np.array_equal(penalized, reference[i]), \
+              "%s edge penalty on %d workers differs from serial" % (mode, workers)
+      report("edge penalty, %s, %d workers" % (mode, workers), times)
+      if serial is None:
+        serial = np.mean(times)
+      else:
+        print("  speedup %.2fx, identical to the serial result" % (serial/np.mean(times)))
+  helper.applyParameters({'EDGE_PENALTY': 'fft', 'PENALTY_WORKERS': 1})
+
+
+def bench_proximity(frames):
+  """
+  dilateImage over structuring element sizes, and the penalty pipeline
+  of each PROXIMITY backend on world frames: danger flag and target
+  against the edge penalty, and the target's quality as its depth and
+  targetClearance
+  """
+  helper = depth_helper()
+  depth = synthetic_depth().astype(float)/helper.POINTCLOUD_CUTOFF
+  depth[np.isnan(depth)] = 1.0
+  for size in ((5, 15), (25, 75), (50, 150), (100, 300)):
+    helper.applyParameters({'DILATION_KERNEL': size})
+    times = []
+    for _ in range(frames):
+      t = time.time()
+      helper.dilateImage(depth)
+      times.append(time.time() - t)
+    report("dilateImage %dx%d" % size, times)
+  helper.applyParameters({'DILATION_KERNEL': helper.parameter_store.parameters['DILATION_KERNEL'].default})
+
+  poses = world_frames(frames)
+  reference = None
+  for proximity in ('edges', 'dilation', 'clearance'):
+    helper.applyParameters({'PROXIMITY': proximity})
+    times, decisions, depths, clearances = [], [], [], []
+    for depth, position in poses:
+      helper.curr_position = position
+      t = time.time()
+      penalized, target = helper.preprocessDepth(depth)
+      times.append(time.time() - t)
+      decisions.append((helper.detectDanger(penalized), helper.pixelPoint(*target)))
+      target_depth = depth[tuple(target)]
+      depths.append(helper.POINTCLOUD_CUTOFF if np.isnan(target_depth) else target_depth)
+      clearances.append(helper.targetClearance(target))
+    report("penalty pipeline, %s" % proximity, times)
+    print("  target depth median %.1f m, clearance around it median %.2f m, min %.2f m"
+          % (np.median(depths), np.median(clearances), np.min(clearances)))
+    if reference is None:
+      reference = decisions
+      continue
+    deviation = [np.degrees(np.arccos(np.clip(a[1].dot(b[1])/np.linalg.norm(a[1])/np.linalg.norm(b[1]),
+                                              -1., 1.)))
+                 for a, b in zip(decisions, reference)]
+    print("  danger flag differs on %d/%d frames, target direction off edges by median "
+          "%.1f, max %.1f deg" % (sum(a[0] != b[0] for a, b in zip(decisions, reference)),
+                                  len(poses), np.median(deviation), np.max(deviation)))
+  helper.applyParameters({'PROXIMITY': 'edges'})
+
+
+def bench_windows(frames):
+  """
+  Occupancy of a drone-sized window around a grid of candidate targets
+  on world frames: one vectorized windowOccupancy call (integral images)
+  against a slice sum per window, and detectDanger with the target check
+  """
+  poses = world_frames(frames)
+  helper = depth_helper()
+  helper.applyParameters({'BODY_SIZE': 1.})
+  dangers, tables, queries, slices, flagged, windows = [], [], [], [], 0, 0
+  for depth, position in poses:
+    helper.curr_position = position
+    penalized, target = helper.preprocessDepth(depth)
+    t = time.time()
+    flagged += helper.detectDanger(penalized, target)
+    dangers.append(time.time() - t)
+
+    mask, near = helper.sky_ground_mask, helper.near_mask
+    rows, cols = np.meshgrid(np.arange(0, mask.shape[0], 8), np.arange(0, mask.shape[1], 8))
+    rows, cols = rows.ravel(), cols.ravel()
+    helper.window_tables = None
+    t = time.time()
+    helper.windowOccupancy(target[0], target[1])
+    tables.append(time.time() - t)
+    t = time.time()
+    occupancy = helper.windowOccupancy(rows, cols)
+    queries.append(time.time() - t)
+    half = int(round(helper.frameFocalLength()*helper.BODY_SIZE/helper.DANGER_DISTANCE/2))
+    t = time.time()
+    looped = [near[max(r-half, 0):r+half+1, max(c-half, 0):c+half+1].sum()
+              /max(mask[max(r-half, 0):r+half+1, max(c-half, 0):c+half+1].sum(), 1.)
+              for r, c in zip(rows, cols)]
+    slices.append(time.time() - t)
+    windows = occupancy.size
+    assert np.allclose(occupancy, looped)
+  report("detectDanger with target", dangers)
+  print("  %d/%d frames in danger with BODY_SIZE %.1f m" % (flagged, len(poses), helper.BODY_SIZE))
+  report("integral images + 1 window", tables)
+  report("%d windows, vectorized" % windows, queries)
+  report("%d windows, slice sums" % windows, slices)
+  helper.applyParameters({'BODY_SIZE': 0.})
+
+
+def bench_render(frames):
+  """
+  Synthetic depth frames from random poses in every interiit21 world:
+  brute-force WorldModel.render_depth against DepthRenderer at full
+  resolution and one ray per 2x2 and 4x4 block, with the largest depth
+  difference to the brute force at the same stride
+  """
+  from depth_renderer import DepthRenderer
+  frames = max(5, frames//10)
+  brute, fast = [], dict((stride, []) for stride in (1, 2, 4))
+  error = 0.
+  for path in WORLDS:
+    world = WorldModel(path)
+    renderers = dict((stride, DepthRenderer(world, stride=stride)) for stride in fast)
+    rng = np.random.RandomState(0)
+    lower, upper = world.bounds(margin=0.)
+    for _ in range(frames):
+      position = rng.uniform(lower, upper)
+      position[2] = rng.uniform(1., 4.)
+      orientation = (0., rng.uniform(-0.1, 0.1), rng.uniform(-np.pi, np.pi))
+      t = time.time()
+      reference = world.render_depth(position, orientation, stride=4)
+      brute.append(time.time() - t)
+      for stride, renderer in renderers.items():
+        t = time.time()
+        depth = renderer.render(position, orientation)
+        fast[stride].append(time.time() - t)
+      same = np.isnan(reference) == np.isnan(depth)
+      error = max(error, np.nanmax(np.abs(reference - depth)) if same.all() else np.inf)
+  report("brute force (4x4 rays)", brute)
+  for stride in sorted(fast):
+    report("DepthRenderer (%dx%d rays)" % (stride, stride), fast[stride])
+  print("  largest difference at 4x4: %.4f m" % error)
+
+
+def bench_engines(frames):
+  """
+  penalty (calculatePenalty/findTarget), profile and vfh target selection
+  flown closed loop from the spawn point of every interiit21 world with
+  kinematic_sim (survey on danger, no waypoint planner): per-frame cost
+  and the fraction of flights without a collision
+  """
+  from kinematic_sim import KinematicFlight
+  steps = max(10, frames//2)
+  for engine in ('penalty', 'profile', 'vfh'):
+    times, successes, flown = [], 0, []
+    for path in WORLDS:
+      world = WorldModel(path)
+      flight = KinematicFlight(world, engine, use_planner=False)
+      outcome = flight.run(max_steps=steps)
+      times += flight.engine_times
+      successes += outcome != 'collided'
+      flown.append(flight.flown)
+      approach = np.hypot(*(flight.position[:2] - world.marker[:2]))
+      print("  %-8s %-24s %-8s after %5.1f m, %d surveys, %5.1f m from marker"
+            % (engine, os.path.basename(path), outcome, flight.flown, flight.surveys, approach))
+    report("%s engine" % engine, times)
+    print("  collision-free flights: %d/%d, mean distance %.1f m"
+          % (successes, len(WORLDS), np.mean(flown)))
+
+
+def world_planning_problem(path, resolution):
+  '''
+  Blocked cells (inflated by one cell) of a world file and the
+  start/goal cells: spawn point at 2.5 m to 1.5 m above the marker
+  '''
+  world = WorldModel(path)
+  grid, lower = world.occupancy_grid(resolution)
+  grid = scipy.ndimage.binary_dilation(grid, structure=np.ones((3, 3, 3), dtype=bool))
+  offset = np.round(lower/resolution).astype(int)
+  blocked = set(map(tuple, (np.argwhere(grid) + offset).tolist()))
+  to_cell = lambda p: tuple(int(c) for c in np.floor(np.asarray(p)/resolution))
+  start = to_cell([world.spawn[0], world.spawn[1], 2.5])
+  goal = to_cell([world.marker[0], world.marker[1], 1.5])
+  blocked -= set([start, goal])
+  return blocked, start, goal
+
+
+def bench_planner(frames):
+  '''
+  D* Lite on the interiit21 world layouts (0.4 m cells, 5 m ceiling):
+  a from-scratch plan with the full map known, then a flight along the
+  plan where obstacles are only revealed within SENSING_RANGE, comparing
+  incremental repair against replanning from scratch at every step.
+  '''
+  resolution = 0.4
+  SENSING_RANGE = 6./resolution
+  z_low, z_high = int(np.ceil(0.5/resolution)), int(5./resolution) - 1
+  for path in WORLDS:
+    name = os.path.basename(path)
+    blocked, start, goal = world_planning_problem(path, resolution)
+
+    dstar = DStarLite(z_low, z_high, max_expansions=10**6)
+    dstar.blocked = set(blocked)
+    t = time.time()
+    dstar.reset(start, goal)
+    dstar.compute_shortest_path()
+    full_path = dstar.path(max_length=10**4)
+    print("%-24s full map: %7.1f ms, %6d expansions, path %5.1f m"
+          % (name, 1e3*(time.time()-t), dstar.expansions,
+             resolution*sum(dstar.heuristic(a, b) for a, b in zip(full_path, full_path[1:]))))
+
+    blocked_array = np.array(sorted(blocked))
+    incremental = DStarLite(z_low, z_high, max_expansions=10**6)
+    incremental.reset(start, goal)
+    position, known = start, set()
+    repair_times, scratch_times = [], []
+    while position != goal and len(repair_times) < 10*frames:
+      near = np.sum((blocked_array - position)**2, axis=1) < SENSING_RANGE**2
+      seen = set(map(tuple, blocked_array[near].tolist())) - known
+      known |= seen
+
+      t = time.time()
+      if position != incremental.start:
+        incremental.move_start(position)
+      incremental.update_cells(seen, ())
+      incremental.compute_shortest_path()
+      repair_times.append(time.time() - t)
+
+      scratch = DStarLite(z_low, z_high, max_expansions=10**6)
+      scratch.blocked = set(known)
+      t = time.time()
+      scratch.reset(position, goal)
+      scratch.compute_shortest_path()
+      scratch_times.append(time.time() - t)
+
+      assert np.isclose(incremental.g.get(position, np.inf), scratch.g.get(position, np.inf))
+      step = incremental.path(max_length=3)
+      if len(step) < 2:
+        break
+      position = step[1]
+    report("  incremental repair", repair_times)
+    report("  replan from scratch", scratch_times)
+    print("  reached goal: %s after %d steps" % (position == goal, len(repair_times)))
+
+  # Freed cells: a wall planned around, then a doorway opening in it one
+  # cell at a time (as the map window scrolls or misses clear voxels)
+  wall = set((5, y, z) for y in range(-30, 31) for z in range(z_low, z_high + 1))
+  start, goal = (0, 0, 5), (10, 0, 5)
+  incremental = DStarLite(z_low, z_high, max_expansions=10**6)
+  incremental.blocked = set(wall)
+  incremental.reset(start, goal)
+  incremental.compute_shortest_path()
+  detour = incremental.g[start]
+  repair_times, scratch_times = [], []
+  for y, z in itertools.product((0, 1, -1), (5, 4, 6)):
+    wall.discard((5, y, z))
+    t = time.time()
+    incremental.update_cells((), [(5, y, z)])
+    incremental.compute_shortest_path()
+    repair_times.append(time.time() - t)
+
+    scratch = DStarLite(z_low, z_high, max_expansions=10**6)
+    scratch.blocked = set(wall)
+    t = time.time()
+    scratch.reset(start, goal)
+    scratch.compute_shortest_path()
+    scratch_times.append(time.time() - t)
+    assert np.isclose(incremental.g[start], scratch.g[start])
+  print("doorway opened in a wall: path %.1f cells, %.1f around the wall"
+        % (incremental.g[start], detour))
+  report("  incremental repair", repair_times)
+  report("  replan from scratch", scratch_times)
+
+
+BENCHMARKS = {
+  'planner': bench_planner,
+  'occupancy': bench_occupancy,
+  'rays': bench_rays,
+  'pixel_rays': bench_pixel_rays,
+  'profile': bench_profile,
+  'decimation': bench_decimation,
+  'edge': bench_edge,
+  'tiled': bench_tiled,
+  'proximity': bench_proximity,
+  'windows': bench_windows,
+  'render': bench_render,
+  'engines': bench_engines,
+}
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description="Offline stage benchmarks")
+  parser.add_argument('names', nargs='*', default=sorted(BENCHMARKS),
+                      help="any of: %s" % ", ".join(sorted(BENCHMARKS)))
+  parser.add_argument('--frames', type=int, default=100)
+  args = parser.parse_args()
+  for name in args.names:
+    BENCHMARKS[name](args.frames)
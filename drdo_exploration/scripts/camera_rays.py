@@ -0,0 +1,52 @@
+#!/usr/bin/env python
+
+# task: per-pixel unit rays of the depth camera, shared by the pipeline,
+# the explorer and the occupancy map
+from __future__ import print_function
+from __future__ import division
+
+import numpy as np
+
+
+# base_link -> depth_cam_link; the camera axes are the body axes (x
+# forward, y left, z up)
+CAMERA_OFFSET = np.array([0.1, 0., 0.])
+
+
+def ray_table(frame_shape, image_shape, focal_length, frame_scale=1.):
+  '''
+  (height, width, 3) float32 unit vectors, camera frame, through the
+  centre of every pixel of a frame_shape frame decimated by 1/frame_scale
+  (see Helper.decimate) from an image_shape camera with focal_length in
+  pixels of the image. Same rays as Helper.pixelPoint: the principal
+  point is at (height//2, width//2) of the image.
+  '''
+  height, width = image_shape
+  # Pixel centres of the frame in image pixels
+  rows = (np.arange(frame_shape[0]) + 0.5)/frame_scale - 0.5 - height//2
+  cols = (np.arange(frame_shape[1]) + 0.5)/frame_scale - 0.5 - width//2
+  table = np.empty((frame_shape[0], frame_shape[1], 3), dtype=np.float32)
+  table[:,:,0] = focal_length
+  table[:,:,1] = -cols
+  table[:,:,2] = -rows[:,None]
+  table /= np.sqrt(np.einsum('ijk,ijk->ij', table, table))[:,:,None]
+  return table
+
+
+def depth_scale(rays):
+  '''
+  Metres along each ray per metre of depth (depth images hold the
+  distance along the optical axis)
+  '''
+  return 1./rays[...,0].astype(float)
+
+
+def depth_points(rays, depth, body=False):
+  '''
+  Points (..., 3) of a depth image, or of depths at the pixels rays were
+  looked up at, in the camera frame or (body) the base_link frame
+  '''
+  points = rays*(depth*depth_scale(rays))[...,None]
+  if body:
+    points += CAMERA_OFFSET
+  return points
@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+
+# task: run explorer, survey, scanner and navigator in a single process
+from __future__ import print_function
+from __future__ import division
+
+import rospy
+from sensor_msgs.msg import Image
+
+from message_bus import MessageBus, LocalSubscriber
+from explorer import Exploration
+from survey import Survey
+from scanner import ArucoScanner
+from move_to_targ import moveCopter
+from depth_preprocessor import DepthPreprocessor
+
+
+# Topics published by a component hosted here; they are exchanged in memory
+LOCAL_TOPICS = [
+  '/target_vector',
+  '/planner/waypoint',
+  '/safesearch/start',
+  '/safesearch/complete',
+  '/aruco_detect',
+  '/depth/target',
+]
+
+
+class SharedDepthFrame:
+  '''
+  Single subscription to the depth image. Each frame is decoded once and
+  the read-only array is handed to every consumer, each on its own
+  thread with a one-frame queue so a slow consumer only drops its own
+  frames.
+  '''
+
+  def __init__(self, decoder, consumers):
+    self.decoder = decoder
+    self.consumers = [LocalSubscriber(self.wrap(consume), queue_size=1)
+                      for consume in consumers]
+    rospy.Subscriber('/depth_camera/depth/image_raw', Image, self.imageCallback,
+                     queue_size=1, buff_size=2**24)
+
+  @staticmethod
+  def wrap(consume):
+    def deliver(frame_and_stamp):
+      consume(*frame_and_stamp)
+    return deliver
+
+  def imageCallback(self, img_msg):
+    frame = self.decoder.decodeDepth(img_msg)
+    if frame is None:
+      return
+    frame.setflags(write=False)
+    for consumer in self.consumers:
+      consumer.deliver((frame, img_msg.header.stamp))
+
+
+if __name__ == '__main__':
+  try:
+    rospy.init_node('composed_node')
+    bus = MessageBus(LOCAL_TOPICS)
+    navigator = moveCopter(bus)
+    # The penalty chain runs once in the preprocessor; the explorer only
+    # maps the frame and acts on /depth/target like the survey does
+    preprocessor = DepthPreprocessor(bus, subscribe_depth=False,
+        penalty_decimation=rospy.get_param('~penalty_decimation', 0),
+        planner_mode=rospy.get_param('~planner_mode', 'penalty'))
+    exploration = Exploration(bus, subscribe_depth=False, shared_preprocessing=True,
+                              planner_mode=rospy.get_param('~planner_mode', 'penalty'))
+    survey = Survey(bus, subscribe_depth=False, shared_preprocessing=True,
+                    strategy=rospy.get_param('~survey_strategy', 'anytime'))
+    scanner = ArucoScanner(bus)
+    depth_frames = SharedDepthFrame(preprocessor, [preprocessor.processDepth,
+                                                   exploration.processDepth])
+    rospy.spin()
+  except rospy.ROSInterruptException:
+    rospy.loginfo("node terminated.")
@@ -0,0 +1,126 @@
+#!/usr/bin/env python
+
+# task: typed tunables of the depth pipeline (defaults, YAML, parameter server)
+from __future__ import print_function
+from __future__ import division
+
+import collections
+
+
+Parameter = collections.namedtuple('Parameter', 'name type default description')
+
+# Helper attributes that can be set without a code edit. type is the
+# element type for lists and the choices for a tuple of strings; an
+# 'optional' default of None is allowed.
+PARAMETERS = [
+  # Camera (overridden by camera_info)
+  Parameter('IMAGE_HEIGHT', int, 480, "depth image rows"),
+  Parameter('IMAGE_WIDTH', int, 640, "depth image columns"),
+  Parameter('FOCAL_LENGTH', float, 554.25, "pixels"),
+  Parameter('POINTCLOUD_CUTOFF', float, 10., "m, depth range and image plane distance"),
+  # Pixel sizes below are at IMAGE_WIDTH and scaled to the frame processed
+  Parameter('DECIMATION', int, 1, "min-pool the depth frame by this factor (1 = full size)"),
+
+  # Edge penalty kernels (Butterworth decay 1 - 1/(1 + (cutoff/x)^(2 rate)))
+  Parameter('VERTICAL_KERNEL_SIZE', int, 350, "pixels, left/right edge kernel"),
+  Parameter('VERTICAL_DECAY_RATE', float, 35., "order of the left/right decay"),
+  Parameter('VERTICAL_DECAY_CUTOFF', float, 120., "pixels, left/right decay cutoff"),
+  Parameter('HORIZONTAL_KERNEL_SIZE', int, 100, "pixels, top/bottom edge kernel"),
+  Parameter('HORIZONTAL_DECAY_RATE', float, 35., "order of the top/bottom decay"),
+  Parameter('HORIZONTAL_DECAY_CUTOFF', float, 10., "pixels, top/bottom decay cutoff"),
+  Parameter('EDGE_THRESHOLD', float, 0.1, "normalised depth step that is an edge"),
+  Parameter('K_vertical', float, 0.5, "weight of the left/right edge penalty"),
+  Parameter('K_horizontal', float, 1., "weight of the top/bottom edge penalty"),
+  Parameter('EDGE_PENALTY', ('fft', 'spectral', 'numba'), 'fft',
+            "fft (reference), spectral (fused FFT passes) or numba (fused loops, "
+            "spectral if numba is missing)"),
+  Parameter('PENALTY_WORKERS', int, 1, "threads of the edge penalty (row/column stripes), 1 = serial"),
+
+  # Sky/ground band
+  Parameter('LOWER_LIMIT', float, 0.1, "m, lowest height kept in the band"),
+  Parameter('UPPER_LIMIT', float, 4.5, "m, highest height kept in the band"),
+
+  # Penalty references and factors
+  Parameter('Z_REF', float, 2.5, "m, preferred flight height"),
+  Parameter('TARGET_DIST', float, 0.4, "0-1, preferred normalised depth"),
+  Parameter('K_HORZ_MOVE', float, 0., "weight of the horizontal veering penalty"),
+  Parameter('K_VERT_MOVE', float, 0., "weight of the vertical veering penalty"),
+  Parameter('K_ALT', float, 0., "weight of the altitude penalty"),
+  Parameter('K_DIST', float, 0., "weight of the distance penalty"),
+
+  # Danger and clearance
+  Parameter('PROXIMITY', ('edges', 'dilation', 'clearance'), 'edges',
+            "obstacle proximity penalty: edges (edge kernels, see EDGE_PENALTY), dilation "
+            "(nearest depth within DILATION_KERNEL) or clearance (distance to pixels closer "
+            "than DANGER_DISTANCE)"),
+  Parameter('DANGER_DISTANCE', float, 2.5, "m"),
+  Parameter('THRESHOLD_FRACTION', float, 0.8, "fraction of the band closer than DANGER_DISTANCE"),
+  Parameter('BODY_SIZE', float, 0.,
+            "m, window around the target that has to be clear at DANGER_DISTANCE (0 = don't check)"),
+  Parameter('DILATION_KERNEL', [int], [50, 150], "pixels (rows, cols) of dilateImage"),
+  Parameter('CLEARANCE_WINDOW', int, 30, "pixels, half size of the target clearance window"),
+  Parameter('CLEARANCE_RADIUS', int, 100,
+            "pixels from the nearest near obstacle at which PROXIMITY clearance stops penalising"),
+
+  # Survey altitude prediction
+  Parameter('VIRTUAL_ALTITUDES', [float], [4., 1.], "m, survey fallback heights"),
+  Parameter('VIRTUAL_BAND_HEIGHT', float, 1., "m, band that has to be free at a height"),
+
+  # Clearance profile planner
+  Parameter('PROFILE_PERCENTILE', float, None, "None = per-column minimum, else this percentile"),
+  Parameter('PROFILE_WINDOW', int, 61, "columns around the heading that have to be clear"),
+]
+
+
+class ParameterStore:
+  '''
+  Current values of PARAMETERS. Values from YAML or the parameter server
+  are converted to the declared type; unknown names and values that
+  don't convert raise ValueError.
+  '''
+
+  def __init__(self, parameters=PARAMETERS):
+    self.parameters = collections.OrderedDict((p.name, p) for p in parameters)
+    self.values = dict((p.name, p.default) for p in parameters)
+
+
+  def convert(self, name, value):
+    if name not in self.parameters:
+      raise ValueError("unknown depth parameter %s" % name)
+    parameter = self.parameters[name]
+    if value is None and parameter.default is None:
+      return None
+    try:
+      if isinstance(parameter.type, list):
+        return [parameter.type[0](v) for v in value]
+      if isinstance(parameter.type, tuple):
+        if value not in parameter.type:
+          raise ValueError
+        return str(value)
+      if parameter.type is int and float(value) != int(float(value)):
+        raise ValueError
+      return parameter.type(value)
+    except (TypeError, ValueError):
+      raise ValueError("depth parameter %s: %r is not %s" % (name, value, parameter.type))
+
+
+  def update(self, values):
+    '''
+    Set several parameters at once (all or none of them); returns
+    {name: value} of those that changed
+    '''
+    converted = dict((name, self.convert(name, value)) for name, value in values.items())
+    changed = dict((name, value) for name, value in converted.items()
+                   if value != self.values[name])
+    self.values.update(changed)
+    return changed
+
+
+def load_yaml(path):
+  '''
+  {name: value} of a parameter file such as config/depth_params.yaml,
+  for Helper.applyParameters
+  '''
+  import yaml
+  with open(path) as yaml_file:
+    return yaml.safe_load(yaml_file) or {}
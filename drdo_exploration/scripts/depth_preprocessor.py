@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+
+# task: run the depth penalty chain once per frame for every consumer
+from __future__ import print_function
+from __future__ import division
+
+import numpy as np
+
+import rospy
+from sensor_msgs.msg import Image
+from nav_msgs.msg import Odometry
+from std_msgs.msg import Int16
+
+from drdo_exploration.msg import depth_target
+
+from helper2 import Helper
+from pose_buffer import PoseBuffer
+from latency_tracer import make_tracer
+
+
+class DepthPreprocessor(Helper):
+  '''
+  Computes what the explorer and the survey (shared_preprocessing mode)
+  need from each depth frame once and publishes it on /depth/target.
+  The penalty chain only runs when one of them uses it: the explorer in
+  planner_mode penalty, or the survey while it is running (the explorer
+  holds /safesearch/start at 1 until /safesearch/complete). Otherwise
+  only the clearance profile of the profile/vfh explorer is computed.
+  '''
+
+  def __init__(self, bus=rospy, subscribe_depth=True, penalty_decimation=0,
+               planner_mode='penalty'):
+    '''
+    bus: transport providing Publisher/Subscriber (rospy or a MessageBus)
+    subscribe_depth: False when decoded frames are fed to processDepth
+    by the composed runner instead
+    penalty_decimation: also publish the penalized image subsampled by
+    this factor (0 = don't)
+    planner_mode: the explorer's planner_mode
+    '''
+    self.curr_position = np.zeros(3)
+    self.curr_orientation = np.zeros(3)
+    self.pose_buffer = PoseBuffer()
+    self.penalty_decimation = penalty_decimation
+    self.planner_mode = planner_mode
+    self.survey_active = False
+
+    self.target_pub = bus.Publisher('/depth/target', depth_target, queue_size=1)
+    self.defineParameters()
+    self.watchParameters(bus)
+    self.tracer = make_tracer('depth_preprocessor')
+
+    if subscribe_depth:
+      bus.Subscriber('/depth_camera/depth/image_raw', Image, self.ImageCallback, queue_size=1)
+    bus.Subscriber('/mavros/global_position/local', Odometry, self.positionCallback, queue_size=1)
+    bus.Subscriber('/safesearch/start', Int16, self.surveyCallback, queue_size=1)
+
+  def ImageCallback(self, img_msg):
+    cv_image_array = self.decodeDepth(img_msg)
+    if cv_image_array is None:
+      return
+    self.processDepth(cv_image_array, img_msg.header.stamp)
+
+  def surveyCallback(self, msg):
+    self.survey_active = msg.data == 1
+
+  def processDepth(self, cv_image_array, stamp):
+    penalty_chain = self.planner_mode == 'penalty' or self.survey_active
+    with self.tracer.timed('preprocess'):
+      if penalty_chain:
+        penalized_cv_img, target = self.preprocessDepth(cv_image_array, stamp)
+      else:
+        profile, target = self.preprocessProfile(cv_image_array, stamp)
+
+    target_msg = depth_target()
+    target_msg.header.stamp = stamp
+    target_msg.target_row = target[0]
+    target_msg.target_col = target[1]
+    if self.planner_mode == 'penalty':
+      target_msg.danger = bool(self.detectDanger(penalized_cv_img, target))
+      target_msg.clearance = self.targetClearance(target)
+    else:
+      if penalty_chain:
+        profile = self.clearanceProfile()
+      target_msg.danger = bool(self.detectDangerProfile(profile))
+      target_msg.clearance = profile[target[1]]
+      target_msg.clearance_profile = profile.tolist()
+    if not penalty_chain:
+      target_msg.intensity = np.nan
+      self.target_pub.publish(target_msg)
+      self.tracer.age('target_published', stamp)
+      return
+
+    target_msg.intensity = penalized_cv_img[target[0], target[1]]
+    if self.survey_active:
+      target_msg.virtual_altitudes = self.VIRTUAL_ALTITUDES
+      target_msg.virtual_intensity = [self.virtualAltitudeIntensity(penalized_cv_img, altitude)
+                                      for altitude in self.VIRTUAL_ALTITUDES]
+    if self.penalty_decimation > 0:
+      penalty = penalized_cv_img[::self.penalty_decimation, ::self.penalty_decimation]
+      target_msg.penalty_rows, target_msg.penalty_cols = penalty.shape
+      target_msg.penalty = penalty.astype(np.float32).ravel().tolist()
+    self.target_pub.publish(target_msg)
+    self.tracer.age('target_published', stamp)
+
+
+if __name__ == '__main__':
+  try:
+    rospy.init_node('depth_preprocessor')
+    preprocessor = DepthPreprocessor(
+        penalty_decimation=rospy.get_param('~penalty_decimation', 0),
+        planner_mode=rospy.get_param('~planner_mode', 'penalty'))
+    rospy.spin()
+  except rospy.ROSInterruptException:
+    rospy.loginfo("node terminated.")
@@ -0,0 +1,201 @@
+#!/usr/bin/env python
+
+# task: fast synthetic depth frames of a parsed world file (no ROS needed)
+from __future__ import print_function
+from __future__ import division
+
+import numpy as np
+
+from occupancy_map import euler_to_rotation
+
+
+class DepthRenderer:
+  '''
+  Depth camera (32FC1, metres along the optical axis, NaN beyond the
+  cutoff) over the boxes and cylinders of a WorldModel, for many frames
+  of the same world.
+
+  The rays of every pixel are built once. Per frame only the obstacles
+  within reach of the camera are looked up in a uniform grid of
+  CELL_SIZE columns over the world; each one is projected to the pixel
+  rectangle its bounding box covers and ray cast there only, nearest
+  first, skipping those that are entirely behind what is already drawn
+  in their rectangle. WorldModel.render_depth is the brute-force
+  reference every ray of which is tested against every obstacle.
+  '''
+
+  def __init__(self, world, shape=(480, 640), stride=1, focal_length=554.25,
+               cutoff=10., camera_offset=(0.1, 0., 0.), cell_size=2.):
+    '''
+    stride: cast one ray per stride x stride pixel block and repeat it
+    '''
+    self.world = world
+    self.shape = shape
+    self.stride = stride
+    self.FOCAL_LENGTH = focal_length
+    self.CUTOFF = cutoff
+    self.CAMERA_OFFSET = np.asarray(camera_offset, dtype=float)
+    self.CELL_SIZE = cell_size
+
+    height, width = shape
+    self.rows = np.arange(stride//2, height, stride)
+    self.cols = np.arange(stride//2, width, stride)
+    cols, rows = np.meshgrid(self.cols, self.rows)
+    # Camera frame rays (1, ray_y, ray_z) with unit x, so the ray
+    # parameter is the depth
+    self.ray_y = (-(cols - width//2)/focal_length).astype(np.float32)
+    self.ray_z = (-(rows - height//2)/focal_length).astype(np.float32)
+    # A hit at Euclidean distance r has depth >= r/MAX_RAY_NORM
+    self.MAX_RAY_NORM = float(np.sqrt(1. + self.ray_y**2 + self.ray_z**2).max())
+
+    # Primitives: (kind, 3x3 rotation, centre, parameters)
+    self.primitives = ([('box', pose[:3,:3], pose[:3,3], half) for pose, half in world.boxes]
+                       + [('cylinder', pose[:3,:3], pose[:3,3], (radius, half_length))
+                          for pose, radius, half_length in world.cylinders])
+    self.corners = []
+    for kind, rotation, centre, parameters in self.primitives:
+      half = parameters if kind == 'box' else np.array([parameters[0], parameters[0], parameters[1]])
+      signs = np.array([[x, y, z] for x in (-1, 1) for y in (-1, 1) for z in (-1, 1)])
+      self.corners.append((signs*half).dot(rotation.T) + centre)
+    self.lower = np.array([c.min(axis=0) for c in self.corners]).reshape(-1, 3)
+    self.upper = np.array([c.max(axis=0) for c in self.corners]).reshape(-1, 3)
+
+    self.grid = {}
+    for index in range(len(self.primitives)):
+      low = np.floor(self.lower[index,:2]/cell_size).astype(int)
+      high = np.floor(self.upper[index,:2]/cell_size).astype(int)
+      for i in range(low[0], high[0] + 1):
+        for j in range(low[1], high[1] + 1):
+          self.grid.setdefault((i, j), []).append(index)
+
+
+  def nearby(self, origin):
+    '''
+    Indices of the primitives that can be within the cutoff of origin,
+    with their distances, nearest first
+    '''
+    reach = self.CUTOFF*self.MAX_RAY_NORM
+    low = np.floor((origin[:2] - reach)/self.CELL_SIZE).astype(int)
+    high = np.floor((origin[:2] + reach)/self.CELL_SIZE).astype(int)
+    indices = set()
+    for i in range(low[0], high[0] + 1):
+      for j in range(low[1], high[1] + 1):
+        indices.update(self.grid.get((i, j), ()))
+    if not indices:
+      return np.zeros(0, dtype=int), np.zeros(0)
+    indices = np.array(sorted(indices))
+    gap = np.maximum(0., np.maximum(self.lower[indices] - origin, origin - self.upper[indices]))
+    distance = np.linalg.norm(gap, axis=1)
+    order = np.argsort(distance)
+    near = distance[order] <= reach
+    return indices[order][near], distance[order][near]
+
+
+  def footprint(self, corners, rotation, origin):
+    '''
+    Ray index slices (rows, cols) of the pixels a primitive's bounding
+    box covers, or None if it is behind the camera or off screen
+    '''
+    camera = (corners - origin).dot(rotation)
+    if np.all(camera[:,0] <= 0):
+      return None
+    height, width = self.shape
+    if np.any(camera[:,0] <= 1e-3):
+      # Straddles the image plane: the projection is unbounded
+      return slice(None), slice(None)
+    col = width//2 - self.FOCAL_LENGTH*camera[:,1]/camera[:,0]
+    row = height//2 - self.FOCAL_LENGTH*camera[:,2]/camera[:,0]
+    first_row = np.searchsorted(self.rows, row.min() - 1)
+    last_row = np.searchsorted(self.rows, row.max() + 1, side='right')
+    first_col = np.searchsorted(self.cols, col.min() - 1)
+    last_col = np.searchsorted(self.cols, col.max() + 1, side='right')
+    if first_row >= last_row or first_col >= last_col:
+      return None
+    return slice(first_row, last_row), slice(first_col, last_col)
+
+
+  @staticmethod
+  def intersect_box(origin, rays, half):
+    '''
+    Depth of the first hit of each ray with a centred box, inf for a
+    miss. origin and half are in the box frame and rays is the tuple of
+    its x, y and z component arrays in that frame.
+    '''
+    # Starting the entry at 0 clips hits behind the origin (and gives 0
+    # from inside the box)
+    near, far = 0., np.inf
+    for axis in range(3):
+      t1 = (-half[axis] - origin[axis])/rays[axis]
+      t2 = (half[axis] - origin[axis])/rays[axis]
+      # fmax/fmin skip the NaN of a ray lying in a face plane
+      near = np.fmax(near, np.minimum(t1, t2))
+      far = np.fmin(far, np.maximum(t1, t2))
+    return np.where(near <= far, near, np.inf)
+
+
+  @staticmethod
+  def intersect_cylinder(origin, rays, radius, half_length):
+    '''
+    Depth of the first hit of each ray with a centred cylinder along z,
+    inf for a miss (arguments as intersect_box)
+    '''
+    dx, dy, dz = rays
+    a = dx**2 + dy**2
+    b = 2*(origin[0]*dx + origin[1]*dy)
+    c = origin[0]**2 + origin[1]**2 - radius**2
+    root = np.sqrt(b**2 - 4*a*c)
+    near = np.where(a > 0, (-b - root)/(2*a), -np.inf if c <= 0 else np.inf)
+    far = np.where(a > 0, (-b + root)/(2*a), np.inf if c <= 0 else -np.inf)
+    tz1, tz2 = (-half_length - origin[2])/dz, (half_length - origin[2])/dz
+    near = np.fmax(near, np.minimum(tz1, tz2))
+    far = np.fmin(far, np.maximum(tz1, tz2))
+    # fmax/fmin also skip the NaN of rays that miss the infinite cylinder
+    hit = (near <= far) & (far > 0) & ~np.isnan(root)
+    return np.where(hit, np.maximum(near, 0.), np.inf)
+
+
+  def local_rays(self, window, transform):
+    '''
+    x, y, z components of the camera rays in window rotated by transform
+    (camera to local frame); the camera x component is 1
+    '''
+    y, z = self.ray_y[window], self.ray_z[window]
+    return tuple(transform[i,0] + transform[i,1]*y + transform[i,2]*z for i in range(3))
+
+
+  def render(self, position, orientation):
+    '''
+    float32 depth image of shape self.shape from a base_link pose
+    '''
+    rotation = euler_to_rotation(*orientation)
+    origin = np.asarray(position, dtype=float) + rotation.dot(self.CAMERA_OFFSET)
+
+    with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+      # Ground plane
+      world_z = rotation[2].astype(np.float32)
+      ray_z = world_z[0] + world_z[1]*self.ray_y + world_z[2]*self.ray_z
+      depth = np.where(ray_z < 0, np.float32(-origin[2])/ray_z, np.float32(np.inf))
+
+      indices, distances = self.nearby(origin)
+      for index, distance in zip(indices, distances):
+        window = self.footprint(self.corners[index], rotation, origin)
+        if window is None:
+          continue
+        drawn = depth[window]
+        # Hidden behind what is already drawn there
+        if drawn.max() < distance/self.MAX_RAY_NORM:
+          continue
+        kind, local_rotation, centre, parameters = self.primitives[index]
+        rays = self.local_rays(window, local_rotation.T.dot(rotation).astype(np.float32))
+        local_origin = (origin - centre).dot(local_rotation).astype(np.float32)
+        if kind == 'box':
+          hit = self.intersect_box(local_origin, rays, parameters.astype(np.float32))
+        else:
+          hit = self.intersect_cylinder(local_origin, rays, *np.float32(parameters))
+        depth[window] = np.minimum(drawn, hit)
+
+    depth[~(depth <= self.CUTOFF)] = np.nan
+    if self.stride > 1:
+      height, width = self.shape
+      depth = np.repeat(np.repeat(depth, self.stride, axis=0), self.stride, axis=1)[:height, :width]
+    return depth
@@ -0,0 +1,205 @@
+#!/usr/bin/env python
+
+# task: fused edge mask + penalty passes of penalizeObstacleProximityCorrected
+from __future__ import print_function
+from __future__ import division
+
+import numpy as np
+from scipy import fftpack, signal
+
+try:
+  import numba
+except ImportError:
+  numba = None
+
+
+'''
+Helper.penalizeObstacleProximityCorrected builds four edge masks (depth
+steps above EDGE_THRESHOLD between neighbouring pixels, one per
+direction), fftconvolves each with its one-sided decay kernel in 'same'
+mode and subtracts the results from the frame: the left/right ones from
+the columns on either side of the step, the top/bottom ones, taken on the
+frame before NaN filling of the sky/ground band, from the rows. The
+border rows and columns are zeroed after each pair.
+
+The functions here give the same image (to rounding) with fewer
+full-frame temporaries:
+
+- edge_penalty_spectral (NumPy): one difference array per axis, both of
+  its masks transformed with a 1-D real FFT along that axis only, the
+  two products with the cached kernel spectra summed (the one-pixel
+  offset of the second mask folded into its kernel) and transformed back
+  once
+- edge_penalty_numba (needs numba): one pass over each axis that
+  computes the steps on the fly and subtracts the kernel at every edge
+  pixel, so the cost scales with the number of edges instead of the
+  frame size
+
+Each pass only mixes pixels along its axis, so the left/right pass of any
+implementation can run on row stripes and the top/bottom pass on column
+stripes independently, without halos (the *_pass functions, see
+Helper.penalizeEdgesTiled).
+'''
+
+
+def kernel_spectra(kernel, other, length):
+  '''
+  rfft of the two kernels of an axis (1-D) padded to length, the second
+  delayed by one pixel
+  '''
+  first = np.concatenate((kernel, [0.]))
+  second = np.concatenate(([0.], other))
+  return np.fft.rfft(first, length), np.fft.rfft(second, length)
+
+
+def spectral_length(size, kernel_size):
+  return fftpack.next_fast_len(size + kernel_size)
+
+
+def axis_penalty(frame, spectra, length, kernel_size, threshold, axis):
+  '''
+  Sum of the penalties of both masks of an axis, frame shaped (its two
+  border lines are garbage and get zeroed by the caller)
+  '''
+  step = np.diff(frame, axis=axis)
+  shape = [1, 1]
+  shape[axis] = -1
+  first, second = (s.reshape(shape) for s in spectra)
+  transformed = (np.fft.rfft(step > threshold, length, axis=axis)*first
+                 + np.fft.rfft(step < -threshold, length, axis=axis)*second)
+  full = np.fft.irfft(transformed, length, axis=axis)
+  start = (kernel_size - 1)//2
+  return np.take(full, np.arange(start, start + frame.shape[axis]), axis=axis)
+
+
+def edge_penalty_spectral(cleaned, sky_ground, vertical, horizontal, threshold):
+  '''
+  vertical, horizontal: (spectra, length, kernel_size, weight) of the
+  left/right and the top/bottom pass
+  '''
+  spectra, length, kernel_size, weight = vertical
+  penalized = cleaned - weight*axis_penalty(cleaned, spectra, length, kernel_size, threshold, 1)
+  penalized[:,0] = 0
+  penalized[:,-1] = 0
+  spectra, length, kernel_size, weight = horizontal
+  penalized -= weight*axis_penalty(sky_ground, spectra, length, kernel_size, threshold, 0)
+  penalized[0,:] = 0
+  penalized[-1,:] = 0
+  return penalized
+
+
+def stripes(size, count):
+  '''
+  count slices covering range(size) in near equal parts
+  '''
+  bounds = np.linspace(0, size, count + 1).round().astype(int)
+  return [slice(start, stop) for start, stop in zip(bounds[:-1], bounds[1:]) if stop > start]
+
+
+def fft_pass(frame, out, kernel, other, weight, threshold, axis):
+  '''
+  The reference (penalizeObstacleProximityCorrected) pass along axis of
+  frame subtracted from out, without the border reset. fftconvolve only
+  transforms along the kernel's axis, so a stripe of lines gives the same
+  values as the whole frame.
+  '''
+  shape = (1, -1) if axis == 1 else (-1, 1)
+  kernel, other = kernel.reshape(shape), other.reshape(shape)
+  if axis == 1:
+    first = (frame[:,1:] - frame[:,0:-1] > threshold).astype(float)
+    second = (frame[:,0:-1] - frame[:,1:] > threshold).astype(float)
+    out[:,0:-1] = out[:,0:-1] - weight*signal.fftconvolve(first, kernel, mode='same')
+    out[:,1:] = out[:,1:] - weight*signal.fftconvolve(second, other, mode='same')
+  else:
+    first = (frame[1:,:] - frame[0:-1,:] > threshold).astype(float)
+    second = (frame[0:-1,:] - frame[1:,:] > threshold).astype(float)
+    out[0:-1,:] = out[0:-1,:] - weight*signal.fftconvolve(first, kernel, mode='same')
+    out[1:,:] = out[1:,:] - weight*signal.fftconvolve(second, other, mode='same')
+
+
+def spectral_pass(frame, out, spectra, length, kernel_size, weight, threshold, axis):
+  out -= weight*axis_penalty(frame, spectra, length, kernel_size, threshold, axis)
+
+
+def support(kernel):
+  nonzero = np.flatnonzero(kernel)
+  return (nonzero[0], nonzero[-1] + 1) if nonzero.size else (0, 0)
+
+
+def scatter_columns(frame, out, kernel, other, weight, threshold):
+  '''
+  Left/right pass: out -= weight*kernel around every rising step along a
+  row (on the columns left of the step's far pixel) and weight*other
+  around every falling one (shifted one column right)
+  '''
+  rows, cols = frame.shape
+  n = cols - 1
+  centre = (kernel.shape[0] - 1)//2
+  first_lo, first_hi = support(kernel)
+  second_lo, second_hi = support(other)
+  for r in range(rows):
+    for m in range(n):
+      step = frame[r, m+1] - frame[r, m]
+      if step > threshold:
+        for t in range(max(first_lo, centre - m), min(first_hi, n + centre - m)):
+          out[r, m + t - centre] -= weight*kernel[t]
+      elif -step > threshold:
+        for t in range(max(second_lo, centre - m), min(second_hi, n + centre - m)):
+          out[r, m + t - centre + 1] -= weight*other[t]
+
+
+def scatter_rows(frame, out, kernel, other, weight, threshold):
+  '''
+  Top/bottom pass, as scatter_columns along the columns (row-major loops)
+  '''
+  rows, cols = frame.shape
+  n = rows - 1
+  centre = (kernel.shape[0] - 1)//2
+  first_lo, first_hi = support(kernel)
+  second_lo, second_hi = support(other)
+  for m in range(n):
+    for c in range(cols):
+      step = frame[m+1, c] - frame[m, c]
+      if step > threshold:
+        for t in range(max(first_lo, centre - m), min(first_hi, n + centre - m)):
+          out[m + t - centre, c] -= weight*kernel[t]
+      elif -step > threshold:
+        for t in range(max(second_lo, centre - m), min(second_hi, n + centre - m)):
+          out[m + t - centre + 1, c] -= weight*other[t]
+
+
+def fused_passes(cleaned, sky_ground, right, left, bottom, top, k_vertical, k_horizontal,
+                 threshold):
+  penalized = cleaned.copy()
+  scatter_columns(cleaned, penalized, right, left, k_vertical, threshold)
+  penalized[:,0] = 0
+  penalized[:,-1] = 0
+  scatter_rows(sky_ground, penalized, bottom, top, k_horizontal, threshold)
+  penalized[0,:] = 0
+  penalized[-1,:] = 0
+  return penalized
+
+
+if numba is not None:
+  # nogil so that stripes run in parallel on threads
+  support = numba.njit(cache=True, nogil=True)(support)
+  scatter_columns = numba.njit(cache=True, nogil=True)(scatter_columns)
+  scatter_rows = numba.njit(cache=True, nogil=True)(scatter_rows)
+  fused_passes = numba.njit(cache=True, nogil=True)(fused_passes)
+
+
+def numba_pass(frame, out, kernel, other, weight, threshold, axis):
+  scatter = scatter_columns if axis == 1 else scatter_rows
+  scatter(frame, out, kernel, other, float(weight), float(threshold))
+
+
+def edge_penalty_numba(cleaned, sky_ground, right, left, bottom, top, k_vertical, k_horizontal,
+                       threshold):
+  '''
+  Kernels as 1-D float arrays. Runs as (slow) Python without numba, for
+  checking the loops.
+  '''
+  return fused_passes(np.ascontiguousarray(cleaned, dtype=float),
+                      np.ascontiguousarray(sky_ground, dtype=float),
+                      right, left, bottom, top, float(k_vertical), float(k_horizontal),
+                      float(threshold))
@@ -21,77 +21,104 @@ from cv_bridge import CvBridge, CvBridgeError
 
 from drdo_exploration.msg import direction
 from drdo_exploration.msg import teleopData
-
-from helper2 import Helper
-
-
-class Exploration(Helper):
-  def __init__(self):
+from drdo_exploration.msg import depth_target
+
+from vfh import VFHHelper
+from pose_buffer import PoseBuffer
+from occupancy_map import OccupancyMap, euler_to_rotation
+from planner import WaypointPlanner
+from latency_tracer import make_tracer
+
+
+class Exploration(VFHHelper):
+  def __init__(self, bus=rospy, subscribe_depth=True, shared_preprocessing=False,
+               planner_mode='penalty'):
+    '''
+    bus: transport providing Publisher/Subscriber (rospy or a MessageBus)
+    subscribe_depth: False when decoded frames are fed to processDepth
+    by the composed runner instead
+    shared_preprocessing: take target/danger from depth_preprocessor on
+    /depth/target and only use the depth frames for mapping
+    planner_mode: 'penalty' picks the target from the penalized image,
+    'profile' from the per-column clearance profile (much cheaper),
+    'vfh' from a polar histogram of the profile and the occupancy map
+    '''
+    self.shared_preprocessing = shared_preprocessing
+    self.planner_mode = planner_mode
 
 
     self.curr_position = np.zeros(3)
     self.curr_orientation = np.zeros(3)
+    self.pose_buffer = PoseBuffer()
     self.IN_DANGER = [0,0]
     # self.listener = tf.TransformListener()
 
-    pose_topic = '/mavros/global_position/local'
-    pc2_img_topic = '/depth_camera/depth/image_raw'
-    safesearch_stop_topic = '/safesearch/complete'
-    rospy.Subscriber(pc2_img_topic, Image, self.pc2ImageCallback, queue_size=1)
-    rospy.Subscriber(pose_topic, Odometry, self.positionCallback,queue_size=1)
-    rospy.Subscriber(safesearch_stop_topic, Int16, self.stopSearchCallback,queue_size=1)
-    
+    self.defineParameters()
+    self.watchParameters(bus)
+    self.occupancy_map = OccupancyMap(rays=self.imageRays)
+    self.planner = WaypointPlanner(self.occupancy_map)
+    self.tracer = make_tracer('explorer')
+
     dirn_topic = '/target_vector'
     safesearch_start_topic = '/safesearch/start'
-    self.dirn_pub = rospy.Publisher(dirn_topic, direction, queue_size=1)
-    self.safesearch_pub = rospy.Publisher(safesearch_start_topic, Int16, queue_size=1)
-    self.stop_pub = rospy.Publisher('/drone/teleop', teleopData, queue_size=1)
+    self.dirn_pub = bus.Publisher(dirn_topic, direction, queue_size=1)
+    self.safesearch_pub = bus.Publisher(safesearch_start_topic, Int16, queue_size=1)
+    self.stop_pub = bus.Publisher('/drone/teleop', teleopData, queue_size=1)
+    self.waypoint_pub = bus.Publisher('/planner/waypoint', PointStamped, queue_size=1)
 
-    self.defineParameters()
+    pose_topic = '/mavros/global_position/local'
+    pc2_img_topic = '/depth_camera/depth/image_raw'
+    safesearch_stop_topic = '/safesearch/complete'
+    if subscribe_depth:
+      bus.Subscriber(pc2_img_topic, Image, self.pc2ImageCallback, queue_size=1)
+    bus.Subscriber(pose_topic, Odometry, self.positionCallback,queue_size=1)
+    bus.Subscriber(safesearch_stop_topic, Int16, self.stopSearchCallback,queue_size=1)
+    if shared_preprocessing:
+      bus.Subscriber('/depth/target', depth_target, self.targetCallback, queue_size=1)
 
   def stopSearchCallback(self, msg):
     self.IN_DANGER[1] = not bool(msg.data)
 
-  def positionCallback(self, local_pose_msg):
-    self.curr_position = [local_pose_msg.pose.pose.position.x,
-                          local_pose_msg.pose.pose.position.y,
-                          local_pose_msg.pose.pose.position.z]
-    quaternion = [local_pose_msg.pose.pose.orientation.x,
-                   local_pose_msg.pose.pose.orientation.y,
-                   local_pose_msg.pose.pose.orientation.z,
-                   local_pose_msg.pose.pose.orientation.w]
-
-    self.curr_orientation = tf.transformations.euler_from_quaternion(quaternion)
-
-
   def pc2ImageCallback(self, pc2_img_msg):
     # t = rospy.get_time()
     # rospy.loginfo("START of pc-cb %s"% t)
-    bridge = CvBridge()
-    pc2_img_msg.encoding = "32FC1"
-    try:
-      cv_img = bridge.imgmsg_to_cv2(pc2_img_msg, pc2_img_msg.encoding)
-    except CvBridgeError as e:
-      print(e)
+    cv_image_array = self.decodeDepth(pc2_img_msg)
+    if cv_image_array is None:
+      return
+    self.processDepth(cv_image_array, pc2_img_msg.header.stamp)
+
+  def processDepth(self, cv_image_array, stamp):
+    '''
+    Everything downstream of the decoded depth frame (metres, NaN = no return).
+    The frame is shared with other components and must not be modified.
+    '''
+    self.tracer.age('frame_received', stamp)
+    with self.tracer.timed('map_update'):
+      self.occupancy_map.update(cv_image_array, *self.framePose(stamp))
+    if self.shared_preprocessing:
+      return
+
+    if self.planner_mode == 'profile':
+      with self.tracer.timed('preprocess'):
+        profile, target = self.preprocessProfile(cv_image_array, stamp)
+      self.actOnTarget(target, self.detectDangerProfile(profile),
+                       profile[target[1]], stamp)
+      return
+    if self.planner_mode == 'vfh':
+      with self.tracer.timed('preprocess'):
+        histogram, target = self.preprocessVFH(cv_image_array, stamp, self.occupancy_map)
+      self.actOnTarget(target, int(self.vfh_sector is None),
+                       self.vfhClearance(histogram), stamp)
       return
-    
-    cv_image_array = np.array(cv_img, dtype = np.dtype('f8'))
-    cleaned_cv_img = cv_image_array/self.POINTCLOUD_CUTOFF
-  
-    cleaned_cv_img[np.isnan(cleaned_cv_img)] = 1.0
-    # cv2.imshow("Cleaned Image", cleaned_cv_img)
-    cleaned_cv_img = self.filterSkyGround(cleaned_cv_img)
-    # cleaned_cv_img = ret[0]
-    # sky_ground_mask = ret[1]
 
     # rospy.loginfo("Before calculate pen %s"% t)
-    penalized_cv_img = self.calculatePenalty(cleaned_cv_img)
+    with self.tracer.timed('preprocess'):
+      penalized_cv_img, target = self.preprocessDepth(cv_image_array, stamp)
     # rospy.loginfo("Post calculate pen %s"% t)
     #image_operation to apply colllision avoidance with drone
     # collision_cv_img = self.collision_avoidance(cleaned_cv_img)
 
-    target, _ = self.findTarget(penalized_cv_img, cleaned_cv_img)
-    danger_flag = self.detectDanger(penalized_cv_img)
+    danger_flag = self.detectDanger(penalized_cv_img, target)
     # danger_flag = self.detectDanger(penalized_cv_img, cleaned_cv_img)
     # rospy.loginfo("Pose target")
     # cv2.circle(cleaned_cv_img, (target[1],target[0]), 20, 0, -1)
@@ -105,6 +132,38 @@ class Exploration(Helper):
    
     cv2.waitKey(1)
 
+    self.actOnTarget(target, danger_flag, self.targetClearance(target), stamp)
+
+  def targetCallback(self, target_msg):
+    '''
+    Compact per-frame result computed once by depth_preprocessor
+    '''
+    self.tracer.age('target_received', target_msg.header.stamp)
+    if self.planner_mode in ('profile', 'vfh') and target_msg.clearance_profile:
+      profile = np.array(target_msg.clearance_profile, dtype=np.float32)
+      self.frame_scale = profile.size/float(self.IMAGE_WIDTH)
+      self.frame_position, self.frame_orientation = self.framePose(target_msg.header.stamp)
+      # referenceRow needs the sky/ground band of this frame
+      self.filterSkyGround(np.ones(self.frameShape()))
+      if self.planner_mode == 'vfh':
+        histogram, target = self.vfhTarget(profile, self.occupancy_map)
+        self.actOnTarget(target, int(self.vfh_sector is None),
+                         self.vfhClearance(histogram), target_msg.header.stamp)
+        return
+      target = self.profileTarget(profile)
+      self.actOnTarget(target, self.detectDangerProfile(profile), profile[target[1]],
+                       target_msg.header.stamp)
+      return
+    target = np.array([target_msg.target_row, target_msg.target_col])
+    if target_msg.penalty_rows > 0:
+      penalty = np.array(target_msg.penalty, dtype=np.float32).reshape(
+          target_msg.penalty_rows, target_msg.penalty_cols)
+      cv2.imshow("Penalized image", penalty)
+      cv2.waitKey(1)
+    self.actOnTarget(target, target_msg.danger, target_msg.clearance,
+                     target_msg.header.stamp)
+
+  def actOnTarget(self, target, danger_flag, clearance, stamp):
     safesearch_msg = Int16()
     if self.IN_DANGER[1] or danger_flag:
       # Don't publish direction message. Pass control to safesearch
@@ -115,20 +174,23 @@ class Exploration(Helper):
       safesearch_msg.data = 0
     self.safesearch_pub.publish(safesearch_msg)
 
-    ps = self.pixel_to_dirn(target[0],target[1])
-    dirn = np.array([ps.point.x, ps.point.y, ps.point.z])
-    dirn = 1.*dirn/np.linalg.norm(dirn)
+    dirn = self.pixelRays(target[0],target[1])
 
     dirn_msg = direction()
+    dirn_msg.header.stamp = stamp
     dirn_msg.vec_x = dirn[0]
     dirn_msg.vec_y = dirn[1]
     dirn_msg.vec_z = dirn[2]
+    dirn_msg.clearance = clearance
     
     # print("%.2f %.2f %.2f"%(dirn[0], dirn[1], dirn[2]))
     
     if not self.IN_DANGER[1]:
       rospy.loginfo("Going")
       self.dirn_pub.publish(dirn_msg)
+      self.tracer.age('direction_published', stamp)
+      with self.tracer.timed('plan'):
+        self.publishWaypoint(dirn, stamp)
     
     if self.IN_DANGER[0] != self.IN_DANGER[1]:
       rospy.loginfo("Switching")
@@ -145,11 +207,30 @@ class Exploration(Helper):
     self.IN_DANGER[0] = self.IN_DANGER[1]
     # rospy.loginfo("END of pc-cb %s" % t)
 
+  def publishWaypoint(self, dirn, stamp):
+    '''
+    Plan over the occupancy map towards the chosen direction and
+    publish the next waypoint for move_to_targ. dirn is in the camera
+    frame of the image with this stamp, so it is rotated by that pose.
+    '''
+    world_dirn = euler_to_rotation(*self.framePose(stamp)[1]).dot(dirn)
+    waypoint = self.planner.plan_along(self.curr_position, world_dirn)
+    if waypoint is None:
+      return
+    waypoint_msg = PointStamped()
+    waypoint_msg.header.frame_id = "map"
+    waypoint_msg.header.stamp = stamp
+    waypoint_msg.point.x = waypoint[0]
+    waypoint_msg.point.y = waypoint[1]
+    waypoint_msg.point.z = waypoint[2]
+    self.waypoint_pub.publish(waypoint_msg)
+
 
 if __name__ == '__main__':
   try:
     rospy.init_node('explorer_node')
-    exploration = Exploration()    
+    exploration = Exploration(shared_preprocessing=rospy.get_param('~shared_preprocessing', False),
+                              planner_mode=rospy.get_param('~planner_mode', 'penalty'))    
     rospy.spin()
   except rospy.ROSInterruptException:
     rospy.loginfo("node terminated.")
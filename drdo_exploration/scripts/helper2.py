@@ -5,6 +5,7 @@ from __future__ import print_function
 from __future__ import division
 
 import cv2
+import multiprocessing.pool
 import numpy as np
 import random
 import scipy.ndimage
@@ -12,7 +13,7 @@ from numpy.lib.stride_tricks import as_strided
 
 import rospy
 from geometry_msgs.msg import PointStamped, Point
-from sensor_msgs.msg import PointCloud2, Image
+from sensor_msgs.msg import PointCloud2, Image, CameraInfo
 from nav_msgs.msg import Odometry
 import ros_numpy
 import tf
@@ -20,6 +21,12 @@ from cv_bridge import CvBridge, CvBridgeError
 
 from drdo_exploration.msg import direction
 
+from pose_buffer import PoseBuffer
+from depth_params import ParameterStore
+import edge_penalty
+import camera_rays
+from integral_image import IntegralImage
+
 ##
 from scipy import signal
 
@@ -27,6 +34,90 @@ class Helper:
   
 
   def defineParameters(self):
+    # Tunables (see depth_params.PARAMETERS), set as attributes of the
+    # same name and changed with applyParameters
+    self.parameter_store = ParameterStore()
+    self.field_cache = {}
+    for name, value in self.parameter_store.values.items():
+      setattr(self, name, value)
+
+    self.cleaned_with_sky_ground = None
+    self.sky_ground_mask = None
+
+    # Pose of the frame being processed (see framePose)
+    self.frame_position = np.zeros(3)
+    self.frame_orientation = np.zeros(3)
+    # Width of the processed frame over IMAGE_WIDTH (see decimate)
+    self.frame_scale = 1.
+    # (workers, ThreadPool) of penalizeEdgesTiled
+    self.penalty_pool = (1, None)
+
+    # self.PROXIMITY_THRESH = 3.
+
+
+  def applyParameters(self, values):
+    '''
+    Set tunables by name ({name: value}, converted to their declared
+    type); kernels and other fields built from them are rebuilt on their
+    next use. Returns the names that changed.
+    '''
+    changed = self.parameter_store.update(values)
+    for name, value in changed.items():
+      setattr(self, name, value)
+    if 'DECIMATION' in changed or 'IMAGE_WIDTH' in changed:
+      # Until the next frame, for nodes acting on another node's targets
+      self.frame_scale = 1./self.DECIMATION
+    return sorted(changed)
+
+
+  def watchParameters(self, bus=rospy, namespace='/depth_params', period=2.0):
+    '''
+    Apply the tunables under namespace on the parameter server (loaded
+    from config/depth_params.yaml by the launch file) now and whenever
+    they change (polled every period s, e.g. after rosparam set), and
+    the resolution and focal length of the depth camera's camera_info
+    '''
+    self.parameter_namespace = namespace
+    self.reloadParameters()
+    if period > 0:
+      self.parameter_timer = rospy.Timer(rospy.Duration(period), self.reloadParameters)
+    bus.Subscriber('/depth_camera/depth/camera_info', CameraInfo,
+                   self.cameraInfoCallback, queue_size=1)
+
+
+  def reloadParameters(self, event=None):
+    try:
+      changed = self.applyParameters(rospy.get_param(self.parameter_namespace, {}))
+    except ValueError as e:
+      rospy.logwarn("%s: %s" % (self.parameter_namespace, e))
+      return
+    if changed:
+      rospy.loginfo("depth parameters changed: %s" % ", ".join(changed))
+
+
+  def cameraInfoCallback(self, info_msg):
+    self.applyParameters({'IMAGE_HEIGHT': info_msg.height,
+                          'IMAGE_WIDTH': info_msg.width,
+                          'FOCAL_LENGTH': info_msg.K[0]})
+
+
+  def cachedField(self, name, inputs, build):
+    '''
+    build(*inputs), kept until it is asked for with different inputs
+    '''
+    cached = self.field_cache.get(name)
+    if cached is None or cached[0] != inputs:
+      cached = (inputs, build(*inputs))
+      self.field_cache[name] = cached
+    return cached[1]
+
+
+  @staticmethod
+  def decayKernel(kernel_size, decay_rate, decay_cutoff):
+    '''
+    Edge penalty falling off with the distance x (pixels) from the edge,
+    zero on the other side of it
+    '''
     ## 1/n decay
     # decay_sequence = np.ones(KERNEL_SIZE//2, dtype=float)/(1+np.arange(KERNEL_SIZE//2))
 
@@ -45,76 +136,210 @@ class Helper:
     '''
     1-1/(1+(d/x)^2n)
     '''
-
-    ######### VERTICAL ##########
-    KERNEL_SIZE = 350
-    DECAY_RATE = 35
-    DECAY_CUTOFF = 120
-    decay_sequence = 1.0+np.arange(KERNEL_SIZE//2)
-    decay_sequence = DECAY_CUTOFF/decay_sequence
-    decay_sequence = np.power(decay_sequence, 2*DECAY_RATE)
+    decay_sequence = 1.0+np.arange(kernel_size//2)
+    decay_sequence = decay_cutoff/decay_sequence
+    decay_sequence = np.power(decay_sequence, 2*decay_rate)
     decay_sequence = 1/(1+decay_sequence)
     decay_sequence = (1 - decay_sequence)
-    
+    return np.concatenate((np.zeros(kernel_size//2), decay_sequence))
 
-    self.kernel_right = np.concatenate((np.zeros(KERNEL_SIZE//2),
-                      decay_sequence))
-    self.kernel_left = self.kernel_right[::-1]
 
-    ##
-    self.kernel_right = self.kernel_right.reshape(1,self.kernel_right.size)
-    self.kernel_left = self.kernel_left.reshape(1,self.kernel_left.size)
+  def scaledPixels(self, pixels):
+    '''
+    A length in pixels at IMAGE_WIDTH, in pixels of the processed frame
+    '''
+    return max(1, int(round(pixels*self.frame_scale)))
 
 
-    ######## HORIZONTAL ###########
-    KERNEL_SIZE = 100
-    DECAY_RATE = 35
-    DECAY_CUTOFF = 10
-    decay_sequence = 1.0+np.arange(KERNEL_SIZE//2)
-    decay_sequence = DECAY_CUTOFF/decay_sequence
-    decay_sequence = np.power(decay_sequence, 2*DECAY_RATE)
-    decay_sequence = 1/(1+decay_sequence)
-    decay_sequence = 1 - decay_sequence
+  def frameFocalLength(self):
+    return self.FOCAL_LENGTH*self.frame_scale
 
-    self.kernel_bottom = np.concatenate((np.zeros(KERNEL_SIZE//2),
-                      decay_sequence))
-    self.kernel_top = self.kernel_bottom[::-1]
 
-    ##
-    self.kernel_top = self.kernel_top.reshape(self.kernel_top.size,1)
-    self.kernel_bottom = self.kernel_bottom.reshape(self.kernel_bottom.size,1)
+  def decimate(self, cv_image_array):
+    '''
+    DECIMATION x DECIMATION min-pooling of a depth frame, keeping the
+    nearest return of each block (NaN only if the whole block is), and
+    the frame_scale every pixel size and the focal length are scaled by
+    '''
+    factor = self.DECIMATION
+    if factor > 1:
+      height, width = cv_image_array.shape[0]//factor, cv_image_array.shape[1]//factor
+      blocks = cv_image_array[:height*factor, :width*factor]
+      # One strided pass per block offset (fmin.reduce over a reshaped
+      # block axis is far slower)
+      pooled = blocks[::factor, ::factor].copy()
+      for i in range(factor):
+        for j in range(factor):
+          if i or j:
+            np.fmin(pooled, blocks[i::factor, j::factor], out=pooled)
+      cv_image_array = pooled
+    self.frame_scale = cv_image_array.shape[1]/float(self.IMAGE_WIDTH)
+    return cv_image_array
+
+
+  ######### VERTICAL ##########
+  @property
+  def kernel_right(self):
+    return self.cachedField('kernel_right',
+        (self.scaledPixels(self.VERTICAL_KERNEL_SIZE), self.VERTICAL_DECAY_RATE,
+         self.VERTICAL_DECAY_CUTOFF*self.frame_scale),
+        lambda *inputs: self.decayKernel(*inputs).reshape(1, -1))
+
+  @property
+  def kernel_left(self):
+    return self.kernel_right[:,::-1]
+
+
+  ######## HORIZONTAL ###########
+  @property
+  def kernel_bottom(self):
+    return self.cachedField('kernel_bottom',
+        (self.scaledPixels(self.HORIZONTAL_KERNEL_SIZE), self.HORIZONTAL_DECAY_RATE,
+         self.HORIZONTAL_DECAY_CUTOFF*self.frame_scale),
+        lambda *inputs: self.decayKernel(*inputs).reshape(-1, 1))
+
+  @property
+  def kernel_top(self):
+    return self.kernel_bottom[::-1]
+
+
+  def frameShape(self):
+    return (self.scaledPixels(self.IMAGE_HEIGHT), self.scaledPixels(self.IMAGE_WIDTH))
+
+  @property
+  def y_dist_penalty(self):
+    return self.cachedField('y_dist_penalty', self.frameShape(), self.vertical_veering_penalty)
+
+  @property
+  def x_dist_penalty(self):
+    return self.cachedField('x_dist_penalty', self.frameShape(), self.horizontal_veering_penalty)
+
+
+  def decodeDepth(self, img_msg):
+    '''
+    32FC1 depth image message -> float64 array in metres (NaN = no return),
+    None if the message cannot be converted
+    '''
+    bridge = CvBridge()
+    img_msg.encoding = "32FC1"
+    try:
+      cv_img = bridge.imgmsg_to_cv2(img_msg, img_msg.encoding)
+    except CvBridgeError as e:
+      print(e)
+      return None
+    return np.array(cv_img, dtype = np.dtype('f8'))
+
+
+  def positionCallback(self, local_pose_msg):
+    self.curr_position = [local_pose_msg.pose.pose.position.x,
+                          local_pose_msg.pose.pose.position.y,
+                          local_pose_msg.pose.pose.position.z]
+    quaternion = [local_pose_msg.pose.pose.orientation.x,
+                   local_pose_msg.pose.pose.orientation.y,
+                   local_pose_msg.pose.pose.orientation.z,
+                   local_pose_msg.pose.pose.orientation.w]
+
+    self.curr_orientation = tf.transformations.euler_from_quaternion(quaternion)
+    self.pose_buffer.addOdometry(local_pose_msg)
+
+
+  def framePose(self, stamp=None):
+    '''
+    (position, orientation) the frame with this header stamp was taken
+    from, interpolated in the odometry ring; the latest pose when there is
+    no stamp or no odometry yet
+    '''
+    pose = None
+    if stamp is not None and not stamp.is_zero():
+      pose = self.pose_buffer.at(stamp.to_sec())
+    if pose is None:
+      return np.array(self.curr_position, dtype=float), self.curr_orientation
+    return pose
 
 
-    self.cleaned_with_sky_ground = None
-    self.sky_ground_mask = None
-    self.y_dist_penalty = None
-    self.x_dist_penalty = None
-    self.vertical_veering_penalty()
-    self.horizontal_veering_penalty()
+  def preprocessDepth(self, cv_image_array, stamp=None):
+    '''
+    Decimate, normalize, NaN fill, sky/ground filter, penalize and pick
+    the target, using the pose at the frame's stamp
+    (frame_position/frame_orientation).
+    Returns (penalized_cv_img, target) in the decimated frame's pixels;
+    cv_image_array is not modified.
+    '''
+    self.frame_position, self.frame_orientation = self.framePose(stamp)
+    cleaned_cv_img = self.decimate(cv_image_array)/self.POINTCLOUD_CUTOFF
+    cleaned_cv_img[np.isnan(cleaned_cv_img)] = 1.0
+    cleaned_cv_img = self.filterSkyGround(cleaned_cv_img)
+    penalized_cv_img = self.calculatePenalty(cleaned_cv_img)
+    target, _ = self.findTarget(penalized_cv_img, cleaned_cv_img)
+    return penalized_cv_img, target
 
-    self.POINTCLOUD_CUTOFF = 10
 
-    # Penalization tunables
-    self.K_vertical = 0.5
-    self.K_horizontal = 1
+  def preprocessProfile(self, cv_image_array, stamp=None):
+    '''
+    Fast alternative to preprocessDepth: reduce the frame to its
+    clearance profile and pick the target from that.
+    Returns (profile, target); cv_image_array is not modified.
+    '''
+    self.frame_position, self.frame_orientation = self.framePose(stamp)
+    cleaned_cv_img = self.decimate(cv_image_array)/self.POINTCLOUD_CUTOFF
+    cleaned_cv_img[np.isnan(cleaned_cv_img)] = 1.0
+    self.filterSkyGround(cleaned_cv_img)
+    profile = self.clearanceProfile()
+    return profile, self.profileTarget(profile)
 
-    # Penalty references
-    self.Z_REF = 2.5
-    self.TARGET_DIST = 0.4 # 0-1, representing depth
 
-    # Penalty factors
-    self.K_HORZ_MOVE =  0
-    self.K_VERT_MOVE =  0
-    self.K_ALT = 0
-    self.K_DIST = 0
+  def clearanceProfile(self):
+    '''
+    Per-column clearance in metres (float32, one entry per image column):
+    the minimum (or PROFILE_PERCENTILE) depth inside the sky/ground band
+    of the last frame passed to filterSkyGround.
+    Columns are POINTCLOUD_CUTOFF if the band is empty.
+    '''
+    band = self.cleaned_with_sky_ground[self.sky_ground_mask[:,0]]
+    if band.shape[0] == 0:
+      return np.full(self.cleaned_with_sky_ground.shape[1], self.POINTCLOUD_CUTOFF, dtype=np.float32)
+    if self.PROFILE_PERCENTILE is None:
+      profile = band.min(axis=0)
+    else:
+      profile = np.percentile(band, self.PROFILE_PERCENTILE, axis=0)
+    return (self.POINTCLOUD_CUTOFF*profile).astype(np.float32)
 
-    # Danger distance threshold
-    self.DANGER_DISTANCE = 2.5 # In metres
-    self.THRESHOLD_FRACTION = 0.8 # Fraction
 
-    self.DILATION_KERNEL = (50,150)
+  def profileTarget(self, profile):
+    '''
+    Target pixel from a clearance profile: the column whose PROFILE_WINDOW
+    neighbourhood has the largest worst-case clearance (nearest the image
+    centre on ties), on referenceRow()
+    '''
+    width = profile.size
+    window_clearance = scipy.ndimage.minimum_filter1d(profile, self.scaledPixels(self.PROFILE_WINDOW),
+                                                      mode='constant', cval=0.)
+    candidates = np.flatnonzero(window_clearance == window_clearance.max())
+    col = candidates[np.argmin(np.abs(candidates - width//2))]
+    return np.array([self.referenceRow(), col])
 
-    # self.PROXIMITY_THRESH = 3.
+
+  def referenceRow(self):
+    '''
+    Image row of Z_REF at the image plane distance, clipped to the
+    sky/ground band of the last filtered frame
+    '''
+    height = self.sky_ground_mask.shape[0]
+    IMAGE_PLANE_DISTANCE = self.POINTCLOUD_CUTOFF
+
+    row = int(height/2 - (self.Z_REF - self.frame_position[2])*self.frameFocalLength()/IMAGE_PLANE_DISTANCE)
+    band_rows = np.flatnonzero(self.sky_ground_mask[:,0])
+    if band_rows.size:
+      row = min(max(row, band_rows[0]), band_rows[-1])
+    return min(max(row, 0), height-1)
+
+
+  def detectDangerProfile(self, profile):
+    '''
+    detectDanger on a clearance profile: most columns closer than
+    DANGER_DISTANCE
+    '''
+    return int(np.mean(profile < self.DANGER_DISTANCE) > self.THRESHOLD_FRACTION)
 
 
   def filterSkyGround(self, cleaned_cv_img):
@@ -122,13 +347,13 @@ class Helper:
     
     self.cleaned_with_sky_ground = cleaned_cv_img.copy()
 
-    height, width = [480, 640]
+    height, width = cleaned_cv_img.shape
     '''
     I have assumed that the origin is at the top left corner.
     '''
-    FOCAL_LENGTH = 554.25 # From camera_info
-    LOWER_LIMIT = 0.1
-    UPPER_LIMIT= 4.5
+    FOCAL_LENGTH = self.frameFocalLength()
+    LOWER_LIMIT = self.LOWER_LIMIT
+    UPPER_LIMIT = self.UPPER_LIMIT
     IMAGE_PLANE_DISTANCE = self.POINTCLOUD_CUTOFF
     '''
     Half height is the original height in meters when the distance is 10m.
@@ -146,8 +371,8 @@ class Helper:
     2. For lower limit, the range is half_pixels+remaining to image_H_PIXELS.
     The remaining is calculated using the given equation.
     '''
-    sky_limit = int((HALF_PIXELS-(UPPER_LIMIT-self.curr_position[2])*FOCAL_LENGTH/IMAGE_PLANE_DISTANCE))
-    ground_limit = int(HALF_PIXELS+((self.curr_position[2]-LOWER_LIMIT)*FOCAL_LENGTH/IMAGE_PLANE_DISTANCE))
+    sky_limit = int((HALF_PIXELS-(UPPER_LIMIT-self.frame_position[2])*FOCAL_LENGTH/IMAGE_PLANE_DISTANCE))
+    ground_limit = int(HALF_PIXELS+((self.frame_position[2]-LOWER_LIMIT)*FOCAL_LENGTH/IMAGE_PLANE_DISTANCE))
     if sky_limit>=0 and sky_limit<height:
       self.sky_ground_mask[:sky_limit,:] = 0
     if ground_limit>=0 and ground_limit<height:
@@ -162,39 +387,138 @@ class Helper:
     return cleaned_cv_img
 
 
-  def pixel_to_dirn(self, h, w):
-    height, width = [480, 640]
+  def virtualAltitudeIntensity(self, penalized_cv_img, altitude):
+    '''
+    Predicts the target intensity the survey would see from the same
+    pose at another altitude, without flying there.
+    At the image plane distance a height change moves the horizon by
+    (altitude - z)*f/d rows; the sky/ground limits are fixed in the world,
+    so the current mask still applies. A column counts as free only if
+    the whole VIRTUAL_BAND_HEIGHT band around the shifted horizon is.
+    NaN if the band leaves the image or the sky/ground band.
+    '''
+    height = penalized_cv_img.shape[0]
+    IMAGE_PLANE_DISTANCE = self.POINTCLOUD_CUTOFF
+    pixels_per_metre = self.frameFocalLength()/IMAGE_PLANE_DISTANCE
+
+    centre = height/2 - (altitude - self.frame_position[2])*pixels_per_metre
+    half_band = self.VIRTUAL_BAND_HEIGHT/2*pixels_per_metre
+    top, bottom = int(round(centre - half_band)), int(round(centre + half_band))
+    if top < 0 or bottom > height or not np.all(self.sky_ground_mask[top:bottom, 0]):
+      return np.nan
+    return np.max(np.min(penalized_cv_img[top:bottom], axis=0))
+
+
+  def pixelPoint(self, h, w):
+    '''
+    (x, y, z) camera frame point at the image plane distance through
+    pixel (h, w) of the processed frame
+    '''
+    # Back to the centre of the pixel block in the full-size image
+    h, w = (h + 0.5)/self.frame_scale - 0.5, (w + 0.5)/self.frame_scale - 0.5
+    height, width = self.IMAGE_HEIGHT, self.IMAGE_WIDTH
     target_px = np.array([h-height//2, w-width//2])
     
-    FOCAL_LENGTH = 554.25 # From camera_info
+    FOCAL_LENGTH = self.FOCAL_LENGTH
     IMAGE_PLANE_DISTANCE = self.POINTCLOUD_CUTOFF
     xp = (IMAGE_PLANE_DISTANCE/FOCAL_LENGTH)*target_px[1]
     yp = (IMAGE_PLANE_DISTANCE/FOCAL_LENGTH)*target_px[0]
     zp = IMAGE_PLANE_DISTANCE
 
     # print(xp, yp, zp)
+    return np.array([zp, -xp, -yp])
+
+
+  def rayTable(self):
+    '''
+    Unit rays (camera frame) of every pixel of the processed frame, see
+    camera_rays.ray_table; rebuilt when the intrinsics or DECIMATION
+    change
+    '''
+    return self.cachedField('ray_table',
+        (self.frameShape(), (self.IMAGE_HEIGHT, self.IMAGE_WIDTH), self.FOCAL_LENGTH, self.frame_scale),
+        camera_rays.ray_table)
+
+
+  def imageRays(self):
+    '''
+    rayTable of the full-size depth image, for consumers of the raw
+    frames (the OccupancyMap)
+    '''
+    image_shape = (self.IMAGE_HEIGHT, self.IMAGE_WIDTH)
+    return self.cachedField('image_rays', (image_shape, image_shape, self.FOCAL_LENGTH),
+                            camera_rays.ray_table)
+
+
+  def pixelRays(self, rows, cols):
+    '''
+    Unit directions of pixelPoint for pixels (rows, cols) of the processed
+    frame, scalars or arrays; camera and base_link axes are the same
+    '''
+    return self.rayTable()[rows, cols].astype(float)
+
+
+  def depthPoints(self, depth, rows=None, cols=None, body=False):
+    '''
+    Points of a processed depth frame (or of its pixels rows, cols), in
+    the camera or (body) the base_link frame
+    '''
+    rays = self.rayTable()
+    if rows is not None:
+      rays, depth = rays[rows, cols], depth[rows, cols]
+    return camera_rays.depth_points(rays, depth, body)
+
+
+  def pixel_to_dirn(self, h, w):
+    point = self.pixelPoint(h, w)
 
     ps = PointStamped()
     ps.header.frame_id = "depth_cam_link"
     ps.header.stamp = rospy.Time(0)
-    ps.point.x = zp
-    ps.point.y = -xp
-    ps.point.z = -yp
+    ps.point.x = point[0]
+    ps.point.y = point[1]
+    ps.point.z = point[2]
     # mat = self.listener.transformPoint("/map", ps)
     # return mat
     return ps
 
-  def detectDanger(self, penalized_cv_img):
+  def detectDanger(self, penalized_cv_img, target=None):
+    '''
+    Most of the band closer than DANGER_DISTANCE, or (BODY_SIZE > 0) the
+    window the drone needs around the target mostly blocked.
+    Keeps the near pixels for windowOccupancy.
+    '''
     danger_flag = 0
     # danger_left, danger_right = 0, 0
     # threshold_img_left, threshold_img_right = np.ones()
     thresholded_img = np.multiply((penalized_cv_img < 1.*self.DANGER_DISTANCE/self.POINTCLOUD_CUTOFF), self.sky_ground_mask)
+    self.near_mask = thresholded_img
+    self.window_tables = None
 
     if np.sum(thresholded_img) > self.THRESHOLD_FRACTION * np.sum(self.sky_ground_mask):
       danger_flag = 1
       # print("DANGERRRRRRR")
+    elif target is not None and self.BODY_SIZE > 0:
+      if self.windowOccupancy(*target) > self.THRESHOLD_FRACTION:
+        danger_flag = 1
     return danger_flag
 
+
+  def windowOccupancy(self, rows, cols):
+    '''
+    Fraction of the band pixels closer than DANGER_DISTANCE in the window
+    a BODY_SIZE drone covers at DANGER_DISTANCE around each pixel (rows,
+    cols scalars or arrays) for the frame of the last detectDanger
+    '''
+    if self.window_tables is None:
+      # Integral images, built on the first query of a frame; any number of
+      # windows is then four lookups each
+      self.window_tables = (IntegralImage(self.near_mask), IntegralImage(self.sky_ground_mask))
+    near_table, band_table = self.window_tables
+    half = int(round(self.frameFocalLength()*self.BODY_SIZE/self.DANGER_DISTANCE/2))
+    band = band_table.around(rows, cols, half, half)
+    return near_table.around(rows, cols, half, half)/np.maximum(band, 1.)
+
   # def detectDanger(self, penalized_cv_img, cleaned_cv_img):
   #   # cv2.imshow("img", penalized_cv_img)
   #   # cv2.waitKey(3)
@@ -222,6 +546,19 @@ class Helper:
   #     print("DANGERRRRRRR")
   #   return danger_flag
 
+  def targetClearance(self, target):
+    '''
+    Distance (m) to the nearest obstacle inside the sky/ground band
+    in a window around the target pixel
+    '''
+    h, w = target
+    half = self.scaledPixels(self.CLEARANCE_WINDOW)
+    window = np.s_[max(h-half,0):h+half, max(w-half,0):w+half]
+    valid = self.sky_ground_mask[window]
+    if not np.any(valid):
+      return self.POINTCLOUD_CUTOFF
+    return self.POINTCLOUD_CUTOFF*np.min(self.cleaned_with_sky_ground[window][valid])
+
   def findTarget(self, penalized_cv_img, cleaned_cv_img):
     '''
     Find (u,v) pixel coordinates that's the
@@ -255,7 +592,15 @@ class Helper:
   
     # Penalty for distance
     # penalized_cv_img = penalizeObstacleProximity(cleaned_cv_img) # Using edge-extension visor
-    edge_penalized_img = self.penalizeObstacleProximityCorrected(cleaned_cv_img) # Using grayscale dilation
+    if self.PROXIMITY == 'dilation':
+      # Nearest depth within DILATION_KERNEL of every pixel, the sky and
+      # ground not counting as obstacles
+      proximity_img = self.dilateImage(np.where(self.sky_ground_mask, cleaned_cv_img, 1.))
+      proximity_img = proximity_img*self.sky_ground_mask
+    elif self.PROXIMITY == 'clearance':
+      proximity_img = self.clearancePenalty(cleaned_cv_img)
+    else:
+      proximity_img = self.penalizeEdges(cleaned_cv_img) # Using grayscale dilation
     # return dilated_img
     
     # thresh_dilation = self.dilateImage(1.*(dilated_img < 
@@ -268,13 +613,13 @@ class Helper:
 
 
     # # Penalty for being off midlevel in world height
-    z_pen = self.world_z_penalty()
+    z_pen = self.world_z_penalty(cleaned_cv_img.shape)
 
     # # Penalty for deviation from self.TARGET_DIST intensity
     # dist_pen = self.distance_penalty(dilated_img)
 
     # # Apply all
-    penalized_cv_img = (edge_penalized_img 
+    penalized_cv_img = (proximity_img 
                         # - self.K_VERT_MOVE * self.y_dist_penalty 
                         # - self.K_HORZ_MOVE * self.x_dist_penalty
                         - self.K_ALT * z_pen
@@ -290,45 +635,127 @@ class Helper:
     return np.abs(edge_penalized_img - self.TARGET_DIST)/self.TARGET_DIST
 
   
-  def vertical_veering_penalty(self):
+  def vertical_veering_penalty(self, height, width):
     #---------------------------------------------------------#
     ## Penalize distance from vertical centerline
 
-    self.y_dist_penalty = np.arange(480) - 479/2.
-    self.y_dist_penalty = np.abs(self.y_dist_penalty)
-    self.y_dist_penalty = np.matlib.repmat(self.y_dist_penalty,640,1).T
+    y_dist_penalty = np.arange(height) - (height-1)/2.
+    y_dist_penalty = np.abs(y_dist_penalty)
+    y_dist_penalty = np.tile(y_dist_penalty, (width, 1)).T
 
-    self.y_dist_penalty = self.y_dist_penalty/(np.max(self.y_dist_penalty))
-    # cv2.imshow("Vertical Veering Penalty", self.y_dist_penalty.astype(float))
+    # cv2.imshow("Vertical Veering Penalty", y_dist_penalty.astype(float))
+    return y_dist_penalty/(np.max(y_dist_penalty))
   
 
-  def horizontal_veering_penalty(self):
+  def horizontal_veering_penalty(self, height, width):
     #---------------------------------------------------------#
     ## Penalize distance from horizontal centerline
 
-    self.x_dist_penalty = np.arange(640) - 639/2.
-    self.x_dist_penalty = np.abs(self.x_dist_penalty)
-    self.x_dist_penalty = np.matlib.repmat(self.x_dist_penalty, 480, 1)
+    x_dist_penalty = np.arange(width) - (width-1)/2.
+    x_dist_penalty = np.abs(x_dist_penalty)
+    x_dist_penalty = np.tile(x_dist_penalty, (height, 1))
 
-    self.x_dist_penalty = self.x_dist_penalty/(np.max(self.x_dist_penalty))
-    # cv2.imshow("Horizontal Veering Penalty", self.x_dist_penalty.astype(float))
+    # cv2.imshow("Horizontal Veering Penalty", x_dist_penalty.astype(float))
+    return x_dist_penalty/(np.max(x_dist_penalty))
 
   
-  def world_z_penalty(self):
+  def world_z_penalty(self, shape=None):
   #---------------------------------------------------------#
   ## Penalize deviation of z-coordinate from self.Z_REF    
 
-    err = (self.curr_position[2]-self.Z_REF)/self.Z_REF
-    z_penalty = np.arange(480)*np.abs(err)/480
+    err = (self.frame_position[2]-self.Z_REF)/self.Z_REF
+    height, width = shape if shape is not None else self.frameShape()
+    z_penalty = np.arange(height)*np.abs(err)/height
     if err>0:
       z_penalty = z_penalty[::-1]
 
-    z_penalty = np.matlib.repmat(z_penalty,640,1).T
+    z_penalty = np.tile(z_penalty, (width, 1)).T
 
     # cv2.imshow("Global Altitude Deviation Penalty", z_penalty.astype(float))
     return z_penalty
   
   
+  def penalizeEdges(self, cleaned_cv_img):
+    '''
+    penalizeObstacleProximityCorrected by the EDGE_PENALTY implementation
+    (see edge_penalty)
+    '''
+    if self.PENALTY_WORKERS > 1:
+      return self.penalizeEdgesTiled(cleaned_cv_img)
+    if self.EDGE_PENALTY == 'fft':
+      return self.penalizeObstacleProximityCorrected(cleaned_cv_img)
+    if self.EDGE_PENALTY == 'numba' and edge_penalty.numba is not None:
+      return edge_penalty.edge_penalty_numba(
+          cleaned_cv_img, self.cleaned_with_sky_ground,
+          self.kernel_right.ravel(), self.kernel_left.ravel(),
+          self.kernel_bottom.ravel(), self.kernel_top.ravel(),
+          self.K_vertical, self.K_horizontal, self.EDGE_THRESHOLD)
+    height, width = cleaned_cv_img.shape
+    vertical = self.edgeSpectra('vertical_spectra', self.kernel_right.ravel(), width)
+    horizontal = self.edgeSpectra('horizontal_spectra', self.kernel_bottom.ravel(), height)
+    return edge_penalty.edge_penalty_spectral(
+        cleaned_cv_img, self.cleaned_with_sky_ground,
+        vertical + (self.K_vertical,), horizontal + (self.K_horizontal,), self.EDGE_THRESHOLD)
+
+
+  def penalizeEdgesTiled(self, cleaned_cv_img):
+    '''
+    penalizeEdges with the left/right pass split into row stripes and the
+    top/bottom pass into column stripes, one per PENALTY_WORKERS thread.
+    A pass only mixes pixels along its axis, so the stripes need no halo
+    and the result equals the serial one exactly.
+    '''
+    height, width = cleaned_cv_img.shape
+    threshold = self.EDGE_THRESHOLD
+    if self.EDGE_PENALTY == 'spectral' or (self.EDGE_PENALTY == 'numba' and edge_penalty.numba is None):
+      vertical = self.edgeSpectra('vertical_spectra', self.kernel_right.ravel(), width)
+      horizontal = self.edgeSpectra('horizontal_spectra', self.kernel_bottom.ravel(), height)
+      run_pass = edge_penalty.spectral_pass
+    else:
+      vertical = (self.kernel_right.ravel(), self.kernel_left.ravel())
+      horizontal = (self.kernel_bottom.ravel(), self.kernel_top.ravel())
+      run_pass = edge_penalty.fft_pass if self.EDGE_PENALTY == 'fft' else edge_penalty.numba_pass
+    vertical += (self.K_vertical, threshold, 1)
+    horizontal += (self.K_horizontal, threshold, 0)
+
+    pool = self.penaltyPool()
+    penalized_cv_img = cleaned_cv_img.copy()
+    pool.map(lambda rows: run_pass(cleaned_cv_img[rows], penalized_cv_img[rows], *vertical),
+             edge_penalty.stripes(height, self.PENALTY_WORKERS))
+    penalized_cv_img[:,0] = 0
+    penalized_cv_img[:,-1] = 0
+    sky_ground = self.cleaned_with_sky_ground
+    pool.map(lambda cols: run_pass(sky_ground[:,cols], penalized_cv_img[:,cols], *horizontal),
+             edge_penalty.stripes(width, self.PENALTY_WORKERS))
+    penalized_cv_img[0,:] = 0
+    penalized_cv_img[-1,:] = 0
+    return penalized_cv_img
+
+
+  def penaltyPool(self):
+    '''
+    Thread pool of PENALTY_WORKERS, kept across frames
+    '''
+    workers, pool = self.penalty_pool
+    if pool is None or workers != self.PENALTY_WORKERS:
+      if pool is not None:
+        pool.close()
+      pool = multiprocessing.pool.ThreadPool(self.PENALTY_WORKERS)
+      self.penalty_pool = (self.PENALTY_WORKERS, pool)
+    return pool
+
+
+  def edgeSpectra(self, name, kernel, size):
+    '''
+    (spectra, transform length, kernel size) of a kernel and its mirror
+    for edge_penalty_spectral along an axis of size pixels
+    '''
+    def build(kernel_bytes, size):
+      length = edge_penalty.spectral_length(size, kernel.size)
+      return (edge_penalty.kernel_spectra(kernel, kernel[::-1], length), length, kernel.size)
+    return self.cachedField(name, (kernel.tobytes(), size), build)
+
+
   def penalizeObstacleProximityCorrected(self, cleaned_cv_img):
     penalized_cv_img = cleaned_cv_img.copy()
     
@@ -340,7 +767,7 @@ class Helper:
     So danger obstacle is on the left of the edge line
     '''
     right_vertical_edge = cleaned_cv_img[:,1:] - cleaned_cv_img[:,0:-1]
-    right_vertical_mask = (right_vertical_edge > 0.1).astype(float)
+    right_vertical_mask = (right_vertical_edge > self.EDGE_THRESHOLD).astype(float)
     # This matrix is basically blips at the pixels of right_vertical_edge
     
     
@@ -358,7 +785,7 @@ class Helper:
     So danger obstacle is on the right of the edge line
     '''
     left_vertical_edge = cleaned_cv_img[:,0:-1] - cleaned_cv_img[:,1:]
-    left_vertical_mask = (left_vertical_edge > 0.1).astype(float)
+    left_vertical_mask = (left_vertical_edge > self.EDGE_THRESHOLD).astype(float)
     # This matrix is basically blips at the pixels of left_vertical_edge
 
     # left_vertical_penalty = self.K_vertical*scipy.ndimage.convolve1d(left_vertical_mask,
@@ -375,7 +802,7 @@ class Helper:
     '''
     # bottom_horizontal_edge = cleaned_cv_img[0:-1,:] - cleaned_cv_img[1:,:]
     bottom_horizontal_edge = self.cleaned_with_sky_ground[1:,:] - self.cleaned_with_sky_ground[0:-1,:]
-    bottom_horizontal_mask = (bottom_horizontal_edge > 0.1).astype(float)
+    bottom_horizontal_mask = (bottom_horizontal_edge > self.EDGE_THRESHOLD).astype(float)
     # This matrix is basically blips at the pixels of bottom_horizontal_edge
 
     # bottom_horizontal_penalty = self.K_horizontal*scipy.ndimage.convolve1d(bottom_horizontal_mask,
@@ -392,7 +819,7 @@ class Helper:
     '''
     # top_horizontal_edge = cleaned_cv_img[1:,:] - cleaned_cv_img[0:-1,:]
     top_horizontal_edge = self.cleaned_with_sky_ground[0:-1,:] - self.cleaned_with_sky_ground[1:,:]
-    top_horizontal_mask = (top_horizontal_edge > 0.1).astype(float)
+    top_horizontal_mask = (top_horizontal_edge > self.EDGE_THRESHOLD).astype(float)
     # This matrix is basically blips at the pixels of top_horizontal_edge
 
     # top_horizontal_penalty = self.K_horizontal*scipy.ndimage.convolve1d(top_horizontal_mask,
@@ -404,13 +831,13 @@ class Helper:
 
     penalized_cv_img[:,0:-1] = penalized_cv_img[:,0:-1] - right_vertical_penalty
     penalized_cv_img[:,1:] = penalized_cv_img[:,1:] - left_vertical_penalty
-    penalized_cv_img[:,0] = np.zeros(480)
-    penalized_cv_img[:,-1] = np.zeros(480)
+    penalized_cv_img[:,0] = 0
+    penalized_cv_img[:,-1] = 0
 
     penalized_cv_img[0:-1,:] = penalized_cv_img[0:-1,:] - bottom_horizontal_penalty
     penalized_cv_img[1:,:] = penalized_cv_img[1:,:] - top_horizontal_penalty
-    penalized_cv_img[0,:] = np.zeros(640)
-    penalized_cv_img[-1,:] = np.zeros(640)
+    penalized_cv_img[0,:] = 0
+    penalized_cv_img[-1,:] = 0
     
 
     penalized_cv_img.clip(min=0)
@@ -429,7 +856,7 @@ class Helper:
     So danger obstacle is on the left of the edge line
     '''
     right_vertical_edge = cleaned_cv_img[:,1:] - cleaned_cv_img[:,0:-1]
-    right_vertical_mask = (right_vertical_edge > 0.1).astype(float)
+    right_vertical_mask = (right_vertical_edge > self.EDGE_THRESHOLD).astype(float)
     # This matrix is basically blips at the pixels of right_vertical_edge
     
     
@@ -447,7 +874,7 @@ class Helper:
     So danger obstacle is on the right of the edge line
     '''
     left_vertical_edge = cleaned_cv_img[:,0:-1] - cleaned_cv_img[:,1:]
-    left_vertical_mask = (left_vertical_edge > 0.1).astype(float)
+    left_vertical_mask = (left_vertical_edge > self.EDGE_THRESHOLD).astype(float)
     # This matrix is basically blips at the pixels of left_vertical_edge
 
     # left_vertical_penalty = self.K_vertical*scipy.ndimage.convolve1d(left_vertical_mask,
@@ -464,7 +891,7 @@ class Helper:
     '''
     # bottom_horizontal_edge = cleaned_cv_img[0:-1,:] - cleaned_cv_img[1:,:]
     bottom_horizontal_edge = cleaned_cv_img[1:,:] - cleaned_cv_img[0:-1,:]
-    bottom_horizontal_mask = (bottom_horizontal_edge > 0.1).astype(float)
+    bottom_horizontal_mask = (bottom_horizontal_edge > self.EDGE_THRESHOLD).astype(float)
     # This matrix is basically blips at the pixels of bottom_horizontal_edge
 
     # bottom_horizontal_penalty = self.K_horizontal*scipy.ndimage.convolve1d(bottom_horizontal_mask,
@@ -481,7 +908,7 @@ class Helper:
     '''
     # top_horizontal_edge = cleaned_cv_img[1:,:] - cleaned_cv_img[0:-1,:]
     top_horizontal_edge = cleaned_cv_img[0:-1,:] - cleaned_cv_img[1:,:]
-    top_horizontal_mask = (top_horizontal_edge > 0.1).astype(float)
+    top_horizontal_mask = (top_horizontal_edge > self.EDGE_THRESHOLD).astype(float)
     # This matrix is basically blips at the pixels of top_horizontal_edge
 
     # top_horizontal_penalty = self.K_horizontal*scipy.ndimage.convolve1d(top_horizontal_mask,
@@ -493,13 +920,13 @@ class Helper:
 
     penalized_cv_img[:,0:-1] = penalized_cv_img[:,0:-1] - right_vertical_penalty
     penalized_cv_img[:,1:] = penalized_cv_img[:,1:] - left_vertical_penalty
-    penalized_cv_img[:,0] = np.zeros(480)
-    penalized_cv_img[:,-1] = np.zeros(480)
+    penalized_cv_img[:,0] = 0
+    penalized_cv_img[:,-1] = 0
 
     penalized_cv_img[0:-1,:] = penalized_cv_img[0:-1,:] - bottom_horizontal_penalty
     penalized_cv_img[1:,:] = penalized_cv_img[1:,:] - top_horizontal_penalty
-    penalized_cv_img[0,:] = np.zeros(640)
-    penalized_cv_img[-1,:] = np.zeros(640)
+    penalized_cv_img[0,:] = 0
+    penalized_cv_img[-1,:] = 0
     
 
     penalized_cv_img.clip(min=0)
@@ -508,7 +935,23 @@ class Helper:
     return penalized_cv_img
   
 
+  def clearancePenalty(self, cleaned_cv_img):
+    '''
+    Depth weighted by the clearance of every pixel: band pixels closer
+    than DANGER_DISTANCE are obstacles, and the weight grows linearly
+    with the Euclidean distance to the nearest one (one linear-time
+    distance transform), reaching 1 at CLEARANCE_RADIUS pixels
+    '''
+    near = self.sky_ground_mask & (cleaned_cv_img < self.DANGER_DISTANCE/self.POINTCLOUD_CUTOFF)
+    if not np.any(near):
+      return cleaned_cv_img.copy()
+    distance = cv2.distanceTransform((~near).astype(np.uint8), cv2.DIST_L2, cv2.DIST_MASK_PRECISE)
+    return cleaned_cv_img*np.minimum(distance/self.scaledPixels(self.CLEARANCE_RADIUS), 1.)
+
+
   def dilateImage(self, cleaned_cv_img):
-    img = scipy.ndimage.grey_dilation((1.-cleaned_cv_img), size=self.DILATION_KERNEL, mode='constant', cval=0.0)
+    # A rectangular size runs as separable running max filters (van Herk/
+    # Gil-Werman class), so the cost doesn't grow with DILATION_KERNEL
+    img = scipy.ndimage.grey_dilation((1.-cleaned_cv_img), size=[self.scaledPixels(n) for n in self.DILATION_KERNEL], mode='constant', cval=0.0)
 
     return (1.-img)
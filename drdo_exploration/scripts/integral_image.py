@@ -0,0 +1,50 @@
+#!/usr/bin/env python
+
+# task: O(1) pixel counts over rectangles of a mask (summed-area table)
+from __future__ import print_function
+from __future__ import division
+
+import numpy as np
+
+
+class IntegralImage:
+  '''
+  Summed-area table of a 2-D mask (or any integer/float image): entry
+  (r, c) holds the sum of mask[:r, :c], so the sum over any rectangle is
+  four lookups. count() takes arrays of rectangles and answers them all
+  with one fancy-indexing gather, e.g. a window around every candidate
+  target at once.
+  '''
+
+  def __init__(self, mask):
+    mask = np.asarray(mask)
+    dtype = np.int32 if mask.dtype == bool else np.result_type(mask.dtype, np.int32)
+    self.shape = mask.shape
+    self.table = np.zeros((mask.shape[0] + 1, mask.shape[1] + 1), dtype=dtype)
+    np.cumsum(mask, axis=0, dtype=dtype, out=self.table[1:,1:])
+    np.cumsum(self.table[1:,1:], axis=1, out=self.table[1:,1:])
+    self.total = self.table[-1,-1]
+
+
+  def count(self, top, left, bottom, right):
+    '''
+    Sum of mask[top:bottom, left:right] for scalars or broadcastable
+    arrays of bounds; bounds are clipped to the image, so windows may
+    hang over its edges
+    '''
+    height, width = self.shape
+    top, bottom = np.clip(top, 0, height), np.clip(bottom, 0, height)
+    left, right = np.clip(left, 0, width), np.clip(right, 0, width)
+    bottom, right = np.maximum(bottom, top), np.maximum(right, left)
+    table = self.table
+    return table[bottom, right] - table[top, right] - table[bottom, left] + table[top, left]
+
+
+  def around(self, rows, cols, half_height, half_width):
+    '''
+    count() of the windows [row - half_height, row + half_height] x
+    [col - half_width, col + half_width] around pixels
+    '''
+    rows, cols = np.asarray(rows), np.asarray(cols)
+    return self.count(rows - half_height, cols - half_width,
+                      rows + half_height + 1, cols + half_width + 1)
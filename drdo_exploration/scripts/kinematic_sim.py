@@ -0,0 +1,349 @@
+#!/usr/bin/env python
+
+# task: closed-loop explorer + survey flights in the interiit21 worlds without
+# gazebo or SITL (imports helper2 and survey and so the ROS python packages)
+from __future__ import print_function
+from __future__ import division
+
+import argparse
+import multiprocessing
+import os
+import sys
+import time
+
+from benchmarks import WORLDS, depth_helper # also pins BLAS to one core
+
+import numpy as np
+import yaml
+from std_msgs.msg import Int16
+
+from depth_renderer import DepthRenderer
+from latency_tracer import LatencyTracer
+from occupancy_map import OccupancyMap, euler_to_rotation
+from planner import WaypointPlanner
+from sdf_world import WorldModel
+from survey import Survey
+from vfh import VFHHelper
+
+
+class SimSurvey(Survey):
+  '''
+  Survey with its parameters, depth pipeline and state machine but no
+  node: the flight's clock stands in for rospy time, teleop commands go
+  to the flight instead of safe_move and completion is only recorded
+  '''
+
+  def __init__(self, flight, strategy='anytime'):
+    self.flight = flight
+    self.curr_position = np.zeros(3)
+    self.curr_orientation = np.zeros(3)
+    self.defineParameters()
+    self.defineSurveyParameters(strategy)
+    self.defineSurveyState()
+    self.frame_stamp = None
+    self.tracer = LatencyTracer('survey', summary_period=0)
+    self.committed = False
+
+  def now(self):
+    return self.flight.time
+
+  def sendTeleop(self, decision, delta):
+    self.flight.teleop(decision, delta)
+
+  def publishComplete(self):
+    self.committed = True
+
+  def reportDurations(self, now):
+    pass # No node to log to; the durations stay in state_durations
+
+
+class KinematicFlight:
+  '''
+  One mission flown kinematically in a WorldModel. Every DECISION_PERIOD
+  of simulated time a depth frame is rendered from the current pose, the
+  occupancy map is updated and the explorer engine ('penalty', 'profile'
+  or 'vfh') picks a direction, which the drone follows (through the
+  WaypointPlanner like explorer.publishWaypoint, if use_planner) at the
+  navigator's SPEED. A danger flag runs the survey's own state machine
+  (Survey.stepSurvey on its SURVEY_PERIOD timer) on rendered frames, so
+  its STATE_DWELL times are charged to the clock.
+
+  The flight ends 'reached' within REACHED_MARKER of the marker,
+  'collided' when the body touches an obstacle, 'stuck' when a survey
+  finds no way out or MAX_SURVEYS are used up, or 'timeout' after
+  MAX_TIME. min_clearance is the closest the centre came to an
+  obstacle.
+  '''
+  SPEED = 0.8 # m/s, move_to_targ MAX_SPEED
+  DECISION_PERIOD = 0.5 # s of simulated time per depth frame
+  BODY_RADIUS = 0.3 # m
+  REACHED_MARKER = 2. # m, horizontal distance at which the marker is found
+  MAX_TIME = 300. # s of simulated time
+  MAX_SURVEYS = 20
+  SURVEY_PERIOD = 0.1 # s, Survey.survey_timer
+  SPAWN_JITTER = 0.5 # m and 0.2 rad of spawn noise for seeds other than 0
+  RENDER_STRIDE = 2 # one depth ray per 2x2 pixels
+
+  def __init__(self, world, engine='penalty', seed=0, use_planner=True,
+               depth_noise=0., strategy='anytime', parameters=None):
+    '''
+    depth_noise: standard deviation of the multiplicative depth noise
+    parameters: depth pipeline tunables ({name: value}, see depth_params)
+    for the explorer and the survey
+    '''
+    self.world = world
+    self.renderer = DepthRenderer(world, stride=self.RENDER_STRIDE)
+    self.engine = engine
+    self.use_planner = use_planner
+    self.depth_noise = depth_noise
+    self.rng = np.random.RandomState(seed)
+
+    self.time = 0.
+    self.helper = depth_helper(VFHHelper)
+    self.survey = SimSurvey(self, strategy)
+    if parameters:
+      self.helper.applyParameters(parameters)
+      self.survey.applyParameters(parameters)
+    self.occupancy_map = OccupancyMap(rays=self.helper.imageRays)
+    self.planner = WaypointPlanner(self.occupancy_map)
+
+    self.position = np.array([world.spawn[0], world.spawn[1], 2.5])
+    self.yaw = world.spawn[3]
+    if seed:
+      for _ in range(100):
+        offset = self.rng.uniform(-self.SPAWN_JITTER, self.SPAWN_JITTER, 2)
+        if not self.collides(self.position + np.append(offset, 0.)):
+          self.position[:2] += offset
+          break
+      self.yaw += self.rng.uniform(-0.2, 0.2)
+
+    self.flown = 0.
+    self.surveys = 0
+    self.frames = 0
+    self.engine_times = []
+    self.min_clearance = self.clearance()
+    self.outcome = None
+
+
+  def collides(self, position):
+    '''
+    Drone body sampled as its centre and four points BODY_RADIUS around it
+    '''
+    body = self.BODY_RADIUS*np.array([[0, 0, 0], [1, 0, 0], [-1, 0, 0], [0, 1, 0], [0, -1, 0]])
+    return bool(self.world.contains(position + body).any() or position[2] < self.BODY_RADIUS)
+
+
+  def clearance(self):
+    '''
+    Distance from the centre to the nearest obstacle surface, up to the
+    renderer's reach
+    '''
+    clearance = self.renderer.CUTOFF*self.renderer.MAX_RAY_NORM
+    for index, bound in zip(*self.renderer.nearby(self.position)):
+      if bound >= clearance:
+        break
+      kind, rotation, centre, parameters = self.renderer.primitives[index]
+      local = (self.position - centre).dot(rotation)
+      if kind == 'box':
+        gap = np.maximum(np.abs(local) - parameters, 0.)
+      else:
+        radius, half_length = parameters
+        gap = np.maximum([np.hypot(local[0], local[1]) - radius, abs(local[2]) - half_length], 0.)
+      clearance = min(clearance, np.linalg.norm(gap))
+    return clearance
+
+
+  def render(self, yaw=None):
+    orientation = (0., 0., self.yaw if yaw is None else yaw)
+    depth = self.renderer.render(self.position, orientation).astype(float)
+    if self.depth_noise:
+      depth *= 1. + self.depth_noise*self.rng.standard_normal(depth.shape)
+    self.frames += 1
+    return depth, orientation
+
+
+  def decide(self, depth, orientation):
+    '''
+    Target pixel and danger flag of the explorer engine for a frame
+    '''
+    helper = self.helper
+    helper.curr_position, helper.curr_orientation = self.position.copy(), orientation
+    t = time.time()
+    if self.engine == 'penalty':
+      penalized, target = helper.preprocessDepth(depth)
+      danger = helper.detectDanger(penalized, target)
+    elif self.engine == 'profile':
+      profile, target = helper.preprocessProfile(depth)
+      danger = helper.detectDangerProfile(profile)
+    else:
+      histogram, target = helper.preprocessVFH(depth, occupancy_map=self.occupancy_map)
+      danger = helper.vfh_sector is None
+    self.engine_times.append(time.time() - t)
+    return target, danger
+
+
+  def move(self, direction):
+    '''
+    Fly one DECISION_PERIOD along a world direction (or to the planner's
+    waypoint ahead of it), facing the horizontal direction of travel.
+    Returns False on a collision.
+    '''
+    step = self.SPEED*self.DECISION_PERIOD
+    if self.use_planner:
+      waypoint = self.planner.plan_along(self.position, direction)
+      if waypoint is not None and np.linalg.norm(waypoint - self.position) > 1e-3:
+        direction = waypoint - self.position
+        step = min(step, np.linalg.norm(direction))
+        direction = direction/np.linalg.norm(direction)
+    self.time += self.DECISION_PERIOD
+    # Check the body half way as well so a step can't jump a thin wall
+    for fraction in (0.5, 1.):
+      if self.collides(self.position + fraction*step*direction):
+        return False
+    self.position = self.position + step*direction
+    self.position[2] = np.clip(self.position[2], self.planner.FLOOR, self.planner.CEILING)
+    if np.hypot(direction[0], direction[1]) > 1e-3:
+      self.yaw = np.arctan2(direction[1], direction[0])
+    self.flown += step
+    self.min_clearance = min(self.min_clearance, self.clearance())
+    return True
+
+
+  def teleop(self, decision, delta):
+    '''
+    safe_move on a survey command: decision 4 flies to height delta,
+    5 turns by delta degrees
+    '''
+    if decision == 4:
+      self.position[2] = delta
+    elif decision == 5:
+      self.yaw += np.radians(delta)
+
+
+  def runSurvey(self):
+    '''
+    Survey from /safesearch/start to its end, stepping it every
+    SURVEY_PERIOD of simulated time and giving it a rendered frame
+    whenever it evaluates a yaw step. Returns the committed world yaw,
+    or None (emergency, or a climb into an obstacle).
+    '''
+    survey = self.survey
+    survey.committed = False
+    survey.start_survey_callback(Int16(data=1))
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, 'w') # The survey narrates every step
+    try:
+      while survey.state != survey.IDLE:
+        self.time += self.SURVEY_PERIOD
+        if survey.state == survey.EVALUATE:
+          depth, orientation = self.render()
+          survey.curr_position, survey.curr_orientation = self.position.copy(), orientation
+          survey.processDepth(depth, None)
+        height = self.position[2]
+        survey.stepSurvey(None)
+        if self.position[2] != height:
+          if self.collides(self.position):
+            return None
+          self.min_clearance = min(self.min_clearance, self.clearance())
+    finally:
+      sys.stdout.close()
+      sys.stdout = stdout
+    return self.yaw if survey.committed else None
+
+
+  def run(self, max_steps=None):
+    '''
+    Fly until an outcome (or max_steps frames); returns the outcome
+    '''
+    steps = 0
+    while self.outcome is None:
+      if np.hypot(*(self.position[:2] - self.world.marker[:2])) < self.REACHED_MARKER:
+        self.outcome = 'reached'
+      elif self.time > self.MAX_TIME or (max_steps is not None and steps >= max_steps):
+        self.outcome = 'timeout'
+      if self.outcome is not None:
+        break
+      steps += 1
+
+      depth, orientation = self.render()
+      self.occupancy_map.update(depth, self.position, orientation)
+      target, danger = self.decide(depth, orientation)
+      if danger:
+        self.surveys += 1
+        yaw = self.runSurvey() if self.surveys <= self.MAX_SURVEYS else None
+        if yaw is None:
+          self.outcome = 'collided' if self.collides(self.position) else 'stuck'
+        else:
+          self.yaw = yaw
+        continue
+
+      direction = euler_to_rotation(*orientation).dot(self.helper.pixelRays(*target))
+      if not self.move(direction):
+        self.outcome = 'collided'
+    return self.outcome
+
+
+def run_case(case):
+  '''
+  Pool worker: fly (world path, engine, seed, options) and summarise
+  '''
+  path, engine, seed, options = case
+  flight = KinematicFlight(WorldModel(path), engine, seed, **options)
+  start = time.time()
+  outcome = flight.run()
+  wall = time.time() - start
+  return dict(world=os.path.basename(path), engine=engine, seed=seed,
+              outcome=outcome, sim_time=flight.time, wall_time=wall,
+              flown=flight.flown, surveys=flight.surveys, frames=flight.frames,
+              engine_time=np.mean(flight.engine_times) if flight.engine_times else 0.,
+              clearance=flight.min_clearance,
+              closest=np.hypot(*(flight.position[:2] - flight.world.marker[:2])))
+
+
+def run_batch(worlds, engines, seeds, workers, options):
+  cases = [(path, engine, seed, options)
+           for path in worlds for engine in engines for seed in range(seeds)]
+  if workers > 1:
+    pool = multiprocessing.Pool(workers)
+    try:
+      return pool.map(run_case, cases, chunksize=1)
+    finally:
+      pool.close()
+      pool.join()
+  return [run_case(case) for case in cases]
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description="Kinematic closed-loop flights in the world files")
+  parser.add_argument('--worlds', nargs='*', default=WORLDS)
+  parser.add_argument('--engines', nargs='*', default=['penalty', 'profile', 'vfh'])
+  parser.add_argument('--seeds', type=int, default=2)
+  parser.add_argument('--workers', type=int, default=multiprocessing.cpu_count())
+  parser.add_argument('--strategy', default='anytime', help="survey strategy: anytime or sweep")
+  parser.add_argument('--depth-noise', type=float, default=0.)
+  parser.add_argument('--no-planner', action='store_true',
+                      help="follow the engine direction without the waypoint planner")
+  parser.add_argument('--param', action='append', default=[], metavar='NAME=VALUE',
+                      help="depth pipeline tunable, e.g. DECIMATION=2 (repeatable)")
+  args = parser.parse_args()
+
+  parameters = dict((name, yaml.safe_load(value)) for name, value in
+                    (param.split('=', 1) for param in args.param))
+  options = dict(use_planner=not args.no_planner, depth_noise=args.depth_noise,
+                 strategy=args.strategy, parameters=parameters)
+  start = time.time()
+  results = run_batch(args.worlds, args.engines, args.seeds, args.workers, options)
+  for r in results:
+    print("%-8s %-24s seed %2d  %-8s %6.1f s sim %6.1f s wall  %5.1f m  %2d surveys  "
+          "marker %5.1f m  clearance %4.2f m"
+          % (r['engine'], r['world'], r['seed'], r['outcome'], r['sim_time'], r['wall_time'],
+             r['flown'], r['surveys'], r['closest'], r['clearance']))
+  for engine in args.engines:
+    runs = [r for r in results if r['engine'] == engine]
+    outcomes = [r['outcome'] for r in runs]
+    print("%-8s reached %d, collided %d, stuck %d, timeout %d of %d; engine %.1f ms/frame, "
+          "%.1fx real time" % (engine, outcomes.count('reached'), outcomes.count('collided'),
+                               outcomes.count('stuck'), outcomes.count('timeout'), len(runs),
+                               1e3*np.mean([r['engine_time'] for r in runs]),
+                               sum(r['sim_time'] for r in runs)/sum(r['wall_time'] for r in runs)))
+  print("%d flights in %.1f s on %d workers" % (len(results), time.time() - start, args.workers))
@@ -0,0 +1,129 @@
+#!/usr/bin/env python
+
+# task: per-stage timings and frame-to-setpoint latency across the nodes
+from __future__ import print_function
+from __future__ import division
+
+import collections
+import os
+import time
+
+import numpy as np
+
+import rospy
+from std_msgs.msg import String
+
+
+class LatencyTracer:
+  '''
+  Keeps the last CAPACITY samples of every stage of a node in a ring
+  buffer and periodically publishes their percentiles on /trace/summary
+  (and appends them to a CSV file if one is given).
+
+  Two kinds of samples (seconds):
+    age(stage, stamp): time since the source depth/RGB image was taken,
+    for a message leaving or arriving at a node. The image stamp travels
+    in the header of direction, teleopData, aruco_detect and
+    /planner/waypoint, so the age at the setpoint is the end-to-end
+    perception-to-actuation latency.
+    timed(stage): wall time of a block of computation.
+  '''
+  PERCENTILES = (50, 90, 99)
+
+  def __init__(self, node_name, capacity=1000, summary_period=5.0, csv_path=None):
+    self.node_name = node_name
+    self.CAPACITY = capacity
+    self.samples = collections.defaultdict(lambda: collections.deque(maxlen=self.CAPACITY))
+    self.csv_path = csv_path
+    if csv_path and not os.path.exists(csv_path):
+      with open(csv_path, 'a') as csv_file:
+        csv_file.write('time,node,stage,count,mean,' +
+                       ','.join('p%d' % p for p in self.PERCENTILES) + ',max\n')
+
+    # Created with the first summary, so that a tracer can record outside
+    # a node (kinematic_sim)
+    self.summary_pub = None
+    if summary_period > 0:
+      self.summary_timer = rospy.Timer(rospy.Duration(summary_period), self.publishSummary)
+
+
+  def record(self, stage, seconds):
+    self.samples[stage].append(seconds)
+
+
+  def age(self, stage, stamp):
+    '''
+    Latency of stage relative to the header stamp of the source image;
+    ignored for unstamped messages
+    '''
+    if stamp is None or stamp.is_zero():
+      return
+    self.record(stage, rospy.get_time() - stamp.to_sec())
+
+
+  def timed(self, stage):
+    return _StageTimer(self, stage)
+
+
+  def summary(self):
+    '''
+    {stage: (count, mean, p50, p90, p99, max)} over the ring buffers
+    '''
+    stats = {}
+    for stage, samples in list(self.samples.items()):
+      values = np.array(samples)
+      if values.size == 0:
+        continue
+      stats[stage] = ((values.size, values.mean())
+                      + tuple(np.percentile(values, self.PERCENTILES))
+                      + (values.max(),))
+    return stats
+
+
+  def publishSummary(self, event=None):
+    stats = self.summary()
+    if not stats:
+      return
+    lines = []
+    for stage in sorted(stats):
+      count, mean = stats[stage][:2]
+      percentiles = stats[stage][2:-1]
+      lines.append('%s %s: n=%d mean=%.1fms %s max=%.1fms' % (
+          self.node_name, stage, count, 1e3*mean,
+          ' '.join('p%d=%.1fms' % (p, 1e3*v) for p, v in zip(self.PERCENTILES, percentiles)),
+          1e3*stats[stage][-1]))
+    if self.summary_pub is None:
+      self.summary_pub = rospy.Publisher('/trace/summary', String, queue_size=10)
+    self.summary_pub.publish(String(data='\n'.join(lines)))
+
+    if self.csv_path:
+      now = rospy.get_time()
+      with open(self.csv_path, 'a') as csv_file:
+        for stage in sorted(stats):
+          csv_file.write('%.3f,%s,%s,%d,' % (now, self.node_name, stage, stats[stage][0]) +
+                         ','.join('%.6f' % v for v in stats[stage][1:]) + '\n')
+
+
+class _StageTimer:
+  def __init__(self, tracer, stage):
+    self.tracer = tracer
+    self.stage = stage
+
+  def __enter__(self):
+    self.start = time.time()
+    return self
+
+  def __exit__(self, *exc_info):
+    self.tracer.record(self.stage, time.time() - self.start)
+    return False
+
+
+def make_tracer(node_name):
+  '''
+  Tracer configured from the global /trace_period (s, 0 = no summary
+  topic) and /trace_csv (path, empty = no CSV) parameters shared by all
+  the nodes
+  '''
+  return LatencyTracer(node_name,
+                       summary_period=rospy.get_param('/trace_period', 5.0),
+                       csv_path=rospy.get_param('/trace_csv', '') or None)
@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+
+# task: in-process publish/subscribe for nodes composed into one process
+from __future__ import print_function
+from __future__ import division
+
+import collections
+import copy
+import threading
+
+import rospy
+
+
+class LocalSubscriber:
+  '''
+  Delivers messages to one callback on its own thread, keeping at most
+  queue_size pending messages (oldest dropped first), like a rospy
+  subscriber does
+  '''
+
+  def __init__(self, callback, queue_size):
+    self.callback = callback
+    self.queue = collections.deque(maxlen=max(1, queue_size or 1))
+    self.condition = threading.Condition()
+    self.thread = threading.Thread(target=self.run)
+    self.thread.daemon = True
+    self.thread.start()
+
+  def deliver(self, msg):
+    with self.condition:
+      self.queue.append(msg)
+      self.condition.notify()
+
+  def run(self):
+    while not rospy.is_shutdown():
+      with self.condition:
+        while not self.queue:
+          self.condition.wait(0.5)
+          if rospy.is_shutdown():
+            return
+        msg = self.queue.popleft()
+      self.callback(msg)
+
+
+class LocalPublisher:
+  '''
+  Hands each message straight to the in-process subscribers of the topic
+  and also publishes it over ROS for any external subscriber (rospy does
+  not serialize when nobody is connected)
+  '''
+
+  def __init__(self, bus, topic, msg_class, queue_size):
+    self.bus = bus
+    self.topic = topic
+    self.ros_publisher = rospy.Publisher(topic, msg_class, queue_size=queue_size)
+
+  def publish(self, msg):
+    subscribers = self.bus.subscribers[self.topic]
+    if subscribers:
+      # Publishers reuse and mutate their message objects after publishing
+      msg_copy = copy.deepcopy(msg)
+      for subscriber in subscribers:
+        subscriber.deliver(msg_copy)
+    self.ros_publisher.publish(msg)
+
+
+class MessageBus:
+  '''
+  Drop-in replacement for the rospy module as the transport of the node
+  classes (they only call bus.Publisher and bus.Subscriber).
+
+  Topics in local_topics are exchanged in memory between the components
+  hosted in this process; every other topic goes through rospy as usual.
+  '''
+
+  def __init__(self, local_topics):
+    self.local_topics = set(local_topics)
+    self.subscribers = collections.defaultdict(list)
+
+  def Publisher(self, topic, msg_class, queue_size=None):
+    if topic not in self.local_topics:
+      return rospy.Publisher(topic, msg_class, queue_size=queue_size)
+    return LocalPublisher(self, topic, msg_class, queue_size)
+
+  def Subscriber(self, topic, msg_class, callback, queue_size=None):
+    if topic not in self.local_topics:
+      return rospy.Subscriber(topic, msg_class, callback, queue_size=queue_size)
+    subscriber = LocalSubscriber(callback, queue_size)
+    self.subscribers[topic].append(subscriber)
+    return subscriber
@@ -8,13 +8,15 @@ import math
 from time import sleep
 from tf.transformations import euler_from_quaternion, quaternion_from_euler
 from geometry_msgs.msg import Point,Twist
-from geometry_msgs.msg import PoseStamped
+from geometry_msgs.msg import PoseStamped, PointStamped, TwistStamped
 from math import atan2, cos, sin
 from nav_msgs.msg import *
 from drdo_exploration.msg import direction #Here direction is the message containing target co-ordinates.
 from mavros_msgs.srv import SetMode, CommandBool, CommandTOL
 from std_msgs.msg import Int16
 from drdo_exploration.msg import aruco_detect
+from latency_tracer import make_tracer
+from pose_buffer import PoseBuffer
 #from geometry_msgs import PoseStamped
 
 import numpy as np
@@ -22,9 +24,10 @@ import numpy as np
 
 
 class moveCopter:
-		def __init__(self):
+		def __init__(self, bus=rospy):
 				'''
 				All values are initialized to zero.
+				bus is the transport providing Publisher/Subscriber (rospy or a MessageBus).
 				pub_set_point_local publishes the goal_point co-ordinates.
 				sub_gps and sub_targ_vector subscribes to the global co-ordinates of the drone and the local co-ordinates of the goal_point.
 				'''
@@ -38,14 +41,20 @@ class moveCopter:
 				self.targ_y=0.0
 				self.targ_z=0.0
 				self.rel_yaw = 0.0
+				self.clearance = 0.0
 				self.flag=0.0
 				self.edge_distance=0.0
+				# Odometry ring for the pose at the stamp of the frame a
+				# direction or marker detection came from
+				self.pose_buffer = PoseBuffer()
+				self.direction_pose = None
 
-				rospy.init_node('navigator_node')
-				self.pub_set_point_local=rospy.Publisher('/mavros/setpoint_position/local', PoseStamped,queue_size=1)
-				self.sub_gps=rospy.Subscriber("/mavros/global_position/local",Odometry, self.gps_data_callback,queue_size=1)
-				self.sub_aruco_detect = rospy.Subscriber("/aruco_detect", aruco_detect, self.aruco_detect_callback,queue_size=1)
-				self.sub_targ_vector=rospy.Subscriber("/target_vector",direction, self.targ_vector_callback,queue_size=1)
+				self.pub_set_point_local=bus.Publisher('/mavros/setpoint_position/local', PoseStamped,queue_size=1)
+				self.pub_set_point_vel=bus.Publisher('/mavros/setpoint_velocity/cmd_vel', TwistStamped,queue_size=1)
+				self.sub_gps=bus.Subscriber("/mavros/global_position/local",Odometry, self.gps_data_callback,queue_size=1)
+				self.sub_aruco_detect = bus.Subscriber("/aruco_detect", aruco_detect, self.aruco_detect_callback,queue_size=1)
+				self.sub_targ_vector=bus.Subscriber("/target_vector",direction, self.targ_vector_callback,queue_size=1)
+				self.sub_waypoint=bus.Subscriber("/planner/waypoint",PointStamped, self.waypoint_callback,queue_size=1)
 				self.msgp=PoseStamped()
 				self.rate=rospy.Rate(1)
 
@@ -53,6 +62,44 @@ class moveCopter:
 				self.t_prev = 0.0
 				self.I = 0.0
 
+				self.waypoint = None
+				self.waypoint_time = 0.0
+				self.WAYPOINT_TIMEOUT = 2.0 # s, older planner waypoints are ignored
+
+				# Setpoints are streamed from a fixed-rate timer; the callbacks only
+				# move goal_position/goal_heading and the loop slews towards them
+				self.CONTROL_RATE = 20.0 # Hz
+				self.MAX_SPEED = 0.8 # m/s, slew limit of the streamed setpoint
+				self.goal_position = None
+				self.goal_heading = 0.0
+				self.setpoint = None
+				self.safesearch_active = 0
+				self.landing = False
+				self.goal_time = 0.0
+
+				# 'position' streams position setpoints, 'velocity' streams velocity
+				# setpoints whose speed scales with the clearance ahead
+				self.control_mode = rospy.get_param('~control_mode', 'position')
+				self.VELOCITY_LOOKAHEAD = 2.0 # m, target_vector goal distance in velocity mode
+				self.K_POSITION = 1.0 # 1/s, velocity per metre of goal error
+				self.MAX_CRUISE_SPEED = 1.5 # m/s, at or beyond SLOW_DISTANCE of clearance
+				self.MIN_CRUISE_SPEED = 0.2 # m/s, at or below STOP_DISTANCE of clearance
+				self.SLOW_DISTANCE = 6.0 # m
+				self.STOP_DISTANCE = 2.5 # m, same as the explorer DANGER_DISTANCE
+				self.K_YAW_RATE = 0.8 # rad/s per rad of heading error
+				rospy.loginfo("navigator control mode: %s" % self.control_mode)
+				self.t_prev = rospy.get_time()
+
+				# Stamp of the image the current goal came from; cleared once the
+				# first setpoint towards it is out (perception-to-actuation latency)
+				self.tracer = make_tracer('navigator')
+				self.direction_stamp = None
+				self.waypoint_stamp = None
+				self.aruco_stamp = None
+				self.goal_stamp = None
+				self.sub_safesearch=bus.Subscriber("/safesearch/start",Int16, self.safesearch_callback,queue_size=1)
+				self.control_timer = rospy.Timer(rospy.Duration(1.0/self.CONTROL_RATE), self.control_loop)
+
 				
 			
 
@@ -69,6 +116,7 @@ class moveCopter:
 				rot_q =msg.pose.pose.orientation
 				self.msgp.pose.orientation=msg.pose.pose.orientation
 				(self.roll ,self.pitch ,self.yaw)=euler_from_quaternion([rot_q.x ,rot_q.y,rot_q.z ,rot_q.w])
+				self.pose_buffer.addOdometry(msg)
 				print(self.yaw)
 
 
@@ -84,9 +132,46 @@ class moveCopter:
 				self.targ_y=msg.vec_y
 				self.targ_z=msg.vec_z
 				self.rel_yaw = math.atan2(self.targ_y,self.targ_x)
+				self.direction_pose = self.pose_at(msg.header.stamp)
+				self.goal_heading = self.direction_pose[3] + self.rel_yaw
+				self.clearance = msg.clearance
+				self.direction_stamp = msg.header.stamp
+				self.tracer.age('direction_received', msg.header.stamp)
 				self.navigate()
 				# self.rate.sleep()
 
+		def pose_at(self, stamp):
+				'''
+				(x, y, z, yaw) when the frame with this stamp was taken, the
+				latest pose if that isn't known
+				'''
+				pose = None
+				if stamp is not None and not stamp.is_zero():
+					pose = self.pose_buffer.at(stamp.to_sec())
+				if pose is None:
+					return (self.x_pose, self.y_pose, self.z_pose, self.yaw)
+				position, orientation = pose
+				return (position[0], position[1], position[2], orientation[2])
+
+		def waypoint_callback(self,msg):
+				'''
+				Latest waypoint from the global planner (map frame)
+				'''
+				self.waypoint = np.array([msg.point.x, msg.point.y, msg.point.z])
+				self.waypoint_time = rospy.get_time()
+				self.waypoint_stamp = msg.header.stamp
+				self.tracer.age('waypoint_received', msg.header.stamp)
+
+		def safesearch_callback(self,msg):
+				'''
+				safe_move owns the setpoint topic while a survey runs, so streaming
+				pauses and restarts from the current pose afterwards
+				'''
+				self.safesearch_active = msg.data
+				if self.safesearch_active:
+					self.goal_position = None
+					self.setpoint = None
+
 		def aruco_detect_callback(self,msg):
 				'''
 				The local co-ordinates of the targets are read into the variables.
@@ -97,6 +182,8 @@ class moveCopter:
 				self.cY=msg.cY
 				self.distance=msg.distance
 				self.edge_distance=msg.edge_distance
+				self.aruco_stamp = msg.header.stamp
+				self.tracer.age('aruco_received', msg.header.stamp)
 				#print(msg)
 		def navigate(self):
 
@@ -104,17 +191,19 @@ class moveCopter:
 					print("Aruco Marker detected!")
 					print("Aligning with Aruco Marker")
 					Delta = self.distance/3000
+					x, y, z, yaw = self.pose_at(self.aruco_stamp)
 
-					pose_msg = PoseStamped()
+					self.goal_position = np.array([
+						x + (self.cX)*Delta*cos(yaw)+(self.cY)*Delta*sin(yaw),
+						y - (self.cY)*Delta*cos(yaw)+(self.cX)*Delta*sin(yaw),
+						z])
+					self.goal_heading = yaw
+					self.goal_time = rospy.get_time()
+					self.goal_stamp = self.aruco_stamp
 
-					pose_msg.pose.position.x = self.x_pose + (self.cX)*Delta*cos(self.yaw)+(self.cY)*Delta*sin(self.yaw)
-					pose_msg.pose.position.y = self.y_pose - (self.cY)*Delta*cos(self.yaw)+(self.cX)*Delta*sin(self.yaw)  
-					pose_msg.pose.position.z = self.z_pose
-					pose_msg.pose.orientation = self.msgp.pose.orientation
-
-					self.pub_set_point_local.publish(pose_msg)
 					if (self.distance<self.edge_distance):
 						print("Landing")
+						self.landing = True
 						self.setLandMode()
 				else:
 					print("moveTOtarget")
@@ -125,26 +214,109 @@ class moveCopter:
 				Here we find the final global co-ordinates by adding gps pose and message we figured out. 
 				'''
 				# print(self.msgp)
-				q = quaternion_from_euler(0, 0, self.yawPID())
-				# print(q)
 				delta = 0.4
-				delta_x = self.targ_x*np.cos(self.yaw)-self.targ_y*np.sin(self.yaw)
-				delta_y = self.targ_x*np.sin(self.yaw)+self.targ_y*np.cos(self.yaw)
+				if self.control_mode == 'velocity':
+					delta = self.VELOCITY_LOOKAHEAD
+				if self.waypoint is not None and rospy.get_time() - self.waypoint_time < self.WAYPOINT_TIMEOUT:
+					self.move_to_waypoint(delta)
+					return
+				# The direction is relative to the pose its depth frame was taken from
+				x, y, z, yaw = self.direction_pose
+				delta_x = self.targ_x*np.cos(yaw)-self.targ_y*np.sin(yaw)
+				delta_y = self.targ_x*np.sin(yaw)+self.targ_y*np.cos(yaw)
 				delta_x = delta_x*delta
 				delta_y = delta_y*delta
-				self.msgp.pose.position.z=self.z_pose + self.targ_z*delta
-				self.msgp.pose.position.x=self.x_pose + delta_x
-				self.msgp.pose.position.y=self.y_pose + delta_y
-				
+				self.goal_position = np.array([x + delta_x,
+											   y + delta_y,
+											   z + self.targ_z*delta])
+				# print("Target pose")
+				# print(self.goal_position)
+				self.goal_time = rospy.get_time()
+				self.goal_stamp = self.direction_stamp
+
+		def move_to_waypoint(self, delta):
+				'''
+				Head for the planner waypoint, yawing towards it
+				'''
+				step = self.waypoint - np.array([self.x_pose, self.y_pose, self.z_pose])
+				self.goal_position = self.waypoint.copy()
+				self.goal_time = rospy.get_time()
+				self.goal_stamp = self.waypoint_stamp
+				if np.hypot(step[0], step[1]) > delta:
+					self.goal_heading = math.atan2(step[1], step[0])
+
+		def control_loop(self, event):
+				'''
+				Fixed-rate setpoint stream: slew the setpoint towards goal_position
+				at MAX_SPEED and run the yaw PID with the measured period
+				'''
+				now = rospy.get_time()
+				dt = min(now - self.t_prev, 2.0/self.CONTROL_RATE)
+				self.t_prev = now
+				if self.goal_position is None or self.safesearch_active or self.landing or dt <= 0:
+					return
+
+				if self.control_mode == 'velocity':
+					self.stream_velocity(dt)
+					return
+
+				if self.setpoint is None:
+					self.setpoint = np.array([self.x_pose, self.y_pose, self.z_pose])
+				step = self.goal_position - self.setpoint
+				distance = np.linalg.norm(step)
+				if distance > self.MAX_SPEED*dt:
+					step = step*self.MAX_SPEED*dt/distance
+				self.setpoint = self.setpoint + step
+
+				self.rel_yaw = math.atan2(sin(self.goal_heading - self.yaw), cos(self.goal_heading - self.yaw))
+				q = quaternion_from_euler(0, 0, self.yawPID(dt))
+
+				self.msgp.header.stamp = rospy.Time.now()
+				self.msgp.pose.position.x = self.setpoint[0]
+				self.msgp.pose.position.y = self.setpoint[1]
+				self.msgp.pose.position.z = self.setpoint[2]
 				self.msgp.pose.orientation.x = q[0]
 				self.msgp.pose.orientation.y = q[1]
 				self.msgp.pose.orientation.z = q[2]
 				self.msgp.pose.orientation.w = q[3]
 				self.pub_set_point_local.publish(self.msgp)
-				# print("Target pose")
-				# print(self.msgp.pose.position.x, self.msgp.pose.position.y, self.msgp.pose.position.z)
+				self.traceSetpoint()
+
+		def traceSetpoint(self):
+				if self.goal_stamp is not None:
+					self.tracer.age('setpoint', self.goal_stamp)
+					self.goal_stamp = None
+
+		def cruise_speed(self):
+				'''
+				Speed limit interpolated linearly in the clearance reported by the explorer
+				'''
+				fraction = (self.clearance - self.STOP_DISTANCE)/(self.SLOW_DISTANCE - self.STOP_DISTANCE)
+				fraction = min(max(fraction, 0.0), 1.0)
+				return self.MIN_CRUISE_SPEED + fraction*(self.MAX_CRUISE_SPEED - self.MIN_CRUISE_SPEED)
+
+		def stream_velocity(self, dt):
+				'''
+				Velocity setpoint towards goal_position, capped by cruise_speed(), plus
+				a yaw rate towards goal_heading. Stale goals command a hover.
+				'''
+				twist = TwistStamped()
+				twist.header.stamp = rospy.Time.now()
+				if rospy.get_time() - self.goal_time < self.WAYPOINT_TIMEOUT:
+					error = self.goal_position - np.array([self.x_pose, self.y_pose, self.z_pose])
+					distance = np.linalg.norm(error)
+					speed = min(self.K_POSITION*distance, self.cruise_speed())
+					if distance > 0:
+						velocity = error*speed/distance
+						twist.twist.linear.x = velocity[0]
+						twist.twist.linear.y = velocity[1]
+						twist.twist.linear.z = velocity[2]
+					self.rel_yaw = math.atan2(sin(self.goal_heading - self.yaw), cos(self.goal_heading - self.yaw))
+					twist.twist.angular.z = self.K_YAW_RATE*self.rel_yaw
+				self.pub_set_point_vel.publish(twist)
+				self.traceSetpoint()
 
-		def yawPID(self):
+		def yawPID(self, dt):
 		
 			Kp = 0.1
 			Kd = 0
@@ -154,7 +326,6 @@ class moveCopter:
 
 			e = self.rel_yaw
 			#print(e*180/3.14)
-			dt = 1
 
 			P = Kp*e
 			if abs(e) < ERROR_THRESHOLD_FOR_INTEGRATOR and abs(self.I) < WINDUP_THRESHOLD:
@@ -184,6 +355,7 @@ class moveCopter:
 
 if __name__ == '__main__':
 	try:   
+		rospy.init_node('navigator_node')
 		moveCopter()
 		rospy.spin()
 
@@ -0,0 +1,279 @@
+#!/usr/bin/env python
+
+# task: remember obstacles seen by the depth camera across frames
+from __future__ import print_function
+from __future__ import division
+
+import numpy as np
+
+import camera_rays
+from depth_params import ParameterStore
+
+
+def euler_to_rotation(roll, pitch, yaw):
+  '''
+  Rotation matrix for the static xyz euler angles returned by
+  tf.transformations.euler_from_quaternion (R = Rz*Ry*Rx)
+  '''
+  cr, sr = np.cos(roll), np.sin(roll)
+  cp, sp = np.cos(pitch), np.sin(pitch)
+  cy, sy = np.cos(yaw), np.sin(yaw)
+  return np.array([[cy*cp, cy*sp*sr - sy*cr, cy*sp*cr + sy*sr],
+                   [sy*cp, sy*sp*sr + cy*cr, sy*sp*cr - cy*sr],
+                   [-sp,   cp*sr,            cp*cr]])
+
+
+class OccupancyMap:
+  '''
+  Fixed-size log-odds voxel grid that scrolls with the drone.
+
+  Voxels are addressed by their global integer index floor(p/resolution).
+  The storage is a ring buffer: global index i lives in slot i % size, so
+  when the drone moves only the slabs that scroll out of the window (the
+  ones left behind) are cleared and reused. Memory never grows.
+  x and y are centred on the drone, z spans [Z_MIN, Z_MIN + size_z*res).
+  '''
+
+  def __init__(self, resolution=0.2, size_xy=100, size_z=30, z_min=0., rays=None):
+    '''
+    rays: callable returning the unit ray table of the depth images
+    (Helper.imageRays, which follows camera_info); None for a fixed one
+    from the depth_params defaults
+    '''
+    self.RESOLUTION = resolution
+    self.SIZE = np.array([size_xy, size_xy, size_z])
+    self.Z_MIN = z_min
+
+    # Log-odds increments and clamping limits
+    self.L_HIT = 0.85
+    self.L_MISS = -0.4
+    self.L_MIN = -2.0
+    self.L_MAX = 3.5
+    self.L_OCCUPIED = 0.0
+
+    # Depth camera geometry
+    if rays is None:
+      values = ParameterStore().values
+      shape = (values['IMAGE_HEIGHT'], values['IMAGE_WIDTH'])
+      table = camera_rays.ray_table(shape, shape, values['FOCAL_LENGTH'])
+      rays = lambda: table
+    self.rays = rays
+    self.POINTCLOUD_CUTOFF = 10
+    self.CAMERA_OFFSET = camera_rays.CAMERA_OFFSET
+    self.PIXEL_STRIDE = 4
+    self.FREE_RAY_STRIDE = 2 # Free space is traced for every 2nd hit ray per axis
+
+    self.grid = np.zeros(self.SIZE, dtype=np.float32)
+    self.origin = None # Global index of the lowest corner of the window
+    self._pixel_grid = (None, None) # (ray table, grid built from it)
+
+
+  def recentre(self, position):
+    '''
+    Scroll the window so that it stays centred on position, clearing
+    the slots of every voxel that falls out of it
+    '''
+    centre = np.floor(np.asarray(position, dtype=float)/self.RESOLUTION).astype(int)
+    new_origin = centre - self.SIZE//2
+    new_origin[2] = int(np.floor(self.Z_MIN/self.RESOLUTION))
+
+    if self.origin is None:
+      self.origin = new_origin
+      return
+
+    for axis in range(2):
+      shift = new_origin[axis] - self.origin[axis]
+      if shift == 0:
+        continue
+      size = self.SIZE[axis]
+      if abs(shift) >= size:
+        self.grid[...] = 0
+        break
+      if shift > 0:
+        leaving = np.arange(self.origin[axis], self.origin[axis]+shift)
+      else:
+        leaving = np.arange(self.origin[axis]+size+shift, self.origin[axis]+size)
+      index = [slice(None)]*3
+      index[axis] = leaving % size
+      self.grid[tuple(index)] = 0
+
+    self.origin = new_origin
+
+
+  def pixel_grid(self, shape):
+    '''
+    Subsampled pixel rows/columns, their camera-frame direction
+    components per metre of depth and the mask of rays that are also
+    traced through free space, rebuilt when the ray table changes
+    '''
+    table = self.rays()
+    if self._pixel_grid[0] is not table:
+      if table.shape[:2] != tuple(shape):
+        raise ValueError("depth image %dx%d, camera rays %dx%d" % (shape + table.shape[:2]))
+      height, width = shape
+      rows = np.arange(self.PIXEL_STRIDE//2, height, self.PIXEL_STRIDE)
+      cols = np.arange(self.PIXEL_STRIDE//2, width, self.PIXEL_STRIDE)
+      free_rays = np.zeros((rows.size, cols.size), dtype=bool)
+      free_rays[::self.FREE_RAY_STRIDE, ::self.FREE_RAY_STRIDE] = True
+      rows, cols = np.meshgrid(rows, cols, indexing='ij')
+      rows, cols = rows.ravel(), cols.ravel()
+      rays = table[rows, cols]
+      per_metre = rays*camera_rays.depth_scale(rays)[:,None]
+      scale_y, scale_z = per_metre[:,1], per_metre[:,2]
+      self._pixel_grid = (table, (rows, cols, scale_y, scale_z, free_rays.ravel()))
+    return self._pixel_grid[1]
+
+
+  def depth_to_points(self, depth_img, position, orientation):
+    '''
+    Project the subsampled depth image (metres, NaN = nothing in range)
+    into world coordinates.
+    Returns (points, hit, sensor_origin) where hit is False for rays with
+    no return within POINTCLOUD_CUTOFF; those points are placed at the cutoff.
+    '''
+    rows, cols, scale_y, scale_z, _ = self.pixel_grid(depth_img.shape)
+    depth = depth_img[rows, cols].astype(float)
+    hit = np.isfinite(depth) & (depth < self.POINTCLOUD_CUTOFF) & (depth > 0)
+    depth[~hit] = self.POINTCLOUD_CUTOFF
+
+    # Camera frame as in pixel_to_dirn: x forward, y left, z up
+    cam_points = np.empty((depth.size, 3))
+    cam_points[:,0] = depth
+    cam_points[:,1] = depth*scale_y
+    cam_points[:,2] = depth*scale_z
+    cam_points += self.CAMERA_OFFSET
+
+    rotation = euler_to_rotation(*orientation)
+    position = np.asarray(position, dtype=float)
+    points = cam_points.dot(rotation.T) + position
+    sensor_origin = rotation.dot(self.CAMERA_OFFSET) + position
+    return points, hit, sensor_origin
+
+
+  def to_index(self, points):
+    return np.floor(np.asarray(points)/self.RESOLUTION).astype(int)
+
+
+  def in_window(self, index):
+    local = index - self.origin
+    return np.all((local >= 0) & (local < self.SIZE), axis=-1)
+
+
+  def to_slot(self, index):
+    '''
+    Flat storage slot of each global voxel index
+    '''
+    slots = index % self.SIZE
+    return np.ravel_multi_index(slots.T, self.SIZE)
+
+
+  def local_slots(self, points):
+    '''
+    Flat storage slot of world points given per axis as arrays of any
+    (equal) shape; points outside the window get slot grid.size
+    '''
+    n_cells = self.grid.size
+    slots = np.zeros(points[0].shape, dtype=np.int64)
+    outside = np.zeros(points[0].shape, dtype=bool)
+    for axis in range(3):
+      local = np.floor(points[axis]/self.RESOLUTION).astype(np.int64) - self.origin[axis]
+      outside |= (local < 0) | (local >= self.SIZE[axis])
+      local += self.origin[axis] % self.SIZE[axis]
+      local[local >= self.SIZE[axis]] -= self.SIZE[axis]
+      slots *= self.SIZE[axis]
+      slots += local
+    slots[outside] = n_cells
+    return slots
+
+
+  def free_space_slots(self, sensor_origin, points):
+    '''
+    Storage slots of the voxels crossed by the rays sensor_origin->points,
+    excluding the end voxel. All rays are sampled at once at voxel
+    spacing, one axis at a time; samples beyond a ray's own end or outside
+    the window get slot grid.size.
+    '''
+    rays = (points - sensor_origin).astype(np.float32)
+    length = np.sqrt(np.sum(rays*rays, axis=1))
+    rays /= length[:,None]
+
+    steps = self.RESOLUTION*np.arange(int(np.ceil(length.max()/self.RESOLUTION)),
+                                      dtype=np.float32)
+    samples = [sensor_origin[axis] + rays[:,axis,None]*steps[None,:] for axis in range(3)]
+    slots = self.local_slots(samples)
+    slots[steps[None,:] >= (length[:,None] - self.RESOLUTION)] = self.grid.size
+    return slots
+
+
+  def integrate_rays(self, sensor_origin, points, hit, free_rays):
+    '''
+    Log-odds update for one batch of rays. Free space is only traced for
+    the rays selected by free_rays, ray ends are marked for every hit.
+    Every voxel touched by at least one ray in the batch gets a single
+    L_MISS (free) or L_HIT (ray end) update; a voxel that is both the end
+    of one ray and crossed by another counts as a hit.
+    '''
+    n_cells = self.grid.size
+
+    free_slots = self.free_space_slots(sensor_origin, points[free_rays])
+    missed = np.zeros(n_cells+1, dtype=bool)
+    missed[free_slots.ravel()] = True
+
+    hit_points = points[hit].T
+    hit_slots = self.local_slots(hit_points)
+    is_hit = np.zeros(n_cells+1, dtype=bool)
+    is_hit[hit_slots] = True
+    missed &= ~is_hit
+
+    flat = self.grid.reshape(-1)
+    hit_slots = np.flatnonzero(is_hit[:n_cells])
+    miss_slots = np.flatnonzero(missed[:n_cells])
+    flat[hit_slots] = np.minimum(flat[hit_slots] + self.L_HIT, self.L_MAX)
+    flat[miss_slots] = np.maximum(flat[miss_slots] + self.L_MISS, self.L_MIN)
+
+
+  def update(self, depth_img, position, orientation):
+    '''
+    Integrate one depth frame taken at the given pose
+    '''
+    self.recentre(position)
+    points, hit, sensor_origin = self.depth_to_points(depth_img, position, orientation)
+    free_rays = self.pixel_grid(depth_img.shape)[-1]
+    self.integrate_rays(sensor_origin, points, hit, free_rays)
+
+
+  def is_occupied(self, points):
+    '''
+    Occupancy of world points; points outside the window are unknown
+    and reported free
+    '''
+    index = self.to_index(np.atleast_2d(points))
+    occupied = np.zeros(len(index), dtype=bool)
+    inside = self.in_window(index)
+    slots = self.to_slot(index[inside])
+    occupied[inside] = self.grid.reshape(-1)[slots] > self.L_OCCUPIED
+    return occupied
+
+
+  def window(self):
+    '''
+    Log-odds grid rolled so that [0,0,0] is the voxel at self.origin
+    '''
+    shift = tuple(-(self.origin % self.SIZE))
+    return np.roll(self.grid, shift, axis=(0, 1, 2))
+
+
+  def occupied_window(self):
+    return self.window() > self.L_OCCUPIED
+
+
+  def occupied_points(self, z_low=-np.inf, z_high=np.inf):
+    '''
+    World centres (N,3) of the occupied voxels in the window whose
+    centre lies in [z_low, z_high)
+    '''
+    if self.origin is None:
+      return np.zeros((0, 3))
+    index = np.argwhere(self.occupied_window()) + self.origin
+    centres = (index + 0.5)*self.RESOLUTION
+    return centres[(centres[:,2] >= z_low) & (centres[:,2] < z_high)]
@@ -0,0 +1,315 @@
+#!/usr/bin/env python
+
+# task: global waypoint planning over the occupancy map (D* Lite)
+from __future__ import print_function
+from __future__ import division
+
+import heapq
+import itertools
+
+import numpy as np
+import scipy.ndimage
+
+
+INF = float('inf')
+
+# 26-connected neighbourhood and the length of each step (in cells)
+NEIGHBOURS = [d for d in itertools.product((-1, 0, 1), repeat=3) if d != (0, 0, 0)]
+STEP_COST = [np.sqrt(dx*dx + dy*dy + dz*dz) for dx, dy, dz in NEIGHBOURS]
+
+
+class DStarLite:
+  '''
+  D* Lite (Koenig & Likhachev, optimized version) on an unbounded 3-D
+  grid of integer cells. Blocked cells are kept in a set; everything
+  else is free. Cells above/below the [z_low, z_high] cell range are
+  blocked, which is how the flight ceiling is enforced.
+
+  The search runs backwards from the goal, so when the start moves or
+  cells change state only the affected part of the tree is repaired
+  (update_cells) instead of replanning from scratch.
+  '''
+
+  def __init__(self, z_low, z_high, max_expansions=20000):
+    self.Z_LOW = z_low
+    self.Z_HIGH = z_high
+    self.MAX_EXPANSIONS = max_expansions
+    self.blocked = set()
+    self.goal = None
+    self.start = None
+    self.expansions = 0
+
+
+  def is_blocked(self, cell):
+    return cell in self.blocked or not (self.Z_LOW <= cell[2] <= self.Z_HIGH)
+
+
+  def heuristic(self, a, b):
+    dx, dy, dz = a[0]-b[0], a[1]-b[1], a[2]-b[2]
+    return np.sqrt(dx*dx + dy*dy + dz*dz)
+
+
+  def neighbours(self, cell):
+    '''
+    (neighbour, edge cost) pairs; edges touching a blocked cell cost INF
+    '''
+    x, y, z = cell
+    cell_blocked = self.is_blocked(cell)
+    for (dx, dy, dz), cost in zip(NEIGHBOURS, STEP_COST):
+      other = (x+dx, y+dy, z+dz)
+      if cell_blocked or self.is_blocked(other):
+        yield other, INF
+      else:
+        yield other, cost
+
+
+  def reset(self, start, goal):
+    self.start = start
+    self.goal = goal
+    self.last_start = start
+    self.km = 0.
+    self.g = {}
+    self.rhs = {goal: 0.}
+    self.open = {}
+    self.heap = []
+    self.push(goal)
+
+
+  def calculate_key(self, cell):
+    best = min(self.g.get(cell, INF), self.rhs.get(cell, INF))
+    return (best + self.heuristic(self.start, cell) + self.km, best)
+
+
+  def push(self, cell):
+    key = self.calculate_key(cell)
+    self.open[cell] = key
+    heapq.heappush(self.heap, (key, cell))
+
+
+  def update_vertex(self, cell):
+    if cell != self.goal:
+      self.rhs[cell] = min(cost + self.g.get(other, INF)
+                           for other, cost in self.neighbours(cell))
+    self.open.pop(cell, None)
+    if self.g.get(cell, INF) != self.rhs.get(cell, INF):
+      self.push(cell)
+
+
+  def top_key(self):
+    # Lazy deletion: skip heap entries that were superseded or removed
+    while self.heap:
+      key, cell = self.heap[0]
+      if self.open.get(cell) == key:
+        return key
+      heapq.heappop(self.heap)
+    return (INF, INF)
+
+
+  def compute_shortest_path(self):
+    '''
+    Returns False when the expansion budget ran out before the start
+    became consistent
+    '''
+    self.expansions = 0
+    while (self.top_key() < self.calculate_key(self.start)
+           or self.rhs.get(self.start, INF) != self.g.get(self.start, INF)):
+      if self.expansions >= self.MAX_EXPANSIONS:
+        return False
+      self.expansions += 1
+      key_old, cell = heapq.heappop(self.heap)
+      del self.open[cell]
+      key_new = self.calculate_key(cell)
+      g_cell, rhs_cell = self.g.get(cell, INF), self.rhs.get(cell, INF)
+
+      if key_old < key_new:
+        self.push(cell)
+      elif g_cell > rhs_cell:
+        # Overconsistent: settle g and relax the predecessors
+        self.g[cell] = rhs_cell
+        for other, cost in self.neighbours(cell):
+          if other != self.goal and cost + rhs_cell < self.rhs.get(other, INF):
+            self.rhs[other] = cost + rhs_cell
+            self.open.pop(other, None)
+            if self.g.get(other, INF) != self.rhs[other]:
+              self.push(other)
+      else:
+        # Underconsistent: invalidate and recompute the dependents
+        self.g[cell] = INF
+        self.update_vertex(cell)
+        for other, _ in self.neighbours(cell):
+          if other in self.rhs:
+            self.update_vertex(other)
+    return True
+
+
+  def move_start(self, start):
+    self.km += self.heuristic(self.last_start, start)
+    self.last_start = start
+    self.start = start
+
+
+  def update_cells(self, newly_blocked, newly_freed):
+    '''
+    Apply map changes and repair every changed cell and its neighbours.
+    A freed cell was never expanded while it was blocked, so it has no
+    rhs entry yet, and it is exactly the cell that can open a shorter
+    path.
+    '''
+    changed = set(newly_blocked) | set(newly_freed)
+    self.blocked |= set(newly_blocked)
+    self.blocked -= set(newly_freed)
+    if self.goal is None:
+      return
+    touched = set()
+    for cell in changed:
+      touched.add(cell)
+      for other, _ in self.neighbours(cell):
+        touched.add(other)
+    for cell in touched:
+      self.update_vertex(cell)
+
+
+  def path(self, max_length=200):
+    '''
+    Greedy descent of g from the start; empty if there is no path
+    '''
+    if self.g.get(self.start, INF) == INF:
+      return []
+    cell = self.start
+    path = [cell]
+    while cell != self.goal and len(path) < max_length:
+      best, best_cost = None, INF
+      for other, cost in self.neighbours(cell):
+        total = cost + self.g.get(other, INF)
+        if total < best_cost:
+          best, best_cost = other, total
+      if best is None:
+        return []
+      cell = best
+      path.append(cell)
+    return path
+
+
+class WaypointPlanner:
+  '''
+  Keeps a D* Lite search in sync with the occupancy map and turns the
+  current plan into a single waypoint a short distance ahead.
+
+  Planning runs on cells of PLAN_RESOLUTION (an integer multiple of the
+  map resolution); a planning cell is blocked if any map voxel in it,
+  grown by INFLATION cells, is occupied. Unknown space is treated as free.
+  '''
+
+  def __init__(self, occupancy_map, plan_resolution=0.4):
+    self.map = occupancy_map
+    self.PLAN_RESOLUTION = plan_resolution
+    self.FACTOR = int(round(plan_resolution/occupancy_map.RESOLUTION))
+
+    self.CEILING = 5.0 # Flight is restricted to 5 m (problem statement)
+    self.FLOOR = 0.5
+    self.INFLATION = 1 # Planning cells of clearance around obstacles
+    self.LOOKAHEAD = 1.2 # m, distance of the published waypoint
+    self.GOAL_DISTANCE = 8. # m, how far ahead a goal direction is projected
+    self.REACHED_DISTANCE = 2. # m, a new goal is picked once this close
+    self.REGOAL_ANGLE = np.radians(40) # direction change that picks a new goal
+
+    # Expansions per frame; an unfinished search resumes on the next frame
+    self.MAX_EXPANSIONS = 5000
+
+    self.dstar = DStarLite(z_low=int(np.ceil(self.FLOOR/plan_resolution)),
+                           z_high=int(np.floor(self.CEILING/plan_resolution)) - 1,
+                           max_expansions=self.MAX_EXPANSIONS)
+    self.goal_point = None
+
+
+  def to_cell(self, point):
+    return tuple(int(c) for c in np.floor(np.asarray(point)/self.PLAN_RESOLUTION))
+
+
+  def to_point(self, cell):
+    return (np.asarray(cell) + 0.5)*self.PLAN_RESOLUTION
+
+
+  def blocked_cells(self):
+    '''
+    Set of planning cells that are blocked in the current map window
+    '''
+    occupied = self.map.occupied_window()
+    factor = self.FACTOR
+
+    # Crop the window so that its blocks line up with global planning cells
+    first = (-self.map.origin) % factor
+    occupied = occupied[first[0]:, first[1]:, first[2]:]
+    shape = np.array(occupied.shape)//factor
+    occupied = occupied[:shape[0]*factor, :shape[1]*factor, :shape[2]*factor]
+    coarse = occupied.reshape(shape[0], factor, shape[1], factor,
+                              shape[2], factor).any(axis=(1, 3, 5))
+    if self.INFLATION:
+      coarse = scipy.ndimage.binary_dilation(
+          coarse, structure=np.ones((3, 3, 3), dtype=bool), iterations=self.INFLATION)
+
+    origin = (self.map.origin + first)//factor
+    cells = np.argwhere(coarse) + origin
+    return set(map(tuple, cells.tolist()))
+
+
+  def clamp_goal(self, point):
+    point = np.array(point, dtype=float)
+    point[2] = np.clip(point[2], self.FLOOR + self.PLAN_RESOLUTION,
+                       self.CEILING - self.PLAN_RESOLUTION)
+    return point
+
+
+  def plan(self, position, goal_point):
+    '''
+    Repair the plan from position to goal_point after a map update, or
+    start a fresh search if the goal cell changed. Returns the next
+    waypoint as a world point, or None when there is no path (yet).
+    '''
+    start = self.to_cell(position)
+    goal = self.to_cell(self.clamp_goal(goal_point))
+
+    blocked = self.blocked_cells()
+    if goal != self.dstar.goal:
+      self.dstar.blocked = blocked
+      self.dstar.reset(start, goal)
+    else:
+      if start != self.dstar.start:
+        self.dstar.move_start(start)
+      self.dstar.update_cells(blocked - self.dstar.blocked,
+                              self.dstar.blocked - blocked)
+    if goal in blocked or start in blocked:
+      return None
+
+    if not self.dstar.compute_shortest_path():
+      return None
+    path = self.dstar.path()
+    if not path:
+      return None
+
+    lookahead = max(1, int(round(self.LOOKAHEAD/self.PLAN_RESOLUTION)))
+    return self.to_point(path[min(lookahead, len(path)-1)])
+
+
+  def plan_along(self, position, direction):
+    '''
+    Plan towards a goal GOAL_DISTANCE ahead along a world-frame direction.
+    The goal is held (so the search can be repaired incrementally) until
+    it is reached, becomes blocked or the direction swings by more than
+    REGOAL_ANGLE.
+    '''
+    position = np.asarray(position, dtype=float)
+    direction = np.asarray(direction, dtype=float)
+    direction = direction/np.linalg.norm(direction)
+
+    if self.goal_point is not None:
+      to_goal = self.goal_point - position
+      distance = np.linalg.norm(to_goal)
+      if (distance < self.REACHED_DISTANCE
+          or np.dot(to_goal, direction) < distance*np.cos(self.REGOAL_ANGLE)
+          or self.to_cell(self.goal_point) in self.dstar.blocked):
+        self.goal_point = None
+    if self.goal_point is None:
+      self.goal_point = self.clamp_goal(position + self.GOAL_DISTANCE*direction)
+
+    return self.plan(position, self.goal_point)
@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+
+# task: look up the drone pose at the time a frame was taken
+from __future__ import print_function
+from __future__ import division
+
+import bisect
+import collections
+import threading
+
+import numpy as np
+from tf.transformations import euler_from_quaternion, quaternion_slerp
+
+
+class PoseBuffer:
+  '''
+  Ring of the last CAPACITY odometry poses indexed by their header stamp.
+  at(stamp) interpolates the pose at an image stamp (linear in position,
+  slerp in orientation), so a frame is processed with the pose it was
+  taken from rather than the latest one.
+  Stamps before the oldest or after the newest pose get the nearest pose.
+  '''
+
+  def __init__(self, capacity=200):
+    self.CAPACITY = capacity
+    self.times = collections.deque(maxlen=capacity)
+    self.positions = collections.deque(maxlen=capacity)
+    self.quaternions = collections.deque(maxlen=capacity)
+    self.lock = threading.Lock()
+
+
+  def add(self, stamp, position, quaternion):
+    '''
+    stamp in seconds; odometry arriving out of order is dropped
+    '''
+    with self.lock:
+      if self.times and stamp <= self.times[-1]:
+        return
+      self.times.append(stamp)
+      self.positions.append(np.array(position, dtype=float))
+      self.quaternions.append(np.array(quaternion, dtype=float))
+
+
+  def addOdometry(self, odom_msg):
+    pose = odom_msg.pose.pose
+    self.add(odom_msg.header.stamp.to_sec(),
+             [pose.position.x, pose.position.y, pose.position.z],
+             [pose.orientation.x, pose.orientation.y,
+              pose.orientation.z, pose.orientation.w])
+
+
+  def at(self, stamp):
+    '''
+    (position (3,), (roll, pitch, yaw)) at stamp in seconds, or None if
+    no odometry arrived yet
+    '''
+    with self.lock:
+      if not self.times:
+        return None
+      i = bisect.bisect_left(self.times, stamp)
+      if i == 0:
+        position, quaternion = self.positions[0], self.quaternions[0]
+      elif i == len(self.times):
+        position, quaternion = self.positions[-1], self.quaternions[-1]
+      else:
+        t0, t1 = self.times[i-1], self.times[i]
+        fraction = (stamp - t0)/(t1 - t0)
+        position = (1 - fraction)*self.positions[i-1] + fraction*self.positions[i]
+        quaternion = quaternion_slerp(self.quaternions[i-1], self.quaternions[i], fraction)
+    return position.copy(), euler_from_quaternion(quaternion)
@@ -12,6 +12,7 @@ from nav_msgs.msg import *
 from drdo_exploration.msg import teleopData
 from mavros_msgs.srv import SetMode, CommandBool, CommandTOL
 from std_msgs.msg import Int16
+from latency_tracer import make_tracer
 #from geometry_msgs import PoseStamped
 class navigation:
     def __init__(self):
@@ -34,6 +35,8 @@ class navigation:
         self.sub_safesaerch_start=rospy.Subscriber("/safesearch/start",Int16,self.safesearch_start_callback,queue_size=1)
         self.subl2=rospy.Subscriber("/safesearch/teleop",teleopData,self.decision_calback,queue_size=1)
         self.msgp=PoseStamped()
+        self.tracer=make_tracer('safe_move')
+        self.teleop_stamp=None
 
 
     def safesearch_start_callback(self,msg):
@@ -53,6 +56,8 @@ class navigation:
     def decision_calback(self,msg):
         self.decision=msg.decision
         self.delta=msg.delta
+        self.teleop_stamp=msg.header.stamp
+        self.tracer.age('teleop_received',msg.header.stamp)
 
     def gps_data_callback(self,msg):
         self.x = msg.pose.pose.position.x   
@@ -82,10 +87,12 @@ class navigation:
             if (self.decision==4):
                 self.set_z()
                 self.pub_set_point_local.publish(self.msgp)
+                self.tracer.age('teleop_setpoint',self.teleop_stamp)
                 self.decision=0
             elif (self.decision==5) :
                 self.move_yaw()
                 self.pub_set_point_local.publish(self.msgp)
+                self.tracer.age('teleop_setpoint',self.teleop_stamp)
                 self.decision=0
             self.rate.sleep()
         
@@ -13,8 +13,12 @@ from cv_bridge import CvBridge, CvBridgeError
 from geometry_msgs.msg import PoseStamped
 from nav_msgs.msg import Odometry
 from drdo_exploration.msg import aruco_detect
+from latency_tracer import make_tracer
 
-def callback_opencv(data):
+def detect_aruco(data):
+	'''
+	aruco_detect message for the marker with id 0 in an RGB image message
+	'''
 	bridge = CvBridge()
 	img = bridge.imgmsg_to_cv2(data, "bgr8")
 
@@ -30,6 +34,7 @@ def callback_opencv(data):
 	#cv2.circle(img,(img.shape[1]//2,img.shape[0]//2),4,(255,0,0),-1)
 
 	aruco = aruco_detect()
+	aruco.header.stamp = data.header.stamp
 	print("aruco",aruco)
 	aruco.cX = 0.0
 	aruco.cY = 0.0
@@ -84,14 +89,28 @@ def callback_opencv(data):
 			aruco.distance = distance
 			aruco.edge_distance=edge_distance
 
-	pub_aruco_detect.publish(aruco)
+	return aruco
 
 
+class ArucoScanner:
+	def __init__(self, bus=rospy):
+		'''
+		bus is the transport providing Publisher/Subscriber (rospy or a MessageBus)
+		'''
+		self.pub_aruco_detect = bus.Publisher("/aruco_detect", aruco_detect,queue_size=10)
+		bus.Subscriber("/camera/color/image_raw/", Image, self.callback_opencv)
+		self.tracer = make_tracer('aruco_lander')
+
+	def callback_opencv(self, data):
+		with self.tracer.timed('detect'):
+			aruco = detect_aruco(data)
+		self.pub_aruco_detect.publish(aruco)
+		self.tracer.age('aruco_published', data.header.stamp)
+
 
 if __name__ == '__main__':
 
 	 rospy.init_node('aruco_detector', anonymous=True)
-	 pub_aruco_detect = rospy.Publisher("/aruco_detect", aruco_detect,queue_size=10)
-	 rospy.Subscriber("/camera/color/image_raw/", Image, callback_opencv)
+	 ArucoScanner()
 	 
 	 rospy.spin()
\ No newline at end of file
@@ -0,0 +1,197 @@
+#!/usr/bin/env python
+
+# task: read obstacle layouts out of the gazebo .world files (no ROS needed)
+from __future__ import print_function
+from __future__ import division
+
+import xml.etree.ElementTree as ET
+
+import numpy as np
+
+from occupancy_map import euler_to_rotation
+from depth_renderer import DepthRenderer
+
+
+def parse_pose(text):
+  '''
+  SDF "x y z roll pitch yaw" -> 4x4 homogeneous transform
+  '''
+  values = [float(v) for v in text.split()] if text else [0.]*6
+  values += [0.]*(6-len(values))
+  transform = np.eye(4)
+  transform[:3,:3] = euler_to_rotation(*values[3:6])
+  transform[:3,3] = values[:3]
+  return transform
+
+
+def element_pose(element):
+  return parse_pose(element.findtext('pose'))
+
+
+class WorldModel:
+  '''
+  Static obstacles of a world file as oriented boxes and cylinders,
+  plus the drone spawn pose and the position of the target marker.
+
+  boxes:     list of (4x4 world transform, half extents (3,))
+  cylinders: list of (4x4 world transform, radius, half length), axis = local z
+  '''
+  IGNORED_MODELS = ('iris', 'ground_plane')
+  TARGET_MARKER = 'aruco_visual_marker_0'
+
+  def __init__(self, path):
+    self.path = path
+    self.boxes = []
+    self.cylinders = []
+    self.spawn = np.zeros(4) # x, y, z, yaw
+    self.marker = None
+
+    world = ET.parse(path).getroot().find('world')
+    state_links, state_models = self.read_state(world)
+
+    for model in world.findall('model'):
+      name = model.get('name')
+      model_pose = state_models.get(name, element_pose(model))
+
+      uri = model.findtext('include/uri') or ''
+      if name == 'iris':
+        pose = element_pose(model) if name not in state_models else model_pose
+        yaw = np.arctan2(pose[1,0], pose[0,0])
+        self.spawn = np.array([pose[0,3], pose[1,3], pose[2,3], yaw])
+      if name == self.TARGET_MARKER or uri.endswith(self.TARGET_MARKER):
+        self.marker = model_pose[:3,3].copy()
+      if name in self.IGNORED_MODELS or name.startswith('aruco') or uri:
+        continue
+
+      for link in model.findall('link'):
+        link_pose = state_links.get((name, link.get('name')))
+        if link_pose is None:
+          link_pose = model_pose.dot(element_pose(link))
+        for collision in link.findall('collision'):
+          self.add_geometry(link_pose.dot(element_pose(collision)),
+                            collision.find('geometry'))
+
+
+  def read_state(self, world):
+    '''
+    World-frame model and link poses saved by gazebo in <state>, which
+    take precedence over the poses in the model definitions
+    '''
+    links, models = {}, {}
+    state = world.find('state')
+    if state is None:
+      return links, models
+    for model in state.findall('model'):
+      name = model.get('name')
+      models[name] = element_pose(model)
+      for link in model.findall('link'):
+        links[(name, link.get('name'))] = element_pose(link)
+    return links, models
+
+
+  def add_geometry(self, pose, geometry):
+    if geometry is None:
+      return
+    box = geometry.find('box')
+    cylinder = geometry.find('cylinder')
+    if box is not None:
+      size = np.array([float(v) for v in box.findtext('size').split()])
+      self.boxes.append((pose, size/2.))
+    elif cylinder is not None:
+      self.cylinders.append((pose, float(cylinder.findtext('radius')),
+                             float(cylinder.findtext('length'))/2.))
+
+
+  def bounds(self, margin=2.):
+    '''
+    Axis-aligned (lower, upper) corners enclosing all obstacles,
+    the spawn point and the marker
+    '''
+    corners = [self.spawn[:3]]
+    if self.marker is not None:
+      corners.append(self.marker)
+    for pose, half in self.boxes:
+      extent = np.abs(pose[:3,:3]).dot(half)
+      corners += [pose[:3,3] - extent, pose[:3,3] + extent]
+    for pose, radius, half_length in self.cylinders:
+      extent = np.abs(pose[:3,:3]).dot([radius, radius, half_length])
+      corners += [pose[:3,3] - extent, pose[:3,3] + extent]
+    corners = np.array(corners)
+    return corners.min(axis=0) - margin, corners.max(axis=0) + margin
+
+
+  def contains(self, points):
+    '''
+    True for every world point (N,3) that lies inside an obstacle
+    '''
+    points = np.asarray(points, dtype=float)
+    inside = np.zeros(len(points), dtype=bool)
+    for pose, half in self.boxes:
+      local = (points - pose[:3,3]).dot(pose[:3,:3])
+      inside |= np.all(np.abs(local) <= half, axis=1)
+    for pose, radius, half_length in self.cylinders:
+      local = (points - pose[:3,3]).dot(pose[:3,:3])
+      inside |= ((local[:,0]**2 + local[:,1]**2 <= radius**2)
+                 & (np.abs(local[:,2]) <= half_length))
+    return inside
+
+
+  def occupancy_grid(self, resolution, z_max=6.):
+    '''
+    Boolean voxel grid of the obstacles over bounds() (clipped to
+    0 <= z < z_max), sampled at voxel centres.
+    Returns (grid, origin) with origin the world position of voxel [0,0,0]'s
+    lower corner, a multiple of resolution.
+    '''
+    lower, upper = self.bounds()
+    lower[2], upper[2] = 0., z_max
+    lower = resolution*np.floor(lower/resolution) # Align with the global voxel grid
+    shape = np.ceil((upper - lower)/resolution).astype(int)
+    axes = [lower[i] + resolution*(0.5 + np.arange(shape[i])) for i in range(3)]
+    centres = np.stack(np.meshgrid(*axes, indexing='ij'), axis=-1).reshape(-1, 3)
+    grid = self.contains(centres).reshape(shape)
+    return grid, lower
+
+
+  def render_depth(self, position, orientation, shape=(480, 640), stride=4,
+                   focal_length=554.25, cutoff=10., camera_offset=(0.1, 0., 0.)):
+    '''
+    Depth image (metres along the optical axis, NaN beyond cutoff) the
+    depth camera would see from a base_link pose, ray cast against every
+    obstacle and the ground. Rays are cast for every stride-th pixel and
+    repeated over the block. Every ray is tested against every obstacle;
+    DepthRenderer is the fast version for many frames of one world.
+    '''
+    rotation = euler_to_rotation(*orientation)
+    origin = np.asarray(position, dtype=float) + rotation.dot(camera_offset)
+    height, width = shape
+    rows = np.arange(stride//2, height, stride)
+    cols = np.arange(stride//2, width, stride)
+    cols, rows = np.meshgrid(cols, rows)
+    # Camera frame rays with unit x, so the ray parameter is the depth
+    rays = np.stack([np.ones(rows.shape), -(cols - width//2)/focal_length,
+                     -(rows - height//2)/focal_length], axis=-1).reshape(-1, 3)
+    rays = rays.dot(rotation.T)
+
+    depth = np.full(len(rays), np.inf)
+    with np.errstate(divide='ignore', invalid='ignore'):
+      down = rays[:,2] < 0
+      depth[down] = -origin[2]/rays[down,2]
+
+      for pose, half in self.boxes:
+        if np.linalg.norm(pose[:3,3] - origin) - np.linalg.norm(half) > cutoff:
+          continue
+        local_origin = (origin - pose[:3,3]).dot(pose[:3,:3])
+        depth = np.minimum(depth, DepthRenderer.intersect_box(
+            local_origin, rays.dot(pose[:3,:3]).T, half))
+
+      for pose, radius, half_length in self.cylinders:
+        if np.linalg.norm(pose[:3,3] - origin) - np.hypot(radius, half_length) > cutoff:
+          continue
+        local_origin = (origin - pose[:3,3]).dot(pose[:3,:3])
+        depth = np.minimum(depth, DepthRenderer.intersect_cylinder(
+            local_origin, rays.dot(pose[:3,:3]).T, radius, half_length))
+
+    depth[depth > cutoff] = np.nan
+    depth = depth.reshape(len(rows), -1).astype(np.float32)
+    return np.repeat(np.repeat(depth, stride, axis=0), stride, axis=1)[:height, :width]
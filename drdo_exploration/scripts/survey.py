@@ -2,7 +2,10 @@
 import rospy
 import numpy as np
 from drdo_exploration.msg import teleopData
+from drdo_exploration.msg import depth_target
 from helper2 import Helper
+from pose_buffer import PoseBuffer
+from latency_tracer import make_tracer
 from sensor_msgs.msg import Image
 from std_msgs.msg import Int16
 import time
@@ -47,82 +50,133 @@ def findLIS(A, n):
 		return check
 
 class Survey(Helper):
-	def __init__(self):
+	def __init__(self, bus=rospy, subscribe_depth=True, shared_preprocessing=False, strategy='anytime'):
+		'''
+		bus: transport providing Publisher/Subscriber (rospy or a MessageBus)
+		subscribe_depth: False when decoded frames are fed to processDepth
+		by the composed runner instead
+		shared_preprocessing: take the target from depth_preprocessor on
+		/depth/target instead of processing depth frames here
+		strategy: 'anytime' tries yaw steps nearest the current heading first
+		and stops at the first clear run, 'sweep' runs the full sweeps
+		'''
 		global final, length, check2, arr
 		self.curr_position = np.zeros(3)
 		self.curr_orientation = np.zeros(3)
+		self.pose_buffer = PoseBuffer()
 		self.init_pose = None
 		self.pc2_arr = None
 		self.listener = tf.TransformListener()
-			 
-		rospy.Subscriber('/mavros/global_position/local', Odometry, self.positionCallback,queue_size=1)
 
-		rospy.Subscriber('/depth_camera/depth/image_raw', Image, self.ImageCallback, queue_size=1)
-		rospy.Subscriber("/safesearch/start", Int16, self.start_survey_callback,queue_size=1) 
+		self.drone_move_pub = bus.Publisher('/safesearch/teleop',teleopData,queue_size = 1)  
+		self.safesearch_complete_pub = bus.Publisher('/safesearch/complete',Int16 ,queue_size=1)
 
-		self.drone_move_pub = rospy.Publisher('/safesearch/teleop',teleopData,queue_size = 1)  
-		self.safesearch_complete_pub = rospy.Publisher('/safesearch/complete',Int16 ,queue_size=1)
-
-		self.survey_flag = 0
-		self.indicator =  0
 		self.safesearch_complete_flag = Int16()
 		self.defineParameters()
+		self.watchParameters(bus)
 
 		self.rate = rospy.Rate(10)
 
-		self.CONE = 120.0 #130
-		self.NO_OF_POINTS_TO_CHECK = 11  #int((self.CONE/self.STEP_SIZE)) + 1
-		self.STEP_SIZE = self.CONE / float(self.NO_OF_POINTS_TO_CHECK - 1) 
+		self.defineSurveyParameters(strategy)
+		self.defineSurveyState()
+		self.frame_stamp = rospy.Time()
+		self.tracer = make_tracer('survey')
+
+		bus.Subscriber('/mavros/global_position/local', Odometry, self.positionCallback,queue_size=1)
+
+		if shared_preprocessing:
+			bus.Subscriber('/depth/target', depth_target, self.targetCallback, queue_size=1)
+		elif subscribe_depth:
+			bus.Subscriber('/depth_camera/depth/image_raw', Image, self.ImageCallback, queue_size=1)
+		bus.Subscriber("/safesearch/start", Int16, self.start_survey_callback,queue_size=1)
+
+		self.survey_timer = rospy.Timer(rospy.Duration(0.1), self.stepSurvey)
 
+	def defineSurveyState(self):
+		'''
+		Survey state machine at rest (no ROS needed either)
+		'''
+		self.survey_flag = 0
+		self.indicator =  0
 		self.new_waypoint_found = bool()
 		self.target = None
 		self.intensity_at_target = None
 		self.target_array = [None]* self.NO_OF_POINTS_TO_CHECK
 		self.target_intensity_array = [None]*self.NO_OF_POINTS_TO_CHECK
 		#self.target_xyz_array = np.zeros(18)#shape 18 values
-		self.THRESHOLD_INTENSITY = 0.25 * np.ones(len(self.target_intensity_array))#tunable parameter
-		
-
 
 		self.best_intensity_index = None
 		self.best_yaw_angle = None
 		self.direction = None
 
-	def positionCallback(self, local_pose_msg):
-		global final, length, check2, arr
-		self.curr_position = [local_pose_msg.pose.pose.position.x,
-							local_pose_msg.pose.pose.position.y,
-							local_pose_msg.pose.pose.position.z]
-		quaternion = [local_pose_msg.pose.pose.orientation.x,
-					 local_pose_msg.pose.pose.orientation.y,
-					 local_pose_msg.pose.pose.orientation.z,
-					 local_pose_msg.pose.pose.orientation.w]
-
-		self.curr_orientation = tf.transformations.euler_from_quaternion(quaternion)    
-
-	
-
+		self.virtual_intensity = {}
+		self.virtual_arrays = {}
+		self.predicted_angle = None
+
+		self.state = self.IDLE
+		self.state_start = self.now()
+		self.state_durations = {}
+		self.survey_start = self.state_start
+		self.dwell = 0.
+		self.plan = self.sweepPlan()
+		self.sweep_index = 0
+		self.yaw_step = 0
+		self.current_angle = 0.
+		self.samples_evaluated = 0
+
+	def defineSurveyParameters(self, strategy='anytime'):
+		'''
+		Survey geometry and decision tunables (no ROS needed, so the
+		kinematic simulator can run the same survey decisions)
+		'''
+		self.CONE = 120.0 #130
+		self.NO_OF_POINTS_TO_CHECK = 11  #int((self.CONE/self.STEP_SIZE)) + 1
+		self.STEP_SIZE = self.CONE / float(self.NO_OF_POINTS_TO_CHECK - 1) 
+		self.THRESHOLD_INTENSITY = 0.25 * np.ones(self.NO_OF_POINTS_TO_CHECK)#tunable parameter
+
+		# Survey state machine, stepped by a timer instead of sleeping in
+		# the /safesearch/start callback
+		self.IDLE, self.CLIMB, self.ALIGN, self.YAW_STEP = 'IDLE', 'CLIMB', 'ALIGN', 'YAW_STEP'
+		self.EVALUATE, self.COMMIT, self.FALLBACK_ALTITUDE = 'EVALUATE', 'COMMIT', 'FALLBACK_ALTITUDE'
+		# Seconds to wait in a state for safe_move to finish the command
+		self.STATE_DWELL = {self.CLIMB: 4., self.FALLBACK_ALTITUDE: 4., self.ALIGN: 4.,
+		                    self.YAW_STEP: 2., self.COMMIT: 4.}
+		# Height of the first sweep; the fallbacks fly to the VIRTUAL_ALTITUDES
+		# depth tunable (see sweeps)
+		self.SURVEY_HEIGHT = 2.5
+		self.strategy = strategy
+		# Adjacent good yaw steps that end a sweep early (None = full sweep,
+		# as the original survey that strategy sweep keeps)
+		self.EARLY_EXIT_RUN = 4 if strategy == 'anytime' else None
+		# Pick the fallback altitude from the frames of the failed cone
+		# (virtualAltitudeIntensity) instead of flying to each one to look;
+		# anytime only as well
+		self.VIRTUAL_ALTITUDE = strategy == 'anytime'
+
+	def sweeps(self):
+		'''
+		(height, initial yaw, sweep direction) of the sweep and its
+		fallbacks, which alternate direction
+		'''
+		fallbacks = [(height, 0, -1 if i % 2 == 0 else 1)
+		             for i, height in enumerate(self.VIRTUAL_ALTITUDES)]
+		return [(self.SURVEY_HEIGHT, -1*(self.CONE/2.0), 1)] + fallbacks
 
 	def ImageCallback(self, img_msg):
-		global final, length, check2, arr
-		bridge = CvBridge()
-		img_msg.encoding = "32FC1"
-		try:
-			cv_img = bridge.imgmsg_to_cv2(img_msg, img_msg.encoding)
-		except CvBridgeError as e:
-			print(e)
+		cv_image_array = self.decodeDepth(img_msg)
+		if cv_image_array is None:
 			return
+		return self.processDepth(cv_image_array, img_msg.header.stamp)
 
-		cv_image_array = np.array(cv_img, dtype = np.dtype('f8'))
-		cv_image_norm = cv_image_array/self.POINTCLOUD_CUTOFF
-		cleaned_cv_img = cv_image_norm.copy()
-		cleaned_cv_img[np.isnan(cleaned_cv_img)] = 1.0
-		cleaned_cv_img = self.filterSkyGround(cleaned_cv_img)
-		penalized_cv_img = self.calculatePenalty(cleaned_cv_img)
+	def processDepth(self, cv_image_array, stamp):
+		global final, length, check2, arr
+		self.frame_stamp = stamp
+		penalized_cv_img, self.target = self.preprocessDepth(cv_image_array, stamp)
 		# collision_cv_img = self.collision_avoidance(cleaned_cv_img)
-		self.target, _ = self.findTarget(penalized_cv_img, cleaned_cv_img)
 		#print("target pixel" , self.target)
 		self.intensity_at_target = penalized_cv_img[self.target[0],self.target[1]]
+		self.virtual_intensity = dict((altitude, self.virtualAltitudeIntensity(penalized_cv_img, altitude))
+		                              for altitude in self.VIRTUAL_ALTITUDES)
 		#print("intensity_at_target pixel",self.intensity_at_target)
 		# dest_cv_img = cv2.circle(penalized_cv_img, (self.target[1],self.target[0]), 20, 0, -1)
 		# dest_cv_img = cv2.circle(penalized_cv_img, (self.target[1],self.target[0]), 10, 1, -1)
@@ -131,6 +185,18 @@ class Survey(Helper):
 		# cv2.waitKey(1)
 		return self.target 
 
+	def targetCallback(self, target_msg):
+		self.frame_stamp = target_msg.header.stamp
+		self.target = np.array([target_msg.target_row, target_msg.target_col])
+		self.intensity_at_target = target_msg.intensity
+		# The message holds float32 heights; key them by our own float64
+		# VIRTUAL_ALTITUDES so that evaluateStep finds them
+		self.virtual_intensity = {}
+		for altitude, intensity in zip(target_msg.virtual_altitudes, target_msg.virtual_intensity):
+			for height in self.VIRTUAL_ALTITUDES:
+				if abs(height - altitude) < 1e-3:
+					self.virtual_intensity[height] = intensity
+
 	def find_good_waypoint(self):
 		global final, length, check2, arr
 		final = []
@@ -150,7 +216,7 @@ class Survey(Helper):
 			arr = findLIS(idx_good_intensities, n)
 			check2.append(arr)
 			for i in range(1,n-1):
-				ele = np.where(arr[0])
+				ele = np.flatnonzero(np.atleast_1d(arr[0])) # np.where of a scalar, gone from newer numpy
 				idx_good_intensities = np.delete(idx_good_intensities,ele)
 				check2.append(findLIS(idx_good_intensities,n-i))
 			for i in range(len(check2)-1):
@@ -185,73 +251,229 @@ class Survey(Helper):
 		print("NO WAYPOINT FOUND !")
 		pass
 
-	def go_to_height(self, h):
-		global final, length, check2, arr
-		opt_height_command = teleopData()
-		opt_height_command.decision = 4
-		opt_height_command.delta = h
-		self.drone_move_pub.publish(opt_height_command)
-		time.sleep(4)
-		print("height reached" , h)
-
-	def scan_using_yaw(self, initial_angle , direction):
-		global final, length, check2, arr
-		self.direction = direction
-		yaw_command = teleopData()
-		yaw_command.decision = 5
-		yaw_command.delta = initial_angle
-		self.drone_move_pub.publish(yaw_command)
-		time.sleep(4)
-		print("reache init deg",initial_angle)
-		for i in range(self.NO_OF_POINTS_TO_CHECK):
-			yaw_command.delta = self.STEP_SIZE * direction
-			self.drone_move_pub.publish(yaw_command)
-			time.sleep(2)
-			print("yaw",(initial_angle+ ((i)*self.STEP_SIZE)))
-			self.target_array[i] = self.target.copy()
-			print("target_array", self.target_array)
-			self.target_intensity_array[i] = self.intensity_at_target
-			print("target_intensity_array", self.target_intensity_array)  
-		
+	def now(self):
+		return rospy.get_time()
+
+	def sendTeleop(self, decision, delta):
+		'''
+		Command to safe_move: decision 4 flies to height delta (m), 5 turns
+		by delta (degrees)
+		'''
+		command = teleopData()
+		command.header.stamp = self.frame_stamp
+		command.decision = decision
+		command.delta = delta
+		self.drone_move_pub.publish(command)
+
+	def publish_height(self, h):
+		self.sendTeleop(4, h)
+
+	def publish_yaw(self, delta):
+		self.sendTeleop(5, delta)
+		self.current_angle += delta
+
+	def publishComplete(self):
+		self.safesearch_complete_flag.data = 1
+		self.safesearch_complete_pub.publish(self.safesearch_complete_flag)
+
+	def sweepPlan(self):
+		'''
+		List of (height, align angle, sample angles, visiting order) with the
+		angles in degrees from the heading at the start of the survey and the
+		sample angles in angular order, so neighbouring entries are adjacent
+		yaw steps
+
+		sweep: the full sweeps of the original survey, each one continuing
+		from where the previous one ended
+		anytime: the same cone around the original heading at every height,
+		visited nearest the heading first
+		'''
+		plan = []
+		if self.strategy == 'sweep':
+			current = 0.
+			for height, initial_angle, direction in self.sweeps():
+				align = current + initial_angle
+				angles = [align + direction*self.STEP_SIZE*(i+1) for i in range(self.NO_OF_POINTS_TO_CHECK)]
+				current = angles[-1]
+				plan.append((height, align, angles, list(range(self.NO_OF_POINTS_TO_CHECK))))
+		else:
+			angles = [-self.CONE/2.0 + self.STEP_SIZE*i for i in range(self.NO_OF_POINTS_TO_CHECK)]
+			# Stable sort visits -step before +step for equal offsets
+			order = sorted(range(self.NO_OF_POINTS_TO_CHECK), key=lambda i: round(abs(angles[i]), 6))
+			for height, _, _ in self.sweeps():
+				plan.append((height, angles[order[0]], angles, order))
+		return plan
+
+	def good_run_centre(self, intensities=None):
+		'''
+		Index of the middle of the longest run of at least EARLY_EXIT_RUN
+		adjacent yaw steps evaluated as good so far, else None
+		'''
+		if self.EARLY_EXIT_RUN is None:
+			return None
+		if intensities is None:
+			intensities = self.target_intensity_array
+		best_start, best_length = None, 0
+		start = None
+		for i, (intensity, threshold) in enumerate(zip(intensities, self.THRESHOLD_INTENSITY)):
+			if intensity is not None and intensity >= threshold:
+				if start is None:
+					start = i
+				if i - start + 1 > best_length:
+					best_start, best_length = start, i - start + 1
+			else:
+				start = None
+		if best_length < self.EARLY_EXIT_RUN:
+			return None
+		return best_start + (best_length - 1)//2
 
 	def start_survey_callback(self,msg):
-		global final, length, check2, arr
+		'''
+		Only arms the survey; the work is done by stepSurvey on the timer
+		so this callback (and the others) never block
+		'''
 		self.survey_flag = msg.data
-
 		if (self.survey_flag == 1 and self.indicator == 0):
 			self.indicator = 1
-			self.go_to_height(2.5)
-			self.scan_using_yaw(-1*(self.CONE/2.0) , 1)
-			if not(self.find_good_waypoint()):
-				self.go_to_height(4)
-				self.scan_using_yaw(0 , -1)
-				if not(self.find_good_waypoint()):
-					self.go_to_height(1)
-					self.scan_using_yaw(0 , 1)
-			# if not(self.find_good_waypoint()):
-
-					#self.emergency()  #to have rtl like function
-			else:
-				print("FOUND NICE WAYPOINT")
-				final_yaw_command = teleopData()
-				final_yaw_command.decision = 5
-				final_yaw_command.delta = self.best_yaw_angle
-				self.drone_move_pub.publish(final_yaw_command)
-				time.sleep(4)
-				self.indicator = 0
-				self.safesearch_complete_flag.data = 1
-				self.safesearch_complete_pub.publish(self.safesearch_complete_flag)
-
-	
+			self.plan = self.sweepPlan()
+			self.sweep_index = 0
+			self.current_angle = 0.
+			self.samples_evaluated = 0
+			self.predicted_angle = None
+			self.state_durations = {}
+			self.survey_start = self.now()
+			self.enterState(self.CLIMB)
+
+	def enterState(self, state):
+		now = self.now()
+		if self.state != self.IDLE:
+			self.state_durations.setdefault(self.state, []).append(now - self.state_start)
+			self.tracer.record('state_' + self.state, now - self.state_start)
+		self.state = state
+		self.state_start = now
+		self.dwell = self.STATE_DWELL.get(state, 0.)
+
+		height, align, angles, order = self.plan[self.sweep_index]
+		if state in (self.CLIMB, self.FALLBACK_ALTITUDE):
+			self.publish_height(height)
+		elif state == self.ALIGN:
+			self.direction = 1 if angles[-1] > angles[0] else -1
+			self.yaw_step = 0
+			self.best_yaw_angle = None
+			self.best_intensity_index = None
+			self.target_array = [None]*self.NO_OF_POINTS_TO_CHECK
+			self.target_intensity_array = [None]*self.NO_OF_POINTS_TO_CHECK
+			self.virtual_arrays = dict((altitude, [None]*self.NO_OF_POINTS_TO_CHECK)
+			                           for altitude in self.VIRTUAL_ALTITUDES)
+			self.turnTo(align)
+		elif state == self.YAW_STEP:
+			self.turnTo(angles[order[self.yaw_step]])
+		elif state == self.COMMIT:
+			print("FOUND NICE WAYPOINT")
+			self.publish_yaw(self.best_yaw_angle)
+		elif state == self.IDLE:
+			self.indicator = 0
+			self.reportDurations(now)
+
+	def turnTo(self, angle):
+		delta = angle - self.current_angle
+		if abs(delta) < 1e-3:
+			# Already facing it; the latest target is from this heading
+			self.dwell = 0.
+		else:
+			self.publish_yaw(delta)
+
+	def reportDurations(self, now):
+		summary = ', '.join('%s %.1fs' % (state, sum(durations))
+		                    for state, durations in sorted(self.state_durations.items()))
+		rospy.loginfo('survey took %.1fs, %d yaw steps (%s)', now - self.survey_start,
+		              self.samples_evaluated, summary)
+
+	def stepSurvey(self, event):
+		if self.state == self.IDLE:
+			return
+		elapsed = self.now() - self.state_start
+		if elapsed < self.dwell:
+			return
 
-			
+		if self.state in (self.CLIMB, self.FALLBACK_ALTITUDE):
+			print("height reached", self.plan[self.sweep_index][0])
+			if self.predicted_angle is not None:
+				# The altitude was picked from the failed cone; no need to look again
+				self.best_yaw_angle = self.predicted_angle - self.current_angle
+				self.predicted_angle = None
+				self.enterState(self.COMMIT)
+			else:
+				self.enterState(self.ALIGN)
+		elif self.state == self.ALIGN:
+			self.enterState(self.YAW_STEP)
+		elif self.state == self.YAW_STEP:
+			self.enterState(self.EVALUATE)
+		elif self.state == self.EVALUATE:
+			self.evaluateStep()
+		elif self.state == self.COMMIT:
+			self.publishComplete()
+			self.enterState(self.IDLE)
+
+	def evaluateStep(self):
+		height, align, angles, order = self.plan[self.sweep_index]
+		i = order[self.yaw_step]
+		if self.target is not None:
+			self.target_array[i] = self.target.copy()
+		self.target_intensity_array[i] = self.intensity_at_target
+		for altitude, predicted in self.virtual_arrays.items():
+			predicted[i] = self.virtual_intensity.get(altitude)
+		print("yaw", angles[i], "intensity", self.intensity_at_target)
+		self.yaw_step += 1
+		self.samples_evaluated += 1
+
+		centre = self.good_run_centre()
+		if centre is not None:
+			self.best_intensity_index = centre
+			self.best_yaw_angle = angles[centre] - self.current_angle
+			self.enterState(self.COMMIT)
+		elif self.yaw_step < len(order):
+			self.enterState(self.YAW_STEP)
+		elif self.find_good_waypoint() and self.best_intensity_index is not None:
+			# Full sweep fallback; find_good_waypoint's angle assumes the
+			# sweep ended on its last entry, which the anytime order doesn't
+			self.best_yaw_angle = angles[int(self.best_intensity_index)] - self.current_angle
+			self.enterState(self.COMMIT)
+		else:
+			self.changeAltitude(angles)
+
+	def changeAltitude(self, angles):
+		'''
+		After a cone without a clear run: climb straight to the first
+		fallback altitude predicted to have one, skip those predicted to be
+		blocked and fly to those that can't be predicted to look
+		'''
+		for index in range(self.sweep_index + 1, len(self.plan)):
+			height = self.plan[index][0]
+			predicted = self.virtual_arrays.get(height)
+			if (not self.VIRTUAL_ALTITUDE or predicted is None
+			    or any(p is None or np.isnan(p) for p in predicted)):
+				self.sweep_index = index
+				self.enterState(self.FALLBACK_ALTITUDE)
+				return
+			centre = self.good_run_centre(predicted)
+			if centre is not None:
+				print("predicted clear at height", height)
+				self.predicted_angle = angles[centre]
+				self.sweep_index = index
+				self.enterState(self.FALLBACK_ALTITUDE)
+				return
+			print("predicted blocked at height", height)
+		self.emergency()  #to have rtl like function
+		self.enterState(self.IDLE)
 
 
 if __name__ == '__main__':
 	rospy.init_node('surveil_node')
 	rospy.loginfo("surveil_node created")
 	try:
-		surveil_node_obj = Survey()
+		surveil_node_obj = Survey(shared_preprocessing=rospy.get_param('~shared_preprocessing', False),
+		                           strategy=rospy.get_param('~survey_strategy', 'anytime'))
 
 		rospy.spin()
 	 
@@ -0,0 +1,186 @@
+#!/usr/bin/env python
+
+# task: polar histogram (VFH+) heading selection for the explorer
+from __future__ import print_function
+from __future__ import division
+
+import numpy as np
+
+from helper2 import Helper
+
+
+class VFHHelper(Helper):
+  '''
+  Vector Field Histogram (Borenstein & Koren; VFH+ by Ulrich & Borenstein)
+  as an alternative to calculatePenalty/findTarget.
+
+  Obstacles around the drone's altitude, from the clearance profile of the
+  current frame and from the occupancy map, are binned by world azimuth
+  into a polar histogram of magnitudes 1 - d/VFH_RADIUS, each obstacle
+  enlarged by the angle VFH_SAFETY subtends at its distance. Sectors
+  above the (hysteresis) threshold are blocked; the free runs inside the
+  camera field of view are the valleys (unseen space is not trusted), and
+  the candidate direction closest to the current heading and the
+  previous choice wins.
+  '''
+
+  def defineParameters(self):
+    Helper.defineParameters(self)
+
+    self.VFH_SECTORS = 72 # 5 degree sectors
+    self.VFH_RADIUS = 6. # m, obstacles further away are ignored
+    self.VFH_BAND = 0.6 # m, obstacles within this height of the drone count
+    self.VFH_SAFETY = 0.6 # m, drone radius plus margin
+    self.vfhThresholds()
+    # Valleys wider than this (sectors) are entered WIDE/2 from their edge
+    self.VFH_WIDE_VALLEY = 8
+    # Cost weights of the deviation from the heading and the last choice
+    self.VFH_MU_HEADING = 5.
+    self.VFH_MU_PREVIOUS = 2.
+
+    self.vfh_blocked = np.zeros(self.VFH_SECTORS, dtype=bool)
+    self.vfh_previous = None # Sector chosen on the last frame
+    self.vfh_sector = None # Sector chosen on this frame, None = no valley
+
+
+  def vfhThresholds(self):
+    # Blocked above HIGH, free below LOW, unchanged in between
+    self.VFH_THRESHOLD_HIGH = 1. - self.DANGER_DISTANCE/self.VFH_RADIUS
+    self.VFH_THRESHOLD_LOW = self.VFH_THRESHOLD_HIGH - 0.1
+
+
+  def applyParameters(self, values):
+    changed = Helper.applyParameters(self, values)
+    if 'DANGER_DISTANCE' in changed:
+      self.vfhThresholds()
+    return changed
+
+
+  def preprocessVFH(self, cv_image_array, stamp=None, occupancy_map=None):
+    '''
+    Like preprocessProfile, with the heading picked by vfhTarget.
+    Returns (histogram, target); vfh_sector is None when every
+    direction is blocked.
+    '''
+    self.frame_position, self.frame_orientation = self.framePose(stamp)
+    cleaned_cv_img = self.decimate(cv_image_array)/self.POINTCLOUD_CUTOFF
+    cleaned_cv_img[np.isnan(cleaned_cv_img)] = 1.0
+    self.filterSkyGround(cleaned_cv_img)
+    return self.vfhTarget(self.clearanceProfile(), occupancy_map)
+
+
+  def profileObstacles(self, profile):
+    '''
+    (distance, world azimuth) of every profile column closer than VFH_RADIUS
+    '''
+    width = profile.size
+    lateral = -(np.arange(width) - width//2)/self.frameFocalLength()
+    near = profile < self.VFH_RADIUS
+    distance = profile[near]*np.sqrt(1. + lateral[near]**2)
+    azimuth = self.frame_orientation[2] + np.arctan(lateral[near])
+    return distance, azimuth
+
+
+  def mapObstacles(self, occupancy_map):
+    '''
+    (distance, world azimuth) of the occupied voxels in the altitude band
+    '''
+    z = self.frame_position[2]
+    points = occupancy_map.occupied_points(z - self.VFH_BAND, z + self.VFH_BAND)
+    offset = points[:,:2] - np.asarray(self.frame_position[:2])
+    distance = np.hypot(offset[:,0], offset[:,1])
+    near = (distance < self.VFH_RADIUS) & (distance > 0)
+    return distance[near], np.arctan2(offset[near,1], offset[near,0])
+
+
+  def polarHistogram(self, distance, azimuth):
+    '''
+    Largest enlarged obstacle magnitude per sector
+    '''
+    if distance.size == 0:
+      # No obstacles (np.max's initial= would need numpy 1.15)
+      return np.zeros(self.VFH_SECTORS)
+    sector_width = 2*np.pi/self.VFH_SECTORS
+    centres = (np.arange(self.VFH_SECTORS) + 0.5)*sector_width
+    magnitude = 1. - distance/self.VFH_RADIUS
+    enlargement = np.arcsin(np.minimum(1., self.VFH_SAFETY/np.maximum(distance, 1e-3)))
+    difference = np.abs(np.angle(np.exp(1j*(centres[None,:] - azimuth[:,None]))))
+    covers = difference <= (enlargement + sector_width/2)[:,None]
+    return np.max(np.where(covers, magnitude[:,None], 0.), axis=0)
+
+
+  def candidateSectors(self, free, goal):
+    '''
+    VFH+ candidates: the centre of narrow valleys, and for wide ones the
+    sectors WIDE/2 in from each edge plus the goal if it lies inside
+    '''
+    n = self.VFH_SECTORS
+    if np.all(free):
+      return [goal]
+    # Rotate so that sector 0 is blocked and valleys don't wrap around
+    shift = int(np.argmin(free))
+    rotated = np.roll(free, -shift)
+    edges = np.diff(np.concatenate(([0], rotated.astype(int), [0])))
+    starts, ends = np.flatnonzero(edges == 1), np.flatnonzero(edges == -1) - 1
+    candidates = []
+    for start, end in zip(starts, ends):
+      start, end = start + shift, end + shift
+      if end - start + 1 <= self.VFH_WIDE_VALLEY:
+        candidates.append(((start + end)//2) % n)
+        continue
+      candidates += [(start + self.VFH_WIDE_VALLEY//2) % n, (end - self.VFH_WIDE_VALLEY//2) % n]
+      if (goal - start) % n <= end - start:
+        candidates.append(goal)
+    return candidates
+
+
+  def vfhTarget(self, profile, occupancy_map=None):
+    '''
+    Histogram of the profile (and map) obstacles, and the target pixel
+    steering towards the chosen valley direction
+    '''
+    distance, azimuth = self.profileObstacles(profile)
+    if occupancy_map is not None:
+      map_distance, map_azimuth = self.mapObstacles(occupancy_map)
+      distance = np.concatenate((distance, map_distance))
+      azimuth = np.concatenate((azimuth, map_azimuth))
+    histogram = self.polarHistogram(distance, azimuth)
+
+    self.vfh_blocked = ((histogram > self.VFH_THRESHOLD_HIGH)
+                        | ((histogram > self.VFH_THRESHOLD_LOW) & self.vfh_blocked))
+    n = self.VFH_SECTORS
+    sector_width = 2*np.pi/n
+    yaw = self.frame_orientation[2]
+    heading = int(np.floor((yaw % (2*np.pi))/sector_width)) % n
+    width = profile.size
+    FOCAL_LENGTH = self.frameFocalLength()
+    half_fov = np.arctan((width//2)/FOCAL_LENGTH)
+    centres = (np.arange(n) + 0.5)*sector_width
+    visible = np.abs(np.angle(np.exp(1j*(centres - yaw)))) <= half_fov
+    free = visible & ~self.vfh_blocked
+
+    self.vfh_sector = None
+    if np.any(free):
+      candidates = np.array(self.candidateSectors(free, heading))
+      sector_distance = lambda a, b: np.minimum((a - b) % n, (b - a) % n)
+      cost = self.VFH_MU_HEADING*sector_distance(candidates, heading)
+      if self.vfh_previous is not None:
+        cost = cost + self.VFH_MU_PREVIOUS*sector_distance(candidates, self.vfh_previous)
+      self.vfh_sector = int(candidates[np.argmin(cost)])
+      self.vfh_previous = self.vfh_sector
+
+    col = width//2
+    if self.vfh_sector is not None:
+      relative = np.angle(np.exp(1j*(centres[self.vfh_sector] - yaw)))
+      relative = np.clip(relative, -half_fov, half_fov)
+      col = int(np.clip(round(width//2 - FOCAL_LENGTH*np.tan(relative)), 0, width-1))
+    return histogram, np.array([self.referenceRow(), col])
+
+
+  def vfhClearance(self, histogram):
+    '''
+    Distance (m) of the nearest enlarged obstacle in the chosen sector
+    '''
+    if self.vfh_sector is None:
+      return 0.
+    return (1. - histogram[self.vfh_sector])*self.VFH_RADIUS